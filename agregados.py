@@ -0,0 +1,244 @@
+import os
+import csv
+import json
+import logging
+import argparse
+import threading
+
+from formatos_gastos import amount_range, parse_date
+
+# ================================
+# Agregados del dashboard mantenidos de forma incremental
+# ================================
+# Guarda en un JSON las sumas y recuentos que necesita analisis_datos.analyze_data
+# (por categoría, empresa, mes, forma de pago, día de la semana, trimestre y rango de
+# importe, KPIs y últimas transacciones). Cada gasto nuevo los actualiza en O(1), así que
+# generar los datos del dashboard ya no depende del tamaño del histórico.
+
+RECENT_TRANSACTIONS = 5
+TOP_BUSINESSES = 10
+MONTHS_SHOWN = 12
+
+def _round1(value):
+    # Mismo redondeo que pandas/numpy .round(1): redondeo al par sobre value * 10
+    return round(value * 10) / 10
+
+def _parse_amount(value):
+    try:
+        amount = float(str(value).replace('€', '').replace('$', '').replace(',', '.').strip())
+    except (TypeError, ValueError):
+        return None
+    return None if amount != amount else amount  # NaN
+
+def _empty_state():
+    return {
+        'version': 1,
+        'total': 0.0,
+        'count': 0,
+        'max': None,
+        'categorias': {},
+        'empresas': {},
+        'metodos_pago': {},
+        'rangos': {},
+        'meses': {},
+        'dias_semana': {},
+        'trimestres': {},
+        'recientes': [],
+    }
+
+def rows_from_csv(csv_path):
+    """
+    Lee registro_gastos.csv y devuelve sus filas con los nombres de columna de analyze_data.
+    """
+    with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield {
+                'Fecha': row.get('Fecha'),
+                'empresa': row.get('Negocio'),
+                'descripcion': row.get('Descripción'),
+                'importe': row.get('Importe'),
+                'categoria': row.get('Categoría'),
+                'forma_pago': row.get('Forma de pago') or 'Desconocido',
+            }
+
+class ExpenseAggregates:
+    """
+    Agregados persistentes de los gastos. to_dashboard_data() devuelve el mismo diccionario
+    que analisis_datos.analyze_data para los mismos gastos.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Ruta del JSON donde se guardan los agregados
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = _empty_state()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """
+        Carga los agregados desde disco.
+
+        :return: Número de gastos agregados
+        """
+        with self._lock:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except FileNotFoundError:
+                self.state = _empty_state()
+        return self.state['count']
+
+    def save(self):
+        """
+        Guarda los agregados de forma atómica (archivo temporal + rename).
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def add(self, row):
+        """
+        Añade un gasto a los agregados.
+
+        :param row: Diccionario con las columnas de analyze_data
+                    ('Fecha', 'empresa', 'descripcion', 'importe', 'categoria', 'forma_pago')
+        :return: True si se agregó, False si la fecha o el importe no son válidos
+        """
+        # Mismos formatos que esquema_gastos, para contar los mismos gastos que analyze_data
+        fecha = parse_date(row.get('Fecha'))
+        importe = _parse_amount(row.get('importe'))
+        if fecha is None or importe is None:
+            return False
+
+        with self._lock:
+            state = self.state
+            state['total'] += importe
+            state['count'] += 1
+            state['max'] = importe if state['max'] is None else max(state['max'], importe)
+
+            for group, key in (('categorias', row.get('categoria')),
+                               ('empresas', row.get('empresa')),
+                               ('metodos_pago', row.get('forma_pago')),
+                               ('rangos', amount_range(importe))):
+                if key is None:
+                    continue
+                entry = state[group].setdefault(key, [0.0, 0])
+                entry[0] += importe
+                entry[1] += 1
+
+            for group, key in (('meses', fecha.strftime('%Y-%m')),
+                               ('dias_semana', fecha.strftime('%A')),
+                               ('trimestres', f"{fecha.year}-Q{(fecha.month - 1) // 3 + 1}")):
+                state[group][key] = state[group].get(key, 0.0) + importe
+
+            recent = state['recientes']
+            if len(recent) < RECENT_TRANSACTIONS or fecha.strftime('%Y-%m-%d') > recent[-1]['Fecha']:
+                recent.append({
+                    'Fecha': fecha.strftime('%Y-%m-%d'),
+                    'empresa': row.get('empresa'),
+                    'descripcion': row.get('descripcion'),
+                    'importe': importe,
+                    'categoria': row.get('categoria')
+                })
+                recent.sort(key=lambda t: t['Fecha'], reverse=True)
+                del recent[RECENT_TRANSACTIONS:]
+        return True
+
+    def rebuild(self, rows):
+        """
+        Recalcula los agregados desde cero y los guarda.
+
+        :param rows: Iterable de diccionarios con las columnas de analyze_data
+        :return: Número de gastos agregados
+        """
+        with self._lock:
+            self.state = _empty_state()
+        for row in rows:
+            self.add(row)
+        self.save()
+        logging.info(f"Agregados del dashboard reconstruidos: {self.state['count']} gastos.")
+        return self.state['count']
+
+    @staticmethod
+    def _records(groups, name, limit=None):
+        records = [{name: key, 'sum': total, 'count': count} for key, (total, count) in sorted(groups.items())]
+        records.sort(key=lambda r: r['sum'], reverse=True)
+        if limit:
+            records = records[:limit]
+        group_total = sum(r['sum'] for r in records)
+        for record in records:
+            record['percentage'] = _round1(record['sum'] / group_total * 100) if group_total else 0.0
+        return records
+
+    def to_dashboard_data(self):
+        """
+        Genera los datos del dashboard a partir de los agregados.
+
+        :return: Diccionario con el mismo formato que analyze_data, o None si no hay gastos
+        """
+        with self._lock:
+            state = json.loads(json.dumps(self.state))
+        if not state['count']:
+            return None
+
+        months = sorted(state['meses'].items())[-MONTHS_SHOWN:]
+        if len(months) >= 2:
+            ultimo_mes, penultimo_mes = months[-1][1], months[-2][1]
+            tendencia_mensual = _round1((ultimo_mes - penultimo_mes) / penultimo_mes * 100) if penultimo_mes > 0 else 0
+        else:
+            tendencia_mensual = 0
+
+        quarters = sorted(state['trimestres'].items())
+
+        return {
+            'general': {
+                'total_gasto': state['total'],
+                'promedio_gasto': state['total'] / state['count'],
+                'max_gasto': state['max'],
+                'num_transacciones': state['count'],
+                'tendencia_mensual': tendencia_mensual
+            },
+            'categorias': self._records(state['categorias'], 'categoria'),
+            'empresas': self._records(state['empresas'], 'empresa', limit=TOP_BUSINESSES),
+            'meses': {
+                'labels': [month for month, _ in months],
+                'values': [total for _, total in months]
+            },
+            'metodos_pago': self._records(state['metodos_pago'], 'forma_pago'),
+            'transacciones_recientes': state['recientes'],
+            'por_dia_semana': [{'dia_semana': day, 'importe': total}
+                               for day, total in sorted(state['dias_semana'].items())],
+            'trimestral': {
+                'labels': [quarter for quarter, _ in quarters],
+                'values': [total for _, total in quarters]
+            },
+            'rangos': [{'rango_importe': key, 'sum': total, 'count': count}
+                       for key, (total, count) in sorted(state['rangos'].items())]
+        }
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    state_dir = os.getenv('STATE_DIR', os.path.join(script_dir, ".asistente"))
+
+    parser = argparse.ArgumentParser(description="Agregados del dashboard de gastos.")
+    parser.add_argument('--rebuild', action='store_true', help="Recalcular los agregados desde el CSV")
+    parser.add_argument('--csv', default=os.path.join(script_dir, "registro_gastos.csv"),
+                        help="CSV de gastos desde el que reconstruir")
+    parser.add_argument('--path', default=os.path.join(state_dir, "agregados.json"),
+                        help="Archivo de agregados")
+    args = parser.parse_args()
+
+    aggregates = ExpenseAggregates(args.path)
+    if args.rebuild or not aggregates.exists():
+        aggregates.rebuild(rows_from_csv(args.csv))
+    else:
+        aggregates.load()
+    print(json.dumps(aggregates.to_dashboard_data(), indent=2, ensure_ascii=False))
@@ -0,0 +1,315 @@
+import os
+import csv
+import json
+import uuid
+import logging
+import argparse
+from datetime import datetime
+
+from formatos_gastos import parse_date
+
+# ================================
+# Almacén columnar de gastos particionado por mes
+# ================================
+# Estructura en disco (una carpeta por mes, estilo Hive):
+#
+#   <raíz>/mes=2025-02/part-20250226-145330-1a2b3c4d.parquet
+#   <raíz>/mes=2025-02/part-20250226-145406-5e6f7a8b.parquet
+#   <raíz>/mes=2025-03/compactado.parquet
+#
+# Cada escritura añade un archivo pequeño a las particiones afectadas; compact() los une
+# en uno solo por mes. Los lectores solo abren los meses y columnas que necesitan.
+# Requiere pyarrow.
+#
+# Las fechas se interpretan con los mismos formatos que el resto del proyecto; si una no
+# encaja en ninguno, el texto original se guarda en fecha_original y se exporta tal cual.
+
+# Columnas del almacén y su cabecera equivalente en registro_gastos.csv
+CSV_COLUMNS = {
+    'fecha': 'Fecha',
+    'negocio': 'Negocio',
+    'descripcion': 'Descripción',
+    'importe': 'Importe',
+    'categoria': 'Categoría',
+    'archivo': 'Archivo',
+    'fecha_procesamiento': 'Fecha Procesamiento',
+}
+
+# Durante la compactación, lista del archivo nuevo y de los que sustituye: si el proceso se
+# interrumpe, la siguiente lectura termina o deshace la compactación en lugar de duplicar filas
+COMPACTION_MARKER = "compactando.json"
+
+def _arrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("El almacén de gastos en Parquet necesita pyarrow (pip install pyarrow)")
+    return pa, pq
+
+def _schema(pa):
+    return pa.schema([
+        ('fecha', pa.date32()),
+        ('negocio', pa.dictionary(pa.int32(), pa.string())),
+        ('descripcion', pa.string()),
+        ('importe', pa.float64()),
+        ('categoria', pa.dictionary(pa.int8(), pa.string())),
+        ('archivo', pa.string()),
+        ('fecha_procesamiento', pa.timestamp('s')),
+        ('fecha_original', pa.string()),
+    ])
+
+def _concat_tables(pa, tables):
+    """
+    Une tablas leídas de archivos con distintas versiones del esquema: a los escritos antes de
+    existir fecha_original se les añade la columna vacía.
+    """
+    schema = _schema(pa)
+    names = [field.name for field in schema if any(field.name in table.column_names for table in tables)]
+    conformed = []
+    for table in tables:
+        for name in names:
+            if name not in table.column_names:
+                field = schema.field(name)
+                table = table.append_column(field, pa.nulls(len(table), field.type))
+        conformed.append(table.select(names))
+    return pa.concat_tables(conformed)
+
+def _parse_amount(value):
+    try:
+        return float(str(value).replace('€', '').replace(',', '.').strip())
+    except (TypeError, ValueError):
+        return None
+
+def _parse_timestamp(value):
+    try:
+        return datetime.strptime(str(value).strip(), '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+def normalize_row(row):
+    """
+    Convierte una fila con las cabeceras del CSV o con las claves del almacén a los tipos del almacén.
+
+    :param row: Diccionario con los datos de un gasto
+    :return: Diccionario con las columnas del almacén tipadas
+    """
+    value = lambda key: row.get(key, row.get(CSV_COLUMNS[key]))
+    raw_date = value('fecha')
+    fecha = parse_date(raw_date)
+    return {
+        'fecha': fecha,
+        'negocio': value('negocio'),
+        'descripcion': value('descripcion'),
+        'importe': _parse_amount(value('importe')),
+        'categoria': value('categoria'),
+        'archivo': value('archivo'),
+        'fecha_procesamiento': _parse_timestamp(value('fecha_procesamiento')),
+        'fecha_original': str(raw_date).strip() if fecha is None and raw_date not in (None, '') else None,
+    }
+
+def partition_key(row):
+    """
+    Mes (YYYY-MM) de la partición de un gasto: el de su fecha o, si no tiene, el de procesamiento.
+    """
+    date = row['fecha'] or row['fecha_procesamiento']
+    return date.strftime('%Y-%m') if date else 'desconocido'
+
+class ExpenseStore:
+    """
+    Almacén de gastos en archivos Parquet comprimidos y particionados por mes.
+    """
+
+    def __init__(self, root, compression='zstd'):
+        """
+        :param root: Carpeta raíz del almacén
+        :param compression: Códec de compresión de Parquet
+        """
+        self.root = root
+        self.compression = compression
+
+    def _partition_dir(self, month):
+        return os.path.join(self.root, f"mes={month}")
+
+    def months(self):
+        """
+        Lista los meses con datos, ordenados.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[4:] for name in os.listdir(self.root) if name.startswith('mes='))
+
+    def _part_files(self, month):
+        directory = self._partition_dir(month)
+        if not os.path.isdir(directory):
+            return []
+        self._recover_compaction(directory)
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.parquet'))
+
+    def append(self, rows):
+        """
+        Añade gastos al almacén escribiendo un archivo nuevo en cada partición afectada.
+        Los archivos se escriben con nombre temporal y se renombran al terminar, así que
+        un lector nunca ve un archivo a medias.
+
+        :param rows: Lista de diccionarios (cabeceras del CSV o claves del almacén)
+        :return: Número de filas escritas
+        """
+        pa, pq = _arrow()
+        schema = _schema(pa)
+        by_month = {}
+        for row in rows:
+            normalized = normalize_row(row)
+            by_month.setdefault(partition_key(normalized), []).append(normalized)
+
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        for month, month_rows in by_month.items():
+            directory = self._partition_dir(month)
+            os.makedirs(directory, exist_ok=True)
+            table = pa.Table.from_pylist(month_rows, schema=schema)
+            path = os.path.join(directory, f"part-{stamp}-{uuid.uuid4().hex[:8]}.parquet")
+            pq.write_table(table, path + ".tmp", compression=self.compression)
+            os.replace(path + ".tmp", path)
+        return len(rows)
+
+    def read(self, months=None, columns=None):
+        """
+        Lee gastos del almacén.
+
+        :param months: Lista de meses (YYYY-MM) a leer; None para todos
+        :param columns: Lista de columnas a leer; None para todas
+        :return: DataFrame de pandas con los gastos
+        """
+        pa, pq = _arrow()
+        selected = self.months() if months is None else [m for m in self.months() if m in set(months)]
+        tables = [pq.read_table(path, columns=columns) for month in selected for path in self._part_files(month)]
+        if not tables:
+            return _schema(pa).empty_table().select(columns or _schema(pa).names).to_pandas()
+        return _concat_tables(pa, tables).to_pandas()
+
+    def _recover_compaction(self, directory):
+        """
+        Termina o deshace una compactación interrumpida: si el archivo compactado ya se publicó
+        se borran los que sustituye; si no, se borra el temporal.
+        """
+        marker_path = os.path.join(directory, COMPACTION_MARKER)
+        if not os.path.exists(marker_path):
+            return
+        with open(marker_path, 'r', encoding='utf-8') as f:
+            marker = json.load(f)
+        target = os.path.join(directory, marker['destino'])
+        leftovers = marker['partes'] if os.path.exists(target) else [marker['destino'] + ".tmp"]
+        for name in leftovers:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        os.remove(marker_path)
+        logging.warning(f"Compactación interrumpida en {directory}: "
+                        f"{'completada' if os.path.exists(target) else 'deshecha'}.")
+
+    def compact(self, min_parts=2):
+        """
+        Une los archivos de cada partición en uno solo, ordenado por fecha.
+
+        :param min_parts: Solo se compactan las particiones con al menos este número de archivos
+        :return: Número de particiones compactadas
+        """
+        pa, pq = _arrow()
+        compacted = 0
+        for month in self.months():
+            parts = self._part_files(month)
+            if len(parts) < min_parts:
+                continue
+            table = _concat_tables(pa, [pq.read_table(path) for path in parts])
+            table = table.sort_by([('fecha', 'ascending'), ('fecha_procesamiento', 'ascending')])
+            directory = self._partition_dir(month)
+            name = f"compactado-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+            target = os.path.join(directory, name)
+            pq.write_table(table, target + ".tmp", compression=self.compression)
+            # Marca con el archivo nuevo y los que sustituye antes de publicarlo
+            marker_path = os.path.join(directory, COMPACTION_MARKER)
+            with open(marker_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump({'destino': name, 'partes': [os.path.basename(path) for path in parts]}, f)
+            os.replace(marker_path + ".tmp", marker_path)
+            os.replace(target + ".tmp", target)
+            for path in parts:
+                os.remove(path)
+            os.remove(marker_path)
+            compacted += 1
+        if compacted:
+            logging.info(f"Almacén de gastos: {compacted} particiones compactadas.")
+        return compacted
+
+    def export_csv(self, csv_path):
+        """
+        Exporta el almacén completo a un CSV con el formato de registro_gastos.csv.
+
+        :param csv_path: Ruta del CSV de salida
+        :return: Número de filas exportadas
+        """
+        df = self.read()
+        df = df.sort_values(['fecha_procesamiento', 'fecha'], kind='stable')
+        original = df['fecha_original'] if 'fecha_original' in df else None
+        df['fecha'] = df['fecha'].map(lambda value: value.isoformat() if value is not None and value == value else None)
+        if original is not None:
+            df['fecha'] = df['fecha'].fillna(original)
+        df['fecha_procesamiento'] = df['fecha_procesamiento'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        df = df.rename(columns=CSV_COLUMNS)[list(CSV_COLUMNS.values())]
+        tmp_path = csv_path + ".tmp"
+        df.to_csv(tmp_path, index=False, encoding='utf-8')
+        os.replace(tmp_path, csv_path)
+        logging.info(f"Almacén de gastos exportado a {csv_path} ({len(df)} filas).")
+        return len(df)
+
+    def import_csv(self, csv_path):
+        """
+        Carga en el almacén las filas de un CSV con el formato de registro_gastos.csv, salvo las
+        de archivos que ya están en él (se puede repetir sin duplicar filas).
+
+        :param csv_path: Ruta del CSV de entrada
+        :return: Número de filas importadas
+        """
+        stored = set(self.read(columns=['archivo'])['archivo'].dropna())
+        with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file:
+            rows = [row for row in csv.DictReader(csv_file) if row.get(CSV_COLUMNS['archivo']) not in stored]
+        count = self.append(rows)
+        self.compact(min_parts=1)
+        logging.info(f"Importadas {count} filas de {csv_path} al almacén de gastos.")
+        return count
+
+    def csv_rows_missing(self, csv_path):
+        """
+        Cuenta las filas de un CSV con el formato de registro_gastos.csv cuyo archivo no está en
+        el almacén (exportar encima las perdería).
+
+        :param csv_path: Ruta del CSV
+        :return: Número de filas del CSV que faltan en el almacén
+        """
+        if not os.path.isfile(csv_path):
+            return 0
+        stored = set(self.read(columns=['archivo'])['archivo'].dropna())
+        with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file:
+            return sum(1 for row in csv.DictReader(csv_file)
+                       if row.get(CSV_COLUMNS['archivo']) and row[CSV_COLUMNS['archivo']] not in stored)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Gestión del almacén de gastos en Parquet.")
+    parser.add_argument('accion', choices=['import-csv', 'export-csv', 'compact'],
+                        help="import-csv: cargar un CSV; export-csv: generar el CSV; compact: unir archivos por mes")
+    parser.add_argument('--store', default=os.getenv('EXPENSE_STORE_DIR', os.path.join(script_dir, "gastos")),
+                        help="Carpeta del almacén")
+    parser.add_argument('--csv', default=os.path.join(script_dir, "registro_gastos.csv"),
+                        help="Ruta del CSV a importar o exportar")
+    args = parser.parse_args()
+
+    store = ExpenseStore(args.store)
+    if args.accion == 'import-csv':
+        store.import_csv(args.csv)
+    elif args.accion == 'export-csv':
+        store.export_csv(args.csv)
+    else:
+        store.compact()
@@ -1,93 +1,96 @@
 import pandas as pd
+
+from formatos_gastos import RANGE_BINS, RANGE_LABELS
+
+# Nombres de los días de la semana por número (0 = lunes), en el idioma de strftime('%A')
+WEEKDAY_NAMES = [pd.Timestamp(2024, 1, 1 + day).strftime('%A') for day in range(7)]
+
+def _share_table(importe, keys, name, limit=None):
+    """
+    Suma y cuenta los importes por clave, ordena por importe (opcionalmente se queda con
+    los primeros) y añade el porcentaje de cada grupo sobre el total de la tabla.
+    """
+    table = importe.groupby(keys, observed=True).agg(['sum', 'count']).rename_axis(name).reset_index()
+    table = table.sort_values('sum', ascending=False)
+    if limit:
+        table = table.head(limit)
+    table['percentage'] = (table['sum'] / table['sum'].sum() * 100).round(1)
+    return table
+
 def analyze_data(df):
     """
     Analiza los datos y crea las métricas para el dashboard
-    
+
+    Todas las agregaciones son vectorizadas y trabajan sobre columnas del DataFrame original,
+    que no se modifica ni se copia.
+
     Args:
         df (pandas.DataFrame): DataFrame con los datos de gastos
-    
+
     Returns:
         dict: Diccionario con las métricas para el dashboard
     """
     if df is None or df.empty:
         return None
-    
-    # Convertir Fecha a datetime para manipulaciones
-    df['Fecha'] = pd.to_datetime(df['Fecha'])
-    
+
+    # Fechas como datetime (sin añadir columnas al DataFrame recibido)
+    fecha = pd.to_datetime(df['Fecha'])
+    importe = df['importe']
+
     # Analizar por categoría
-    category_data = df.groupby('categoria')['importe'].agg(['sum', 'count']).reset_index()
-    category_data = category_data.sort_values('sum', ascending=False)
-    category_data['percentage'] = (category_data['sum'] / category_data['sum'].sum() * 100).round(1)
-    
+    category_data = _share_table(importe, df['categoria'], 'categoria')
+
     # Analizar por empresa (top 10)
-    business_data = df.groupby('empresa')['importe'].agg(['sum', 'count']).reset_index()
-    business_data = business_data.sort_values('sum', ascending=False).head(10)
-    business_data['percentage'] = (business_data['sum'] / business_data['sum'].sum() * 100).round(1)
-    
-    # Analizar por mes
-    df['mes_año'] = df['Fecha'].dt.strftime('%Y-%m')
-    monthly_data = df.groupby('mes_año')['importe'].sum().reset_index()
-    monthly_data = monthly_data.sort_values('mes_año')
-    
+    business_data = _share_table(importe, df['empresa'], 'empresa', limit=10)
+
+    # Analizar por mes (periodos mensuales; solo se formatean las etiquetas resultantes)
+    monthly = importe.groupby(fecha.dt.to_period('M')).sum().sort_index()
+
     # Obtener meses para el gráfico (últimos 12 meses)
-    if len(monthly_data) > 12:
-        monthly_data = monthly_data.tail(12)
-    
+    if len(monthly) > 12:
+        monthly = monthly.tail(12)
+
     # Analizar por método de pago
-    payment_data = df.groupby('forma_pago')['importe'].agg(['sum', 'count']).reset_index()
-    payment_data = payment_data.sort_values('sum', ascending=False)
-    payment_data['percentage'] = (payment_data['sum'] / payment_data['sum'].sum() * 100).round(1)
-    
-    # Añadir análisis por día de la semana
-    df['dia_semana'] = df['Fecha'].dt.strftime('%A')
-    weekday_data = df.groupby('dia_semana')['importe'].sum().reset_index()
-    
+    payment_data = _share_table(importe, df['forma_pago'], 'forma_pago')
+
+    # Añadir análisis por día de la semana (ordenado por nombre, como el groupby original)
+    weekday = importe.groupby(fecha.dt.dayofweek).sum()
+    weekday_data = pd.DataFrame({
+        'dia_semana': [WEEKDAY_NAMES[int(day)] for day in weekday.index],
+        'importe': weekday.to_numpy()
+    }).sort_values('dia_semana')
+
     # Añadir análisis trimestral
-    df['trimestre'] = df['Fecha'].dt.quarter
-    df['año'] = df['Fecha'].dt.year
-    quarterly_data = df.groupby(['año', 'trimestre'])['importe'].sum().reset_index()
-    quarterly_data['periodo'] = quarterly_data['año'].astype(str) + '-Q' + quarterly_data['trimestre'].astype(str)
-    quarterly_data = quarterly_data.sort_values(['año', 'trimestre'])
-    
-    # Obtener las últimas 5 transacciones
-    recent_transactions = df.sort_values('Fecha', ascending=False).head(5)
-    recent_transactions['Fecha_str'] = recent_transactions['Fecha'].dt.strftime('%Y-%m-%d')
-    
+    quarterly = importe.groupby(fecha.dt.to_period('Q')).sum().sort_index()
+    quarterly_labels = [f"{period.year}-Q{period.quarter}" for period in quarterly.index]
+
+    # Obtener las últimas 5 transacciones (selección parcial en lugar de ordenar todo),
+    # por posición para no depender de que el índice del DataFrame sea único
+    recent_positions = pd.Series(fecha.to_numpy()).nlargest(5, keep='first').index
+
     # Calcular KPIs generales
-    total_gasto = df['importe'].sum()
-    promedio_gasto = df['importe'].mean()
-    max_gasto = df['importe'].max()
+    values = importe.to_numpy()
+    total_gasto = importe.sum()
+    promedio_gasto = importe.mean()
+    max_gasto = importe.max()
     num_transacciones = len(df)
-    
+
     # Tendencia respecto al mes anterior
-    if len(monthly_data) >= 2:
-        ultimo_mes = monthly_data.iloc[-1]['importe']
-        penultimo_mes = monthly_data.iloc[-2]['importe']
+    if len(monthly) >= 2:
+        ultimo_mes = monthly.iloc[-1]
+        penultimo_mes = monthly.iloc[-2]
         tendencia_mensual = ((ultimo_mes - penultimo_mes) / penultimo_mes * 100).round(1) if penultimo_mes > 0 else 0
     else:
         tendencia_mensual = 0
-    
-    # Gastos por rango
-    def get_range(value):
-        """
-        Retorna el rango de gasto para un importe dado
-        """
-        if value < 10:
-            return "Menos de 10€"
-        elif value < 50:
-            return "10€ - 50€"
-        elif value < 100:
-            return "50€ - 100€"
-        elif value < 500:
-            return "100€ - 500€"
-        else:
-            return "Más de 500€"
-    
-    df['rango_importe'] = df['importe'].apply(get_range)
-    range_data = df.groupby('rango_importe')['importe'].agg(['sum', 'count']).reset_index()
+
+    # Gastos por rango: cortes por intervalos; un importe vacío cae en el último rango,
+    # igual que en la comparación encadenada original
+    ranges = pd.cut(values, RANGE_BINS, right=False, labels=RANGE_LABELS).fillna(RANGE_LABELS[-1])
+    range_data = importe.groupby(ranges, observed=True).agg(['sum', 'count'])
+    range_data = range_data.rename_axis('rango_importe').reset_index()
+    range_data['rango_importe'] = range_data['rango_importe'].astype(str)
     range_data = range_data.sort_values('rango_importe')
-    
+
     # Preparar los datos para el dashboard
     dashboard_data = {
         'general': {
@@ -100,27 +103,29 @@ def analyze_data(df):
         'categorias': category_data.to_dict('records'),
         'empresas': business_data.to_dict('records'),
         'meses': {
-            'labels': monthly_data['mes_año'].tolist(),
-            'values': monthly_data['importe'].tolist()
+            'labels': monthly.index.strftime('%Y-%m').tolist(),
+            'values': monthly.tolist()
         },
         'metodos_pago': payment_data.to_dict('records'),
         'transacciones_recientes': [],
         'por_dia_semana': weekday_data.to_dict('records'),
         'trimestral': {
-            'labels': quarterly_data['periodo'].tolist(),
-            'values': quarterly_data['importe'].tolist()
+            'labels': quarterly_labels,
+            'values': quarterly.tolist()
         },
         'rangos': range_data.to_dict('records')
     }
-    
+
     # Formatear transacciones recientes para el dashboard
-    for _, row in recent_transactions.iterrows():
+    recent = df.iloc[recent_positions][['empresa', 'descripcion', 'importe', 'categoria']]
+    for fecha_str, (empresa, descripcion, importe_row, categoria) in zip(
+            fecha.iloc[recent_positions].dt.strftime('%Y-%m-%d'), recent.itertuples(index=False)):
         dashboard_data['transacciones_recientes'].append({
-            'Fecha': row['Fecha_str'],
-            'empresa': row['empresa'],
-            'descripcion': row['descripcion'],
-            'importe': row['importe'],
-            'categoria': row['categoria']
+            'Fecha': fecha_str,
+            'empresa': empresa,
+            'descripcion': descripcion,
+            'importe': importe_row,
+            'categoria': categoria
         })
-    
+
     return dashboard_data
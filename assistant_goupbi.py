@@ -1,18 +1,35 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import base64
-import requests
 import json
 import os
 import csv
 import logging
 import io
+import argparse
+import threading
+import time
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
-# Librerías para la API de Google Drive
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from indice_procesados import ProcessedIndex
+from cache_extracciones import ExtractionCache, content_hash, extraction_fingerprint
+from escritura_sheets import SheetWriter
+from preprocesado_imagenes import preprocess_image
+from cliente_openai import OpenAIClient
+from clientes_google import get_google_clients
+from almacen_gastos import ExpenseStore
+from agregados import ExpenseAggregates, rows_from_csv
+from instantanea_dashboard import SNAPSHOT_FILE, write_snapshot
+from duplicados_perceptuales import PerceptualIndex, dhash
+from categorias_negocios import CATEGORIES, MerchantCategoryMemo
+from extractores import ExtractorChain, LocalOCRExtractor
+from diario_trabajos import JobJournal
+from metricas import PipelineMetrics
+from informe_ejecucion import RunReport, write_report
+from reintentos import RETRYABLE_STATUS_CODES, backoff_delay
+from extraccion_multiple import ReceiptBatcher, build_multi_payload, parse_multi_response
+from formatos_gastos import parse_date
 
 # Configuración del logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,89 +48,231 @@ else:
 # Cargar variables de entorno
 load_dotenv(ENV_FILE)
 
-# ================================
-# Usar credenciales de las variables de entorno o valores predeterminados
-# ================================
-# Verificamos si las credenciales están en las variables de entorno
-GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE')
-if not GOOGLE_CREDENTIALS_FILE or not os.path.exists(GOOGLE_CREDENTIALS_FILE):
-    # Si no está en el .env o la ruta no existe, usamos la ubicación original
-    GOOGLE_CREDENTIALS_FILE = "C:/Users/nicol/OneDrive/Desktop/Asistente/credentials.json"
-    logging.info(f"Usando ruta a credenciales predeterminada: {GOOGLE_CREDENTIALS_FILE}")
-
-# Spreadsheet URL
-SPREADSHEET_URL = os.getenv('SPREADSHEET_URL', "https://docs.google.com/spreadsheets/d/1_fOKbe6g5dlkRNJl4nWujfcLh7if_5oD4oLBJWPPvJI/edit?usp=drive_link")
-logging.info(f"URL de la hoja de cálculo: {SPREADSHEET_URL}")
-
 # API Key de OpenAI
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+# Límites de la cuenta (se ajustan solos con las cabeceras x-ratelimit-* de cada respuesta)
+OPENAI_RPM = int(os.getenv('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.getenv('OPENAI_TPM', '30000'))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '120'))
+
+# Prompt para solicitar la extracción de datos específicos
+EXTRACTION_PROMPT = """
+Analiza esta imagen de un recibo o factura y extrae la siguiente información en formato JSON:
+1. fecha: la fecha de la transacción (formato YYYY-MM-DD)
+2. descripcion: breve descripción de la compra o servicio
+3. importe: cantidad total pagada (número decimal)
+4. negocio: nombre del negocio o entidad que emitió el recibo
+5. categoria: asigna una de estas categorías al gasto:
+   - Suscripciones
+   - Salud
+   - Vivienda
+   - Movilidad
+   - Educación
+   - Alimentos
+   - Salidas
+   - Gastos extraordinarios
+
+Responde ÚNICAMENTE con el objeto JSON puro, sin marcadores de código (```), comillas ni texto adicional.
+"""
+EXTRACTION_FIELDS = ['fecha', 'descripcion', 'importe', 'negocio', 'categoria']
+
+# Prompt corto: sin la clasificación, que se resuelve en local con la tabla de negocios conocidos
+SHORT_EXTRACTION_PROMPT = """
+Analiza esta imagen de un recibo o factura y extrae en formato JSON:
+1. fecha: fecha de la transacción (YYYY-MM-DD)
+2. descripcion: breve descripción de la compra o servicio
+3. importe: cantidad total pagada (número decimal)
+4. negocio: nombre del negocio que emitió el recibo
+
+Responde ÚNICAMENTE con el objeto JSON puro, sin marcadores de código ni texto adicional.
+"""
+SHORT_EXTRACTION_FIELDS = ['fecha', 'descripcion', 'importe', 'negocio']
+
+# Extracción de varios tickets por petición (MULTI_RECEIPT_SIZE > 1): cada imagen va precedida
+# de "Ticket <n>" y la respuesta sigue un esquema JSON estricto con la lista de tickets
+MULTI_EXTRACTION_PROMPT = """
+Analiza estas {n} imágenes de recibos o facturas. Cada imagen va precedida de la línea "Ticket <n>".
+Para cada imagen devuelve un elemento en "tickets" con su número en "indice" y:
+1. fecha: la fecha de la transacción (formato YYYY-MM-DD)
+2. descripcion: breve descripción de la compra o servicio
+3. importe: cantidad total pagada (número decimal)
+4. negocio: nombre del negocio o entidad que emitió el recibo
+5. categoria: la categoría del gasto, una de las permitidas
+
+Devuelve exactamente un elemento por imagen y no mezcles datos de imágenes distintas.
+"""
+SHORT_MULTI_EXTRACTION_PROMPT = """
+Analiza estas {n} imágenes de recibos o facturas. Cada imagen va precedida de la línea "Ticket <n>".
+Para cada imagen devuelve un elemento en "tickets" con su número en "indice" y:
+1. fecha: fecha de la transacción (YYYY-MM-DD)
+2. descripcion: breve descripción de la compra o servicio
+3. importe: cantidad total pagada (número decimal)
+4. negocio: nombre del negocio que emitió el recibo
+
+Devuelve exactamente un elemento por imagen y no mezcles datos de imágenes distintas.
+"""
+
+# Clasificación solo con texto (sin imagen) para los negocios que no están en la tabla
+CLASSIFICATION_PROMPT = """
+Asigna una de estas categorías al gasto: {categorias}.
+Negocio: {negocio}
+Descripción: {descripcion}
+Responde ÚNICAMENTE con el nombre de la categoría.
+"""
 # IDs de carpetas
 TICKETS_FOLDER_ID = os.getenv('TICKETS_FOLDER_ID', '1o7ODEc36bYV0cKWP9gxIgr4cWSvCRz6A')
 TICKETS_CARGADOS_FOLDER_ID = os.getenv('TICKETS_CARGADOS_FOLDER_ID', '1U_QB29Xeg8fAF_aLLB9nFqKG5LTJsBSu')
-
-# Verificamos que el archivo de credenciales exista
-if not os.path.exists(GOOGLE_CREDENTIALS_FILE):
-    logging.error(f"No se encontró el archivo de credenciales en {GOOGLE_CREDENTIALS_FILE}")
-    logging.error("Por favor, verifica la ubicación del archivo o crea un archivo .env con la ruta correcta")
-    raise FileNotFoundError(f"No se encontró el archivo de credenciales: {GOOGLE_CREDENTIALS_FILE}")
-
-# ================================
-# Configuración de Google APIs
-# ================================
-# Define el alcance de los permisos necesarios para Sheets y Drive
-scope = ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-
-try:
-    # Carga y autoriza las credenciales desde el archivo definido
-    logging.info(f"Intentando cargar credenciales desde: {GOOGLE_CREDENTIALS_FILE}")
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS_FILE, scope)
-    client = gspread.authorize(creds)
-    logging.info(f"Autenticación con Google API exitosa usando {GOOGLE_CREDENTIALS_FILE}")
-except Exception as e:
-    logging.error(f"Error al autenticar con Google API: {e}")
-    raise
-
-# Inicializar el servicio de Google Drive
-try:
-    drive_service = build('drive', 'v3', credentials=creds)
-    logging.info("Servicio de Google Drive inicializado.")
-except Exception as e:
-    logging.error(f"Error al inicializar Google Drive: {e}")
-    raise
-
-try:
-    # Abre el documento de Google Sheets por URL
-    logging.info(f"Intentando abrir hoja de cálculo: {SPREADSHEET_URL}")
-    spreadsheet = client.open_by_url(SPREADSHEET_URL)
-    
-    # Intenta acceder primero a "Gastos" y si no existe, busca otras hojas
-    try:
-        gastos_sheet = spreadsheet.worksheet("Gastos")
-        logging.info("Hoja 'Gastos' encontrada")
-    except:
-        # Si no encuentra "Gastos", intenta con el nombre de la primera hoja
-        worksheet_list = spreadsheet.worksheets()
-        if worksheet_list:
-            gastos_sheet = worksheet_list[0]
-            logging.warning(f"No se encontró hoja 'Gastos'. Usando la primera hoja: {gastos_sheet.title}")
-        else:
-            # Si no hay hojas, crear una llamada "Gastos"
-            gastos_sheet = spreadsheet.add_worksheet(title="Gastos", rows=1000, cols=10)
-            logging.info("Creada nueva hoja 'Gastos'")
-    
-    logging.info(f"Acceso a Google Sheets exitoso: {spreadsheet.title}")
-except Exception as e:
-    logging.error(f"Error al acceder a las hojas de Google Sheets: {e}")
-    raise
+# Número de hilos para descargar y extraer tickets en paralelo (1 = secuencial)
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '1'))
+# Tickets por petición a OpenAI (1 = una imagen por petición). Se agrupan las imágenes que los
+# hilos tienen listas a la vez, así que el grupo no pasa del número de hilos; una imagen espera
+# como mucho MULTI_RECEIPT_WAIT segundos a que se llene el grupo
+MULTI_RECEIPT_SIZE = max(1, int(os.getenv('MULTI_RECEIPT_SIZE', '1')))
+MULTI_RECEIPT_WAIT = float(os.getenv('MULTI_RECEIPT_WAIT', '2'))
+# Copias por petición batch de Drive (el API admite hasta 100) y reintentos de las que fallen
+DRIVE_BATCH_SIZE = min(100, max(1, int(os.getenv('DRIVE_BATCH_SIZE', '100'))))
+DRIVE_COPY_RETRIES = int(os.getenv('DRIVE_COPY_RETRIES', '3'))
+# Filas por lote y segundos máximos de espera antes de escribir en Google Sheets
+SHEETS_BATCH_SIZE = int(os.getenv('SHEETS_BATCH_SIZE', '50'))
+SHEETS_FLUSH_SECONDS = float(os.getenv('SHEETS_FLUSH_SECONDS', '30'))
+# Preprocesado de imágenes: lado mayor máximo (0 = sin reescalar), calidad JPEG y escala de grises
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '1600'))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '80'))
+IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', '1') == '1'
+# Procesos para el preprocesado (0 = en el propio hilo, sin pool de procesos)
+IMAGE_PREPROCESS_WORKERS = int(os.getenv('IMAGE_PREPROCESS_WORKERS', str(os.cpu_count() or 1)))
+# Tickets casi duplicados (mismo ticket escaneado o fotografiado otra vez): 'flag' los procesa
+# dejándolos anotados, 'skip' omite los que además tienen la misma fecha e importe que el ticket
+# al que se parecen (la imagen sola no basta: dos tickets del mismo negocio tienen casi el mismo
+# dHash) y 'off' desactiva la detección
+DUPLICATE_MODE = os.getenv('DUPLICATE_MODE', 'flag').lower()
+# Distancia de Hamming máxima entre hashes perceptuales (de 64 bits) para considerarlos el mismo ticket
+PHASH_THRESHOLD = int(os.getenv('PHASH_THRESHOLD', '6'))
 
 # Ruta al archivo CSV local para guardar los datos
 CSV_FILE_PATH = os.path.join(SCRIPT_DIR, "registro_gastos.csv")
 logging.info(f"Archivo CSV local: {CSV_FILE_PATH}")
 
+# Almacenamiento local de los gastos: 'csv' (registro_gastos.csv) o 'parquet' (almacén por meses)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'csv').lower()
+EXPENSE_STORE_DIR = os.getenv('EXPENSE_STORE_DIR', os.path.join(SCRIPT_DIR, "gastos"))
+# Con el almacén en Parquet: regenerar el CSV al final de cada ejecución (para dashboard.html)
+STORAGE_CSV_EXPORT = os.getenv('STORAGE_CSV_EXPORT', '1') == '1'
+# Archivos por mes a partir de los cuales se compacta la partición al final de la ejecución
+STORAGE_COMPACT_PARTS = int(os.getenv('STORAGE_COMPACT_PARTS', '8'))
+expense_store = ExpenseStore(EXPENSE_STORE_DIR) if STORAGE_BACKEND == 'parquet' else None
+
+# Carpeta para el estado local (índices, cachés...)
+STATE_DIR = os.getenv('STATE_DIR', os.path.join(SCRIPT_DIR, ".asistente"))
+PROCESSED_INDEX_PATH = os.path.join(STATE_DIR, "procesados.sqlite")
+processed_index = ProcessedIndex(PROCESSED_INDEX_PATH)
+
+# Caché de extracciones por hash del contenido de la imagen. La huella incluye todos los prompts
+# de extracción (completo, corto y múltiples): cambiar cualquiera invalida la caché
+EXTRACTION_CACHE_PATH = os.path.join(STATE_DIR, "extracciones.sqlite")
+extraction_cache = ExtractionCache(
+    EXTRACTION_CACHE_PATH,
+    fingerprint=extraction_fingerprint(OPENAI_MODEL, EXTRACTION_PROMPT, SHORT_EXTRACTION_PROMPT,
+                                       MULTI_EXTRACTION_PROMPT, SHORT_MULTI_EXTRACTION_PROMPT,
+                                       IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_GRAYSCALE),
+    max_entries=int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', '5000')),
+    max_age_days=int(os.getenv('EXTRACTION_CACHE_MAX_AGE_DAYS', '180'))
+)
+
+# Agregados del dashboard, actualizados con cada gasto guardado
+AGGREGATES_PATH = os.path.join(STATE_DIR, "agregados.json")
+aggregates = ExpenseAggregates(AGGREGATES_PATH)
+# Instantánea con los datos ya agregados que carga dashboard.html
+DASHBOARD_SNAPSHOT_PATH = os.getenv('DASHBOARD_SNAPSHOT_PATH', os.path.join(SCRIPT_DIR, SNAPSHOT_FILE))
+
+# Hashes perceptuales de los tickets procesados y registro de los casi duplicados encontrados
+PERCEPTUAL_INDEX_PATH = os.path.join(STATE_DIR, "hashes_perceptuales.sqlite")
+perceptual_index = PerceptualIndex(PERCEPTUAL_INDEX_PATH)
+NEAR_DUPLICATES_LOG_PATH = os.path.join(STATE_DIR, "posibles_duplicados.jsonl")
+_near_duplicates_lock = threading.Lock()
+
+# Tabla negocio -> categoría aprendida del histórico. 'auto' usa el prompt corto cuando los
+# negocios conocidos suman al menos MERCHANT_MEMO_MIN_COVERAGE de los gastos, 'on' siempre y 'off' nunca
+MERCHANT_MEMO = os.getenv('MERCHANT_MEMO', 'auto').lower()
+MERCHANT_MEMO_MIN_COVERAGE = float(os.getenv('MERCHANT_MEMO_MIN_COVERAGE', '0.6'))
+MERCHANT_MEMO_PATH = os.path.join(STATE_DIR, "negocios_categorias.json")
+merchant_memo = MerchantCategoryMemo(MERCHANT_MEMO_PATH)
+# Extracción local (OCR con tesseract, opcional) antes de OpenAI: solo se acepta si su confianza
+# (0-1) llega a LOCAL_CONFIDENCE_THRESHOLD; si no, el ticket se envía al modelo
+LOCAL_EXTRACTION = os.getenv('LOCAL_EXTRACTION', '1') == '1'
+LOCAL_CONFIDENCE_THRESHOLD = float(os.getenv('LOCAL_CONFIDENCE_THRESHOLD', '0.85'))
+# Campos que el OCR debe encontrar siempre, con cualquier umbral (descripcion sale del negocio)
+LOCAL_REQUIRED_FIELDS = ['fecha', 'importe', 'negocio']
+TESSERACT_LANG = os.getenv('TESSERACT_LANG', 'spa')
+local_extractor = LocalOCRExtractor(TESSERACT_LANG, lookup=merchant_memo.lookup)
+# Se decide una vez por ejecución en load_merchant_memo()
+use_short_prompt = False
+# Valor de datos['categoria_origen'] cuando la categoría sale de la tabla de negocios
+CATEGORY_FROM_MEMO = 'tabla'
+# Llamadas a la API de la ejecución por tipo ('completo', 'corto', 'clasificacion') y aciertos de la tabla
+api_usage = {}
+merchant_memo_stats = {'hits': 0, 'misses': 0}
+_api_usage_lock = threading.Lock()
+
+# Diario de etapas de cada ticket para reanudar tras una interrupción. Tras un fallo se espera
+# JOB_RETRY_BASE_SECONDS (el doble en cada fallo, hasta JOB_RETRY_MAX_SECONDS) y tras
+# JOB_MAX_ATTEMPTS fallos el ticket pasa a descartados
+JOB_JOURNAL_PATH = os.path.join(STATE_DIR, "trabajos.sqlite")
+job_journal = JobJournal(
+    JOB_JOURNAL_PATH,
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '5')),
+    retry_base_seconds=float(os.getenv('JOB_RETRY_BASE_SECONDS', '60')),
+    retry_max_seconds=float(os.getenv('JOB_RETRY_MAX_SECONDS', str(6 * 3600)))
+)
+
+# Marca de agua de la sincronización incremental con Drive
+SYNC_STATE_PATH = os.path.join(STATE_DIR, "sincronizacion.json")
+
+# Métricas por etapa (latencia, errores, reintentos, bytes), en formato de texto de Prometheus.
+# Se escriben en METRICS_FILE al final de cada ejecución (vacío para no escribirlas)
+METRICS_FILE = os.getenv('METRICS_FILE', os.path.join(STATE_DIR, "metricas.prom"))
+metrics = PipelineMetrics()
+
+# Informe JSON de cada ejecución (tiempos y tokens por archivo, percentiles), en RUN_REPORTS_DIR
+# (vacío para no escribirlo). Se comparan con: python informe_ejecucion.py comparar --ultimos
+RUN_REPORTS_DIR = os.getenv('RUN_REPORTS_DIR', os.path.join(STATE_DIR, "informes"))
+run_report = RunReport()
+metrics.add_listener(run_report.observe)
+
+# Cliente HTTP compartido para OpenAI (pool de conexiones, reintentos y límites de uso)
+openai_client = OpenAIClient(
+    OPENAI_API_KEY,
+    base_url=OPENAI_BASE_URL,
+    timeout=(10, OPENAI_TIMEOUT),
+    pool_size=max(10, MAX_WORKERS),
+    requests_per_minute=OPENAI_RPM,
+    tokens_per_minute=OPENAI_TPM,
+    metrics=metrics
+)
+
+# ================================
+# Clientes de Google (se conectan la primera vez que se usan)
+# ================================
+def get_drive_service():
+    """
+    Devuelve el servicio de Google Drive asociado al hilo actual.
+    
+    :return: Servicio de Drive listo para usar desde este hilo.
+    """
+    return get_google_clients(STATE_DIR).drive_service
+
+def get_gastos_sheet():
+    """
+    Devuelve la hoja de gastos de Google Sheets.
+    """
+    return get_google_clients(STATE_DIR).gastos_sheet
+
 # ================================
 # Función para descargar un archivo de Drive
 # ================================
+@metrics.instrument('descarga', failed=lambda file_bytes: file_bytes is None)
 def download_file(file_id):
     """
     Descarga un archivo de Google Drive y devuelve un objeto BytesIO.
@@ -121,14 +280,17 @@ def download_file(file_id):
     :param file_id: ID del archivo en Drive.
     :return: BytesIO con el contenido del archivo o None en caso de error.
     """
+    from googleapiclient.http import MediaIoBaseDownload
+    
     try:
-        request = drive_service.files().get_media(fileId=file_id)
+        request = get_drive_service().files().get_media(fileId=file_id)
         file_bytes = io.BytesIO()
         downloader = MediaIoBaseDownload(file_bytes, request)
         done = False
         while not done:
             status, done = downloader.next_chunk()
         file_bytes.seek(0)
+        metrics.add_bytes('descarga', 'recibidos', file_bytes.getbuffer().nbytes)
         logging.info(f"Archivo descargado correctamente (ID: {file_id}).")
         return file_bytes
     except Exception as e:
@@ -145,7 +307,7 @@ def verify_sheet_structure():
     """
     try:
         # Obtener el encabezado actual
-        header_row = gastos_sheet.row_values(1)
+        header_row = get_gastos_sheet().row_values(1)
         
         # Encabezado esperado
         expected_header = [
@@ -157,7 +319,7 @@ def verify_sheet_structure():
         if not header_row:
             # Si no hay encabezado, lo creamos
             logging.info("Creando encabezado en la hoja de gastos.")
-            gastos_sheet.append_row(expected_header)
+            get_gastos_sheet().append_row(expected_header)
             logging.info("Encabezado creado correctamente.")
             return True
             
@@ -165,7 +327,7 @@ def verify_sheet_structure():
         if len(header_row) < len(expected_header):
             # Actualizamos el encabezado
             logging.warning("El encabezado existente no tiene todas las columnas necesarias. Actualizando...")
-            gastos_sheet.update("A1:G1", [expected_header])
+            get_gastos_sheet().update("A1:G1", [expected_header])
             logging.info("Encabezado actualizado correctamente.")
             return True
             
@@ -178,10 +340,11 @@ def verify_sheet_structure():
             logging.warning(f"Actual: {[header_row[i] for i in differences]}")
             logging.warning(f"Esperado: {[expected_header[i] for i in differences]}")
             
-            # Actualizamos solo las celdas necesarias
-            for i in differences:
-                col_letter = chr(65 + i)  # A, B, C, etc.
-                gastos_sheet.update(f"{col_letter}1", expected_header[i])
+            # Actualizamos solo las celdas necesarias, todas en una sola llamada
+            get_gastos_sheet().batch_update([
+                {'range': f"{chr(65 + i)}1", 'values': [[expected_header[i]]]}  # A, B, C, etc.
+                for i in differences
+            ])
                 
             logging.info("Encabezado corregido.")
             return True
@@ -196,35 +359,50 @@ def verify_sheet_structure():
 # ================================
 # Función para obtener archivos por fecha de creación/modificación
 # ================================
-def get_files_by_creation_date(folder_id, days_threshold=7):
+def get_files_by_creation_date(folder_id, days_threshold=7, since=None):
     """
     Obtiene archivos de una carpeta de Google Drive que fueron creados/modificados 
-    en los últimos días_threshold días.
+    en los últimos días_threshold días, o desde la marca de tiempo since si se indica.
+    Recorre todas las páginas de resultados.
     
     :param folder_id: ID de la carpeta en Google Drive
     :param days_threshold: Número de días hacia atrás para considerar
+    :param since: Marca de tiempo RFC 3339 desde la que buscar (sustituye a days_threshold)
     :return: Lista de archivos (con id y nombre)
     """
     try:
         # Calculamos la fecha límite
-        date_threshold = (datetime.now() - timedelta(days=days_threshold)).strftime('%Y-%m-%dT%H:%M:%S')
+        if since:
+            date_threshold = since
+            window = f"desde {since}"
+        else:
+            date_threshold = (datetime.now() - timedelta(days=days_threshold)).strftime('%Y-%m-%dT%H:%M:%S')
+            window = f"últimos {days_threshold} días"
         
         # Consultamos archivos de imagen en la carpeta especificada, creados después de la fecha límite
-        query = f"'{folder_id}' in parents and mimeType contains 'image/' and (createdTime > '{date_threshold}' or modifiedTime > '{date_threshold}')"
-        
-        results = drive_service.files().list(
-            q=query,
-            fields="files(id, name, createdTime, modifiedTime)",
-            orderBy="createdTime desc"
-        ).execute()
+        # (>= para no perder archivos con la misma marca de tiempo; los repetidos los filtra el índice)
+        query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed = false and (createdTime >= '{date_threshold}' or modifiedTime >= '{date_threshold}')"
         
-        files = results.get('files', [])
+        files = []
+        page_token = None
+        while True:
+            results = get_drive_service().files().list(
+                q=query,
+                fields="nextPageToken, files(id, name, createdTime, modifiedTime)",
+                orderBy="createdTime desc",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
         
         if not files:
-            logging.info(f"No se encontraron archivos nuevos (últimos {days_threshold} días) en la carpeta.")
+            logging.info(f"No se encontraron archivos nuevos ({window}) en la carpeta.")
             return []
             
-        logging.info(f"Se encontraron {len(files)} archivos nuevos (últimos {days_threshold} días).")
+        logging.info(f"Se encontraron {len(files)} archivos nuevos ({window}).")
         
         # Mostramos información detallada de los archivos encontrados
         for file in files:
@@ -238,110 +416,299 @@ def get_files_by_creation_date(folder_id, days_threshold=7):
         logging.error(f"Error al listar archivos por fecha: {e}")
         return []
 
+# ================================
+# Sincronización incremental con Drive
+# ================================
+def file_timestamp(file):
+    """
+    Marca de tiempo más reciente (creación o modificación) de un archivo de Drive.
+    Las cadenas RFC 3339 de Drive se pueden comparar directamente.
+    """
+    return max(file.get('createdTime', ''), file.get('modifiedTime', ''))
+
+def load_sync_state():
+    """
+    Lee el estado de la sincronización incremental (marca de agua por carpeta).
+    
+    :return: Diccionario {folder_id: marca de tiempo}
+    """
+    try:
+        with open(SYNC_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"No se pudo leer el estado de sincronización: {e}")
+        return {}
+
+def save_sync_state(state):
+    """
+    Guarda el estado de la sincronización de forma atómica (archivo temporal + rename).
+    """
+    os.makedirs(os.path.dirname(SYNC_STATE_PATH), exist_ok=True)
+    tmp_path = SYNC_STATE_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, SYNC_STATE_PATH)
+
+def get_new_files(folder_id, days_threshold=7, incremental=False):
+    """
+    Obtiene los archivos a procesar. En modo incremental solo pide a Drive los archivos
+    creados o modificados desde la marca de agua guardada en la ejecución anterior; si no
+    hay marca todavía, usa la ventana de days_threshold días.
+    
+    :param folder_id: ID de la carpeta en Google Drive
+    :param days_threshold: Número de días hacia atrás para la primera ejecución
+    :param incremental: Usar la marca de agua guardada
+    :return: Lista de archivos (con id y nombre)
+    """
+    since = load_sync_state().get(folder_id) if incremental else None
+    return get_files_by_creation_date(folder_id, days_threshold, since=since)
+
+def advance_sync_state(folder_id, files, failed_files):
+    """
+    Avanza la marca de agua de la carpeta tras una ejecución. Si algún archivo falló,
+    la marca no pasa de él para que se vuelva a intentar en la siguiente ejecución.
+    
+    :param folder_id: ID de la carpeta en Google Drive
+    :param files: Archivos listados en esta ejecución
+    :param failed_files: Archivos que no se pudieron procesar por un error
+    """
+    if not files:
+        return
+    if failed_files:
+        high_water_mark = min(file_timestamp(f) for f in failed_files)
+    else:
+        high_water_mark = max(file_timestamp(f) for f in files)
+    
+    state = load_sync_state()
+    if high_water_mark and high_water_mark > state.get(folder_id, ''):
+        state[folder_id] = high_water_mark
+        save_sync_state(state)
+        logging.info(f"Marca de sincronización actualizada: {high_water_mark}")
+
+# ================================
+# Preprocesado de imágenes en un pool de procesos
+# ================================
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+def get_image_pool():
+    """
+    Devuelve el pool de procesos compartido para el preprocesado de imágenes (o None si
+    está desactivado). Se crea la primera vez que se necesita.
+    """
+    global _image_pool
+    if IMAGE_PREPROCESS_WORKERS <= 0:
+        return None
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+        return _image_pool
+
+def shutdown_image_pool():
+    """
+    Cierra el pool de procesos de preprocesado si se llegó a crear.
+    """
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is not None:
+            _image_pool.shutdown()
+            _image_pool = None
+
+def prepare_image(image_data):
+    """
+    Preprocesa una imagen para enviarla a OpenAI. El trabajo de CPU se ejecuta en el pool
+    de procesos, así que los hilos trabajadores pueden seguir descargando mientras tanto.
+    
+    :param image_data: Bytes de la imagen descargada
+    :return: Tupla (bytes, tipo MIME) de la imagen a enviar
+    """
+    pool = get_image_pool()
+    if pool is None:
+        return preprocess_image(image_data, IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_GRAYSCALE)
+    return pool.submit(preprocess_image, image_data, IMAGE_MAX_SIDE, IMAGE_QUALITY, IMAGE_GRAYSCALE).result()
+
 # ================================
 # Función para procesar imagen usando OpenAI API
 # ================================
-def process_ticket_image_with_openai(file_bytes):
+@metrics.instrument('extraccion', failed=lambda datos: datos is None)
+def process_ticket_image_with_openai(file_bytes, stats=None, check_cache=True):
     """
     Procesa una imagen usando la API de OpenAI para extraer datos estructurados.
+    Si la misma imagen (mismos bytes) ya se extrajo con el modelo y prompt actuales,
+    devuelve el resultado guardado en la caché sin llamar a la API. Si no, la imagen se
+    preprocesa (orientación, escala de grises, tamaño) antes de enviarla.
+    Con la tabla de negocios activa se usa el prompt corto (sin categorías) y la categoría
+    se asigna después con classify_expense. Con MULTI_RECEIPT_SIZE > 1 la imagen se extrae junto
+    con las de otros hilos en una sola petición (ver receipt_batcher).
     
     :param file_bytes: Objeto BytesIO con los datos de la imagen.
+    :param stats: Diccionario opcional que se rellena con información de la extracción
+                  (cache_hit, original_bytes, sent_bytes)
+    :param check_cache: Consultar la caché antes de llamar a la API (la cadena de extractores ya lo hace)
     :return: Diccionario con datos estructurados (fecha, descripción, importe, negocio, categoría)
     """
+    if stats is None:
+        stats = {}
+    stats['cache_hit'] = False
+    
+    image_data = file_bytes.read()
+    file_bytes.seek(0)  # Reiniciar el puntero para futuros usos
+    image_hash = content_hash(image_data)
+    
+    cached = get_cached_extraction(image_hash) if check_cache else None
+    if cached is not None:
+        stats['cache_hit'] = True
+        return cached
+    
     try:
-        # Codificar la imagen en base64
-        encoded_image = base64.b64encode(file_bytes.read()).decode('utf-8')
-        file_bytes.seek(0)  # Reiniciar el puntero para futuros usos
-        
-        # Configurar la solicitud a la API de OpenAI
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
-        }
+        send_data, mime_type = prepare_image(image_data)
+    except Exception as e:
+        logging.warning(f"Error al preprocesar la imagen, se envía la original: {e}")
+        send_data, mime_type = image_data, 'image/jpeg'
+    stats['original_bytes'] = len(image_data)
+    stats['sent_bytes'] = len(send_data)
+    metrics.add_bytes('extraccion', 'enviados', len(send_data))
+    run_report.add(bytes_originales=len(image_data), bytes_enviados=len(send_data))
+    logging.info(f"Imagen preprocesada: {len(image_data)} -> {len(send_data)} bytes "
+                 f"({len(image_data) - len(send_data)} bytes ahorrados, {mime_type}).")
+    
+    datos = _extract_in_group(send_data, mime_type) if receipt_batcher.max_receipts > 1 else None
+    if use_short_prompt:
+        if datos is None:
+            datos = _extract_with_openai(send_data, mime_type, SHORT_EXTRACTION_PROMPT, SHORT_EXTRACTION_FIELDS, 'corto')
+        # Sin categoría no se guarda en la caché, para volver a intentarlo la próxima vez
+        classified = datos is not None and classify_expense(datos)
+    else:
+        if datos is None:
+            datos = _extract_with_openai(send_data, mime_type)
+        classified = datos is not None
+    if classified:
+        try:
+            extraction_cache.put(image_hash, datos)
+        except Exception as e:
+            logging.warning(f"Error al guardar en la caché de extracciones: {e}")
+    return datos
+
+def get_cached_extraction(image_hash):
+    """
+    Busca en la caché la extracción de una imagen por el hash de su contenido.
+    
+    :return: Diccionario con los datos o None si no está (o la caché falla)
+    """
+    try:
+        cached = extraction_cache.get(image_hash)
+    except Exception as e:
+        logging.warning(f"Error al consultar la caché de extracciones: {e}")
+        return None
+    if cached is not None:
+        logging.info(f"Datos del recibo obtenidos de la caché (hash {image_hash[:12]}).")
+    return cached
+
+def build_extraction_payload(image_data, mime_type='image/jpeg', prompt=EXTRACTION_PROMPT):
+    """
+    Construye el cuerpo de la petición de chat para extraer los datos de un ticket.
+    Se usa tanto en las llamadas síncronas como en los lotes de la Batch API.
+    
+    :param image_data: Bytes de la imagen
+    :param mime_type: Tipo MIME de la imagen
+    :param prompt: Prompt de extracción (EXTRACTION_PROMPT o SHORT_EXTRACTION_PROMPT)
+    :return: Diccionario con el payload para /chat/completions
+    """
+    # Codificar la imagen en base64
+    encoded_image = base64.b64encode(image_data).decode('utf-8')
+    
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{encoded_image}"
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 500
+    }
+
+def parse_extraction_response(resultado, required_fields=EXTRACTION_FIELDS):
+    """
+    Interpreta la respuesta de /chat/completions y devuelve los datos del ticket.
+    
+    :param resultado: Cuerpo JSON de la respuesta (ya decodificado)
+    :param required_fields: Campos que debe tener la respuesta (los que falten se rellenan)
+    :return: Diccionario con los datos extraídos o None si no se puede interpretar
+    """
+    datos_extraidos = resultado['choices'][0]['message']['content']
+    
+    logging.info("Datos extraídos del recibo con OpenAI:")
+    logging.info(datos_extraidos)
+    
+    # Limpiar la respuesta JSON si contiene marcadores de código
+    datos_limpios = datos_extraidos.strip()
+    if datos_limpios.startswith("```json"):
+        datos_limpios = datos_limpios[7:]  # Eliminar ```json del inicio
+    if datos_limpios.endswith("```"):
+        datos_limpios = datos_limpios[:-3]  # Eliminar ``` del final
+    datos_limpios = datos_limpios.strip()
+    
+    try:
+        # Intentar parsear el JSON
+        datos_json = json.loads(datos_limpios)
         
-        # Modificar el prompt para solicitar la extracción de datos específicos
-        prompt = """
-        Analiza esta imagen de un recibo o factura y extrae la siguiente información en formato JSON:
-        1. fecha: la fecha de la transacción (formato YYYY-MM-DD)
-        2. descripcion: breve descripción de la compra o servicio
-        3. importe: cantidad total pagada (número decimal)
-        4. negocio: nombre del negocio o entidad que emitió el recibo
-        5. categoria: asigna una de estas categorías al gasto:
-           - Suscripciones
-           - Salud
-           - Vivienda
-           - Movilidad
-           - Educación
-           - Alimentos
-           - Salidas
-           - Gastos extraordinarios
-
-        Responde ÚNICAMENTE con el objeto JSON puro, sin marcadores de código (```), comillas ni texto adicional.
-        """
+        # Asegurarse que todos los campos estén presentes
+        for field in required_fields:
+            if field not in datos_json:
+                logging.warning(f"Campo '{field}' no encontrado en la respuesta de OpenAI. Añadiendo valor por defecto.")
+                if field == 'fecha':
+                    datos_json[field] = datetime.now().strftime('%Y-%m-%d')
+                elif field == 'importe':
+                    datos_json[field] = 0.0
+                else:
+                    datos_json[field] = "No especificado"
         
-        payload = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encoded_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 500
-        }
+        return datos_json
+    
+    except json.JSONDecodeError as e:
+        logging.error(f"Error al parsear JSON: {e}. Contenido: {datos_limpios}")
+        return None
+
+def _extract_with_openai(image_data, mime_type='image/jpeg', prompt=EXTRACTION_PROMPT,
+                         required_fields=EXTRACTION_FIELDS, usage_path='completo'):
+    """
+    Llama a la API de OpenAI con la imagen y devuelve los datos extraídos.
+    
+    :param image_data: Bytes de la imagen
+    :param mime_type: Tipo MIME de la imagen
+    :param prompt: Prompt de extracción
+    :param required_fields: Campos que debe devolver el modelo
+    :param usage_path: Tipo de llamada con el que se anota el consumo (ver record_api_call)
+    :return: Diccionario con los datos extraídos o None en caso de error
+    """
+    try:
+        # Configurar la solicitud a la API de OpenAI
+        payload = build_extraction_payload(image_data, mime_type, prompt)
         
-        # Realizar la solicitud a la API
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+        # Realizar la solicitud a la API (con límites de uso, timeouts y reintentos)
+        start = time.perf_counter()
+        response = openai_client.post_json("/chat/completions", payload)
         
         # Procesar y mostrar la respuesta
         if response.status_code == 200:
             resultado = response.json()
-            datos_extraidos = resultado['choices'][0]['message']['content']
-            
-            logging.info("Datos extraídos del recibo con OpenAI:")
-            logging.info(datos_extraidos)
-            
-            # Limpiar la respuesta JSON si contiene marcadores de código
-            datos_limpios = datos_extraidos.strip()
-            if datos_limpios.startswith("```json"):
-                datos_limpios = datos_limpios[7:]  # Eliminar ```json del inicio
-            if datos_limpios.endswith("```"):
-                datos_limpios = datos_limpios[:-3]  # Eliminar ``` del final
-            datos_limpios = datos_limpios.strip()
-            
-            try:
-                # Intentar parsear el JSON
-                datos_json = json.loads(datos_limpios)
-                
-                # Asegurarse que todos los campos estén presentes
-                required_fields = ['fecha', 'descripcion', 'importe', 'negocio', 'categoria']
-                for field in required_fields:
-                    if field not in datos_json:
-                        logging.warning(f"Campo '{field}' no encontrado en la respuesta de OpenAI. Añadiendo valor por defecto.")
-                        if field == 'fecha':
-                            datos_json[field] = datetime.now().strftime('%Y-%m-%d')
-                        elif field == 'importe':
-                            datos_json[field] = 0.0
-                        else:
-                            datos_json[field] = "No especificado"
-                
-                return datos_json
-            
-            except json.JSONDecodeError as e:
-                logging.error(f"Error al parsear JSON: {e}. Contenido: {datos_limpios}")
-                return None
-            
+            datos = parse_extraction_response(resultado, required_fields)
+            record_api_call(usage_path, time.perf_counter() - start, resultado.get('usage'), failed=datos is None)
+            return datos
         else:
             logging.error(f"Error en la API de OpenAI: {response.status_code}")
             logging.error(response.text)
@@ -351,24 +718,339 @@ def process_ticket_image_with_openai(file_bytes):
         logging.error(f"Error al procesar la imagen con OpenAI: {e}")
         return None
 
+# ================================
+# Extracción de varios tickets por petición
+# ================================
+def _send_receipt_group(images):
+    """
+    Extrae un grupo de imágenes en una sola petición (la función send de receipt_batcher).
+    
+    :param images: Lista de (bytes de la imagen, tipo MIME)
+    :return: Tupla (datos o None por imagen, segundos de la petición, usage)
+    """
+    if use_short_prompt:
+        prompt, fields = SHORT_MULTI_EXTRACTION_PROMPT, SHORT_EXTRACTION_FIELDS
+    else:
+        prompt, fields = MULTI_EXTRACTION_PROMPT, EXTRACTION_FIELDS
+    payload = build_multi_payload(images, prompt, fields, OPENAI_MODEL, CATEGORIES)
+    start = time.perf_counter()
+    response = openai_client.post_json("/chat/completions", payload)
+    seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        logging.error(f"Error en la API de OpenAI (extracción de {len(images)} tickets): {response.status_code}")
+        logging.error(response.text)
+        return [None] * len(images), seconds, None
+    resultado = response.json()
+    results = parse_multi_response(resultado, len(images), fields)
+    logging.info(f"Extracción de {len(images)} tickets en una petición: "
+                 f"{sum(1 for datos in results if datos is not None)} emparejados.")
+    return results, seconds, resultado.get('usage')
+
+receipt_batcher = ReceiptBatcher(_send_receipt_group, MULTI_RECEIPT_SIZE, MULTI_RECEIPT_WAIT)
+
+def _extract_in_group(image_data, mime_type):
+    """
+    Extrae un ticket dentro de un grupo de receipt_batcher y anota su parte de la petición.
+    
+    :return: Diccionario con los datos o None si la respuesta no trae este ticket (el llamante
+             lo extrae entonces por separado)
+    """
+    datos, share = receipt_batcher.submit(image_data, mime_type)
+    record_api_call('multiple', share['segundos'], share['usage'], failed=datos is None,
+                    requests=share['peticiones'])
+    if datos is None:
+        logging.warning("Ticket sin emparejar en la extracción múltiple: se extrae por separado.")
+    return datos
+
+def report_multi_receipt_usage():
+    """
+    Compara la extracción múltiple de la ejecución con la de una imagen por petición: tokens y
+    segundos de API por ticket y proporción de tickets cuya respuesta no se pudo usar. La
+    referencia es el consumo medio del camino de una imagen medido en ejecuciones anteriores.
+    """
+    group = receipt_batcher.stats()
+    if not group['tickets']:
+        return
+    with _api_usage_lock:
+        multi = dict(api_usage.get('multiple', {}))
+    logging.info(f"Extracción múltiple: {group['tickets']} tickets en {group['peticiones']} peticiones "
+                 f"({group['tickets'] / group['peticiones']:.1f} por petición), "
+                 f"{multi.get('tokens', 0) / group['tickets']:.0f} tokens y "
+                 f"{group['segundos'] / group['tickets']:.2f}s de API por ticket, "
+                 f"{group['sin_emparejar']} sin emparejar ({group['sin_emparejar'] / group['tickets']:.0%}).")
+    reference = merchant_memo.average_usage('corto' if use_short_prompt else 'completo')
+    if reference is None:
+        logging.info("Todavía no hay consumo medido de la extracción de una imagen por petición para comparar.")
+        return
+    logging.info(f"Una imagen por petición: {reference['tokens']:.0f} tokens y {reference['segundos']:.2f}s "
+                 f"por ticket, {reference['fallos']:.0%} de respuestas sin interpretar.")
+
+# ================================
+# Clasificación con la tabla de negocios conocidos
+# ================================
+def record_api_call(path, seconds, usage, failed=False, requests=1):
+    """
+    Anota la duración y los tokens de una llamada a la API en los contadores de la ejecución,
+    en el consumo medio que guarda la tabla de negocios y en el informe del archivo en curso.
+    
+    :param path: Tipo de llamada ('completo', 'corto', 'multiple', 'lote' o 'clasificacion')
+    :param seconds: Duración de la llamada (o la parte que corresponde al ticket)
+    :param usage: Campo usage de la respuesta (puede ser None)
+    :param failed: La respuesta no se pudo interpretar
+    :param requests: Fracción de petición que corresponde al ticket (1 salvo en la extracción múltiple)
+    """
+    usage = usage or {}
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', 0)
+    with _api_usage_lock:
+        entry = api_usage.setdefault(path, {'llamadas': 0, 'segundos': 0.0, 'tokens': 0})
+        entry['llamadas'] += 1
+        entry['segundos'] += seconds
+        entry['tokens'] += prompt_tokens + completion_tokens
+    merchant_memo.record_usage(path, seconds, prompt_tokens, completion_tokens, failed)
+    run_report.add(llamadas_api=requests, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                   segundos_api=round(seconds, 4), fallos_interpretacion=1 if failed else 0)
+
+def classify_with_openai(negocio, descripcion):
+    """
+    Pide la categoría de un gasto al modelo solo con el texto (negocio y descripción), sin imagen.
+    
+    :return: Categoría o None si la respuesta no es una de CATEGORIES
+    """
+    payload = {
+        "model": OPENAI_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": CLASSIFICATION_PROMPT.format(categorias=", ".join(CATEGORIES),
+                                                    negocio=negocio, descripcion=descripcion)
+        }],
+        "max_tokens": 20
+    }
+    try:
+        start = time.perf_counter()
+        response = openai_client.post_json("/chat/completions", payload)
+        if response.status_code != 200:
+            logging.error(f"Error en la API de OpenAI al clasificar el gasto: {response.status_code}")
+            return None
+        resultado = response.json()
+        record_api_call('clasificacion', time.perf_counter() - start, resultado.get('usage'))
+        categoria = resultado['choices'][0]['message']['content'].strip().strip('."\'')
+    except Exception as e:
+        logging.error(f"Error al clasificar el gasto con OpenAI: {e}")
+        return None
+    if categoria not in CATEGORIES:
+        logging.warning(f"Categoría no reconocida en la respuesta de OpenAI: {categoria}")
+        return None
+    return categoria
+
+def classify_expense(datos):
+    """
+    Asigna la categoría a unos datos extraídos con el prompt corto: desde la tabla de negocios
+    si el negocio es conocido y, si no, con una llamada de solo texto. Las que salen de la tabla
+    se marcan con 'categoria_origen' para no volver a añadirlas a ella (ver finish_saved_entries).
+    
+    :param datos: Diccionario de la extracción (se le añade 'categoria')
+    :return: True si se asignó una categoría válida
+    """
+    found = merchant_memo.lookup(datos.get('negocio'))
+    with _api_usage_lock:
+        merchant_memo_stats['hits' if found else 'misses'] += 1
+    if found:
+        categoria, known_name, score = found
+        logging.info(f"Categoría de '{datos.get('negocio')}' desde la tabla de negocios: {categoria} "
+                     f"(como '{known_name}', similitud {score}).")
+        datos['categoria'] = categoria
+        datos['categoria_origen'] = CATEGORY_FROM_MEMO
+        return True
+    
+    categoria = classify_with_openai(datos.get('negocio'), datos.get('descripcion'))
+    datos['categoria'] = categoria or "No especificado"
+    return categoria is not None
+
+def merchant_history_rows():
+    """
+    Recorre los pares (negocio, categoría) del histórico: la hoja de Google Sheets (que recoge
+    las correcciones manuales) y las filas locales que todavía no estén en ella.
+    """
+    sheet_files = set()
+    try:
+        # Solo las columnas necesarias: Negocio (B) y Categoría y Archivo (E:F)
+        merchants, categories = get_gastos_sheet().batch_get(['B2:B', 'E2:F'])
+        for merchant, category in zip_longest(merchants, categories, fillvalue=[]):
+            if category[1:]:
+                sheet_files.add(category[1])
+            yield (merchant[0] if merchant else None), (category[0] if category else None)
+    except Exception as e:
+        logging.warning(f"Error al leer el histórico de Google Sheets para la tabla de negocios: {e}")
+    
+    try:
+        if expense_store:
+            df = expense_store.read(columns=['negocio', 'categoria', 'archivo'])
+            local_rows = df[['negocio', 'categoria', 'archivo']].itertuples(index=False)
+        elif os.path.isfile(CSV_FILE_PATH):
+            with open(CSV_FILE_PATH, 'r', newline='', encoding='utf-8') as csv_file:
+                local_rows = [(row.get('Negocio'), row.get('Categoría'), row.get('Archivo'))
+                              for row in csv.DictReader(csv_file)]
+        else:
+            local_rows = []
+        for merchant, category, file_name in local_rows:
+            if file_name not in sheet_files:
+                yield merchant, category
+    except Exception as e:
+        logging.warning(f"Error al leer los gastos locales para la tabla de negocios: {e}")
+
+def load_merchant_memo(rebuild=False):
+    """
+    Carga la tabla de negocios (o la construye desde el histórico si no existe o se pide) y
+    decide si la ejecución usa el prompt corto.
+    
+    :param rebuild: Forzar la reconstrucción desde Google Sheets y los gastos locales
+    """
+    global use_short_prompt
+    try:
+        if rebuild or not merchant_memo.exists():
+            merchant_memo.rebuild(merchant_history_rows())
+        else:
+            merchant_memo.load()
+    except Exception as e:
+        logging.warning(f"Error al cargar la tabla de negocios: {e}")
+    
+    coverage = merchant_memo.coverage()
+    if MERCHANT_MEMO == 'on':
+        use_short_prompt = True
+    elif MERCHANT_MEMO == 'auto':
+        use_short_prompt = coverage >= MERCHANT_MEMO_MIN_COVERAGE
+    else:
+        use_short_prompt = False
+    logging.info(f"Tabla de negocios: {len(merchant_memo)} conocidos ({coverage:.0%} de los gastos). "
+                 f"Prompt {'corto con clasificación local' if use_short_prompt else 'completo'}.")
+
+def reset_api_usage():
+    """
+    Pone a cero los contadores de llamadas de la ejecución (cada lote del servicio de
+    vigilancia informa solo de las suyas).
+    """
+    with _api_usage_lock:
+        api_usage.clear()
+        merchant_memo_stats.update(hits=0, misses=0)
+
+def report_merchant_memo_savings():
+    """
+    Muestra las llamadas de la ejecución y el ahorro estimado de tokens y tiempo frente a haber
+    usado el prompt completo, con el consumo medio del prompt completo medido en ejecuciones
+    anteriores (o en esta).
+    """
+    with _api_usage_lock:
+        usage = {path: dict(entry) for path, entry in api_usage.items()}
+        hits, misses = merchant_memo_stats['hits'], merchant_memo_stats['misses']
+    for path, entry in sorted(usage.items()):
+        logging.info(f"Llamadas '{path}': {entry['llamadas']}, {entry['tokens']} tokens, "
+                     f"{entry['segundos']:.1f}s ({entry['segundos'] / entry['llamadas']:.2f}s de media).")
+    
+    short = usage.get('corto')
+    if not short:
+        return
+    logging.info(f"Tabla de negocios: {hits} categorías asignadas en local, {misses} clasificadas con OpenAI.")
+    reference = merchant_memo.average_usage('completo')
+    if reference is None:
+        logging.info("Todavía no hay consumo medido del prompt completo para estimar el ahorro.")
+        return
+    classification = usage.get('clasificacion', {'tokens': 0, 'segundos': 0.0})
+    tokens_saved = reference['tokens'] * short['llamadas'] - short['tokens'] - classification['tokens']
+    seconds_saved = reference['segundos'] * short['llamadas'] - short['segundos'] - classification['segundos']
+    logging.info(f"Ahorro estimado frente al prompt completo: {tokens_saved:.0f} tokens y "
+                 f"{seconds_saved:.1f}s de llamadas a la API.")
+
+# ================================
+# Cadena de extractores: caché, OCR local y OpenAI
+# ================================
+def _cache_step(image_data):
+    cached = get_cached_extraction(content_hash(image_data))
+    return cached, 1.0
+
+def _local_step(image_data):
+    """
+    Extracción local. Si la confianza basta pero el negocio no tiene categoría conocida,
+    se clasifica con classify_expense; si no se consigue, el ticket pasa a OpenAI. También
+    pasa a OpenAI si falta la fecha, el importe o el negocio, sea cual sea la confianza
+    (con un umbral bajo el OCR puede aceptar tickets incompletos).
+    """
+    datos, confidence = local_extractor.extract(image_data)
+    if not datos or confidence < LOCAL_CONFIDENCE_THRESHOLD:
+        return datos, confidence
+    missing = [field for field in LOCAL_REQUIRED_FIELDS if not datos.get(field)]
+    if missing:
+        logging.info(f"Extracción local incompleta (falta {', '.join(missing)}); se pasa a OpenAI.")
+        return None, 0.0
+    datos.pop('nif', None)
+    if 'categoria' in datos:
+        # parse_receipt_text la ha buscado en la tabla de negocios
+        datos['categoria_origen'] = CATEGORY_FROM_MEMO
+    elif not classify_expense(datos):
+        return None, 0.0
+    logging.info(f"Datos del recibo extraídos en local (confianza {confidence}): {datos}")
+    return datos, confidence
+
+def _openai_step(image_data):
+    return process_ticket_image_with_openai(io.BytesIO(image_data), check_cache=False), 1.0
+
+def build_extractor_chain():
+    """
+    Crea la cadena de extractores: caché de extracciones, OCR local (si está activado y
+    tesseract está disponible) y OpenAI, que se acepta siempre.
+    """
+    steps = [('cache', _cache_step, None)]
+    if LOCAL_EXTRACTION and local_extractor.available:
+        steps.append(('local', _local_step, LOCAL_CONFIDENCE_THRESHOLD))
+    elif LOCAL_EXTRACTION:
+        logging.info("Extracción local desactivada: falta Pillow o pytesseract.")
+    steps.append(('openai', _openai_step, None))
+    return ExtractorChain(steps)
+
+extractor_chain = build_extractor_chain()
+
+def extract_ticket_data(file_bytes):
+    """
+    Extrae los datos de un ticket con el primer extractor de la cadena que dé un resultado fiable.
+    
+    :param file_bytes: Objeto BytesIO con los datos de la imagen
+    :return: Diccionario con los datos extraídos o None si ningún extractor lo consiguió
+    """
+    datos, extractor = extractor_chain.extract(file_bytes.getvalue())
+    run_report.set(extractor=extractor)
+    return datos
+
+def report_extractor_stats():
+    """
+    Muestra cuántos tickets resolvió cada extractor de la cadena y el tiempo que empleó.
+    """
+    for name, entry in extractor_chain.stats().items():
+        logging.info(f"Extractor '{name}': {entry['tickets']} tickets de {entry['intentos']} intentos, "
+                     f"{entry['segundos']:.1f}s ({entry['segundos'] / entry['intentos']:.2f}s por intento).")
+
 # ================================
 # Función para copiar archivo a otra carpeta en Drive
 # ================================
-def copy_file_to_folder(file_id, destination_folder_id):
+@metrics.instrument('copia_drive', failed=lambda copied_id: copied_id is None)
+def copy_file_to_folder(file_id, destination_folder_id, file_name=None):
     """
     Copia un archivo de Google Drive a una carpeta específica sin eliminar el original.
     
     :param file_id: ID del archivo a copiar
     :param destination_folder_id: ID de la carpeta destino
+    :param file_name: Nombre del archivo si ya se conoce (evita pedir sus metadatos a Drive)
     :return: ID del archivo copiado o None si hay error
     """
     try:
-        # 1. Obtener metadata del archivo original
-        file_metadata = drive_service.files().get(
-            fileId=file_id, 
-            fields='name,mimeType',
-            supportsAllDrives=True
-        ).execute()
+        # 1. Obtener metadata del archivo original (si no la tenemos ya del listado)
+        if file_name:
+            file_metadata = {'name': file_name}
+        else:
+            file_metadata = get_drive_service().files().get(
+                fileId=file_id, 
+                fields='name,mimeType',
+                supportsAllDrives=True
+            ).execute()
         
         # 2. Crear una copia del archivo en la carpeta destino
         copy_metadata = {
@@ -378,7 +1060,7 @@ def copy_file_to_folder(file_id, destination_folder_id):
         
         logging.info(f"Copiando archivo {file_id} con nombre {file_metadata['name']} a carpeta {destination_folder_id}")
         
-        copied_file = drive_service.files().copy(
+        copied_file = get_drive_service().files().copy(
             fileId=file_id,
             body=copy_metadata,
             supportsAllDrives=True
@@ -391,61 +1073,388 @@ def copy_file_to_folder(file_id, destination_folder_id):
         logging.error(f"Error al copiar el archivo {file_id} a la carpeta {destination_folder_id}: {e}")
         return None
 
+def is_retryable_drive_error(error):
+    """
+    Indica si un error de Drive es transitorio: 429/5xx o 403 por límite de uso.
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return True  # Error de red sin respuesta: se reintenta
+    return status in RETRYABLE_STATUS_CODES or (status == 403 and 'ratelimitexceeded' in str(error).lower())
+
+def copy_files_to_folder(files, destination_folder_id, batch_size=None, max_retries=None):
+    """
+    Copia varios archivos de Drive a una carpeta agrupando las copias en peticiones batch
+    (hasta DRIVE_BATCH_SIZE copias por petición HTTP). Usa el nombre que ya viene en el listado,
+    sin pedir los metadatos de cada archivo, y reintenta con espera exponencial solo las copias
+    que fallan por un error transitorio.
+    
+    :param files: Archivos de Drive (con id y name)
+    :param destination_folder_id: ID de la carpeta destino
+    :param batch_size: Copias por petición (por defecto DRIVE_BATCH_SIZE, máximo 100)
+    :param max_retries: Reintentos de las copias fallidas (por defecto DRIVE_COPY_RETRIES)
+    :return: Diccionario {file_id: ID de la copia o None si no se pudo copiar}
+    """
+    batch_size = min(100, batch_size or DRIVE_BATCH_SIZE)
+    max_retries = DRIVE_COPY_RETRIES if max_retries is None else max_retries
+    results = {file['id']: None for file in files}
+    pending = list({file['id']: file for file in files}.values())
+    requests_sent = 0
+    
+    for attempt in range(max_retries + 1):
+        retry = []
+        for start in range(0, len(pending), batch_size):
+            chunk = {file['id']: file for file in pending[start:start + batch_size]}
+            errors = {}
+            
+            def on_copy(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = response['id']
+                else:
+                    errors[request_id] = exception
+            
+            requests_sent += 1
+            with metrics.track('copia_drive_lote') as call:
+                try:
+                    drive_files = get_drive_service().files()
+                    batch = get_drive_service().new_batch_http_request(callback=on_copy)
+                    for file_id, file in chunk.items():
+                        batch.add(drive_files.copy(
+                            fileId=file_id,
+                            body={'name': file['name'], 'parents': [destination_folder_id]},
+                            fields='id',
+                            supportsAllDrives=True
+                        ), request_id=file_id)
+                    batch.execute()
+                except Exception as e:
+                    # La petición entera falló (red, autenticación): todas sus copias se reintentan
+                    errors = {file_id: e for file_id in chunk if results[file_id] is None}
+                call['ok'] = not errors
+            
+            for file_id, error in errors.items():
+                if attempt < max_retries and is_retryable_drive_error(error):
+                    retry.append(chunk[file_id])
+                else:
+                    logging.error(f"Error al copiar el archivo {chunk[file_id]['name']} ({file_id}) "
+                                  f"a la carpeta {destination_folder_id}: {error}")
+        
+        if not retry:
+            break
+        delay = backoff_delay(attempt)
+        logging.warning(f"{len(retry)} copias en Drive fallaron por un error transitorio. "
+                        f"Reintentando en {delay:.1f}s (intento {attempt + 1}/{max_retries}).")
+        for _ in retry:
+            metrics.retry('drive')
+        time.sleep(delay)
+        pending = retry
+    
+    copied = sum(1 for copied_id in results.values() if copied_id)
+    if files:
+        logging.info(f"{copied} de {len(results)} archivos copiados a la carpeta {destination_folder_id} "
+                     f"en {requests_sent} peticiones a Drive.")
+    return results
+
 # ================================
-# Función para comprobar si un archivo ya ha sido procesado
+# Índice local de archivos procesados
 # ================================
-def is_file_already_processed(file_name):
+def list_folder_files(folder_id):
     """
-    Verifica si un archivo ya ha sido procesado anteriormente.
-    Comprueba tanto en el CSV local como en la hoja de Google Sheets.
+    Lista todos los archivos de una carpeta de Drive, recorriendo todas las páginas.
     
-    :param file_name: Nombre del archivo a verificar
-    :return: True si ya ha sido procesado, False en caso contrario
+    :param folder_id: ID de la carpeta en Google Drive
+    :return: Lista de archivos (con id y nombre)
+    """
+    files = []
+    page_token = None
+    while True:
+        results = get_drive_service().files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
+            fields="nextPageToken, files(id, name)",
+            pageSize=1000,
+            pageToken=page_token
+        ).execute()
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+def rebuild_processed_index():
+    """
+    Reconstruye el índice local a partir del CSV (o del almacén en Parquet), la columna
+    Archivo de Google Sheets y la carpeta de destino en Drive.
+    
+    :return: Número de archivos en el índice
     """
-    # Verificar en el CSV local
+    sheet_names = []
     try:
-        if os.path.exists(CSV_FILE_PATH):
-            with open(CSV_FILE_PATH, 'r', newline='', encoding='utf-8') as csv_file:
-                reader = csv.DictReader(csv_file)
-                for row in reader:
-                    if 'Archivo' in row and row['Archivo'] == file_name:
-                        logging.info(f"Archivo {file_name} encontrado en CSV local. Omitiendo.")
-                        return True
+        sheet_names = get_gastos_sheet().col_values(6)[1:]  # Omitir encabezado
     except Exception as e:
-        logging.warning(f"Error al verificar en CSV local: {e}")
+        logging.warning(f"Error al leer la columna Archivo de Google Sheets: {e}")
     
-    # Verificar en Google Sheets
+    drive_files = []
     try:
-        # Obtener todos los valores de la columna Archivo (columna 6)
-        processed_files = gastos_sheet.col_values(6)[1:]  # Omitir encabezado
-        if file_name in processed_files:
-            logging.info(f"Archivo {file_name} encontrado en Google Sheets. Omitiendo.")
-            return True
+        drive_files = list_folder_files(TICKETS_CARGADOS_FOLDER_ID)
     except Exception as e:
-        logging.warning(f"Error al verificar en Google Sheets: {e}")
+        logging.warning(f"Error al listar la carpeta destino: {e}")
+    
+    store_names = []
+    if expense_store:
+        try:
+            # Solo se lee la columna necesaria de cada partición
+            store_names = expense_store.read(columns=['archivo'])['archivo'].dropna().tolist()
+        except Exception as e:
+            logging.warning(f"Error al leer el almacén de gastos: {e}")
+    
+    return processed_index.rebuild(CSV_FILE_PATH, sheet_names, drive_files, store_names)
+
+def load_processed_index(rebuild=False):
+    """
+    Carga el índice de archivos procesados una vez por ejecución.
+    Si el índice no existe todavía (o se pide explícitamente) se reconstruye.
+    
+    :param rebuild: Forzar la reconstrucción desde CSV, Sheets y Drive
+    """
+    count = processed_index.load()
+    if rebuild or count == 0:
+        rebuild_processed_index()
+
+# ================================
+# Agregados del dashboard
+# ================================
+def local_expense_rows():
+    """
+    Recorre los gastos guardados en local (CSV o almacén en Parquet) con las columnas de analyze_data.
+    """
+    if not expense_store:
+        if os.path.isfile(CSV_FILE_PATH):
+            yield from rows_from_csv(CSV_FILE_PATH)
+        return
+    
+    columns = ['fecha', 'negocio', 'descripcion', 'importe', 'categoria']
+    df = expense_store.read(columns=columns)
+    for fecha, negocio, descripcion, importe, categoria in df[columns].itertuples(index=False):
+        yield {
+            'Fecha': fecha,
+            'empresa': negocio,
+            'descripcion': descripcion,
+            'importe': importe,
+            'categoria': categoria,
+            'forma_pago': 'Desconocido'
+        }
+
+def load_aggregates(rebuild=False):
+    """
+    Carga los agregados del dashboard. Si todavía no existen (o se pide explícitamente)
+    se recalculan desde los gastos guardados en local.
     
-    # Comprobar si ya existe en la carpeta de destino
+    :param rebuild: Forzar el recálculo completo
+    """
     try:
-        query = f"name = '{file_name}' and '{TICKETS_CARGADOS_FOLDER_ID}' in parents"
-        results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-        files = results.get('files', [])
-        if files:
-            logging.info(f"Archivo {file_name} encontrado en carpeta destino. Omitiendo.")
-            return True
+        if rebuild or not aggregates.exists():
+            aggregates.rebuild(local_expense_rows())
+        else:
+            aggregates.load()
+    except Exception as e:
+        logging.warning(f"Error al cargar los agregados del dashboard: {e}")
+
+def add_to_aggregates(datos):
+    """
+    Suma un gasto recién guardado a los agregados del dashboard (sin guardarlos en disco).
+    """
+    try:
+        aggregates.add({
+            'Fecha': datos['fecha'],
+            'empresa': datos['negocio'],
+            'descripcion': datos['descripcion'],
+            'importe': datos['importe'],
+            'categoria': datos['categoria'],
+            'forma_pago': 'Desconocido'
+        })
+    except Exception as e:
+        logging.warning(f"Error al actualizar los agregados del dashboard: {e}")
+
+def save_merchant_memo():
+    try:
+        merchant_memo.save()
+    except Exception as e:
+        logging.warning(f"Error al guardar la tabla de negocios: {e}")
+
+def write_dashboard_snapshot():
+    """
+    Genera la instantánea JSON del dashboard a partir de los agregados (no recorre el histórico).
+    """
+    try:
+        write_snapshot(aggregates.to_dashboard_data(), DASHBOARD_SNAPSHOT_PATH)
+    except Exception as e:
+        logging.warning(f"Error al generar la instantánea del dashboard: {e}")
+
+# ================================
+# Tickets casi duplicados (hash perceptual)
+# ================================
+def record_near_duplicate(file, match, distance, action, datos=None):
+    """
+    Anota un posible duplicado en NEAR_DUPLICATES_LOG_PATH (una línea JSON por caso) para revisarlo.
+    Los omitidos guardan el archivo y los datos extraídos, para recuperarlos con --keep-duplicate.
+    """
+    entry = {
+        'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'archivo': file['name'],
+        'id': file['id'],
+        'coincide_con': match['name'],
+        'distancia': distance,
+        'accion': action
+    }
+    if datos is not None:
+        entry['file'] = file
+        entry['datos'] = datos
+    try:
+        with _near_duplicates_lock:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with open(NEAR_DUPLICATES_LOG_PATH, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
     except Exception as e:
-        logging.warning(f"Error al verificar en carpeta destino: {e}")
+        logging.warning(f"No se pudo anotar el posible duplicado: {e}")
+
+def find_near_duplicate(file, file_bytes):
+    """
+    Busca un ticket ya procesado (o en proceso en esta ejecución) con una imagen casi idéntica.
+    Si no lo hay, el hash queda reservado hasta que el ticket se guarde.
+    
+    :param file: Diccionario con id y nombre del archivo en Drive
+    :param file_bytes: Objeto BytesIO con los datos de la imagen
+    :return: Tupla (distancia, archivo coincidente) o None
+    """
+    if DUPLICATE_MODE == 'off':
+        return None
+    
+    phash = dhash(file_bytes.getvalue())
+    if phash is None:
+        return None
+    
+    found = perceptual_index.find_or_reserve(phash, file, PHASH_THRESHOLD)
+    if found is not None:
+        logging.info(f"El archivo {file['name']} se parece a {found[1]['name']} (distancia {found[0]}); "
+                     f"se comprobará con los datos extraídos.")
+    return found
+
+def same_receipt(datos, match):
+    """
+    Indica si los datos extraídos tienen la misma fecha e importe que el ticket coincidente.
+    Sin fecha o importe guardados (tickets indexados antes, o en proceso) no se confirma.
+    """
+    try:
+        same_amount = round(float(datos['importe']), 2) == round(float(match['importe']), 2)
+    except (KeyError, TypeError, ValueError):
+        return False
+    fecha = parse_date(datos.get('fecha'))
+    return same_amount and fecha is not None and fecha == parse_date(match.get('fecha'))
+
+def resolve_near_duplicate(file, near, datos):
+    """
+    Decide qué hacer con un ticket cuya imagen se parece a otro, ya con sus datos extraídos.
     
+    :param near: Tupla (distancia, archivo coincidente) de find_near_duplicate
+    :return: True si el ticket debe omitirse por ser un duplicado
+    """
+    distance, match = near
+    if DUPLICATE_MODE == 'skip' and same_receipt(datos, match):
+        record_near_duplicate(file, match, distance, 'omitido', datos)
+        logging.info(f"El archivo {file['name']} es el mismo ticket que {match['name']} (distancia {distance}, "
+                     f"misma fecha e importe). Omitiendo; se recupera con --keep-duplicate.")
+        return True
+    record_near_duplicate(file, match, distance, 'marcado')
+    logging.warning(f"⚠️ El archivo {file['name']} parece el mismo ticket que {match['name']} "
+                    f"(distancia {distance}). Se procesa igualmente.")
+    return False
+
+def skipped_near_duplicates():
+    """
+    :return: Entradas del registro de casi duplicados omitidos que siguen fuera de la hoja
+    """
+    if not os.path.isfile(NEAR_DUPLICATES_LOG_PATH):
+        return []
+    entries = {}
+    with open(NEAR_DUPLICATES_LOG_PATH, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['accion'] == 'omitido':
+                entries[entry['archivo']] = entry
+            elif entry['accion'] == 'recuperado':
+                entries.pop(entry['archivo'], None)
+    return list(entries.values())
+
+def keep_near_duplicate(file_name):
+    """
+    Recupera un ticket omitido por casi duplicado: lo quita del índice de procesados y lo deja
+    en el diario con sus datos extraídos, para que la ejecución lo guarde sin volver a
+    descargarlo ni extraerlo.
+    
+    :return: True si el ticket estaba entre los omitidos
+    """
+    entry = next((entry for entry in skipped_near_duplicates() if entry['archivo'] == file_name), None)
+    if entry is None:
+        return False
+    processed_index.remove(file_name)
+    job_journal.advance(entry['file'], 'extraido', datos=entry['datos'])
+    record_near_duplicate(entry['file'], {'name': entry['coincide_con']}, entry['distancia'], 'recuperado')
+    return True
+
+def index_processed_images(max_workers=None):
+    """
+    Calcula el hash perceptual de los tickets de la carpeta de destino que todavía no están en
+    el índice, para detectar duplicados de tickets procesados antes de activar la detección.
+    
+    :param max_workers: Hilos para las descargas (por defecto MAX_WORKERS)
+    :return: Número de imágenes añadidas al índice
+    """
+    perceptual_index.load()
+    files = [f for f in list_folder_files(TICKETS_CARGADOS_FOLDER_ID) if not perceptual_index.contains(f['name'])]
+    logging.info(f"Calculando el hash perceptual de {len(files)} tickets ya procesados.")
+    
+    def hash_file(file):
+        file_bytes = download_file(file['id'])
+        return dhash(file_bytes.getvalue()) if file_bytes else None
+    
+    added = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers or MAX_WORKERS)) as executor:
+        for file, phash in zip(files, executor.map(hash_file, files)):
+            if phash is not None:
+                perceptual_index.add(phash, file)
+                added += 1
+    logging.info(f"Añadidos {added} tickets al índice de hashes perceptuales.")
+    return added
+
+# ================================
+# Función para comprobar si un archivo ya ha sido procesado
+# ================================
+@metrics.instrument('indice_procesados')
+def is_file_already_processed(file_name, file_id=None):
+    """
+    Verifica si un archivo ya ha sido procesado anteriormente.
+    Consulta el índice local, que refleja el CSV, Google Sheets y la carpeta de destino.
+    
+    :param file_name: Nombre del archivo a verificar
+    :param file_id: ID del archivo en Drive (opcional)
+    :return: True si ya ha sido procesado, False en caso contrario
+    """
+    if processed_index.contains(file_name=file_name, file_id=file_id):
+        logging.info(f"Archivo {file_name} encontrado en el índice de procesados. Omitiendo.")
+        return True
     return False
 
 # ================================
 # Función para guardar datos en CSV local
 # ================================
-def save_to_csv(datos, file_name):
+@metrics.instrument('csv', failed=lambda saved: not saved)
+def save_to_csv(datos, file_name, processed_at=None):
     """
     Guarda los datos extraídos en un archivo CSV local.
     
     :param datos: Diccionario con los datos extraídos
     :param file_name: Nombre del archivo procesado
+    :param processed_at: Fecha de procesamiento (por defecto, ahora)
     :return: True si se guardó correctamente, False en caso contrario
     """
     try:
@@ -457,7 +1466,7 @@ def save_to_csv(datos, file_name):
             'Importe': datos['importe'],
             'Categoría': datos['categoria'],
             'Archivo': file_name,
-            'Fecha Procesamiento': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            'Fecha Procesamiento': processed_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         
         # Verificar si el archivo existe
@@ -482,9 +1491,86 @@ def save_to_csv(datos, file_name):
         logging.error(f"Error al guardar en CSV: {e}")
         return False
 
+# ================================
+# Función para guardar datos en el almacén en Parquet
+# ================================
+@metrics.instrument('almacen', failed=lambda saved: not saved)
+def save_to_store(entries):
+    """
+    Guarda un lote de datos extraídos en el almacén de gastos en Parquet con una sola escritura.
+    
+    :param entries: Lista de tuplas (datos, file_name, processed_at)
+    :return: True si se guardó correctamente, False en caso contrario
+    """
+    try:
+        rows = [
+            dict(datos, archivo=file_name, fecha_procesamiento=processed_at)
+            for datos, file_name, processed_at in entries
+        ]
+        expense_store.append(rows)
+        logging.info(f"{len(rows)} filas guardadas en el almacén de gastos: {EXPENSE_STORE_DIR}")
+        return True
+    
+    except Exception as e:
+        logging.error(f"Error al guardar en el almacén de gastos: {e}")
+        return False
+
+def load_expense_store():
+    """
+    Al empezar a usar el almacén en Parquet con un registro_gastos.csv previo, importa el CSV
+    (si el almacén está vacío) para que el CSV exportado al final no pierda el histórico.
+    """
+    if not expense_store or expense_store.months() or not os.path.isfile(CSV_FILE_PATH):
+        return
+    try:
+        expense_store.import_csv(CSV_FILE_PATH)
+    except Exception as e:
+        logging.warning(f"Error al importar {CSV_FILE_PATH} en el almacén de gastos: {e}")
+
+def finish_local_storage():
+    """
+    Tareas de fin de ejecución del almacén en Parquet: compactar las particiones con muchos
+    archivos y, si está activado, regenerar el CSV para los consumidores que lo leen. El CSV
+    no se sobrescribe si tiene filas que no están en el almacén.
+    """
+    if not expense_store:
+        return
+    try:
+        expense_store.compact(min_parts=STORAGE_COMPACT_PARTS)
+        if not STORAGE_CSV_EXPORT:
+            return
+        missing = expense_store.csv_rows_missing(CSV_FILE_PATH)
+        if missing:
+            logging.warning(f"{CSV_FILE_PATH} tiene {missing} filas que no están en el almacén de gastos: "
+                            f"no se regenera. Impórtalas con 'python almacen_gastos.py import-csv'.")
+            return
+        expense_store.export_csv(CSV_FILE_PATH)
+    except Exception as e:
+        logging.warning(f"Error al compactar o exportar el almacén de gastos: {e}")
+
 # ================================
 # Función para guardar datos en Google Sheets
 # ================================
+def build_sheet_row(datos, file_name, processed_at=None):
+    """
+    Prepara la fila de Google Sheets para los datos extraídos.
+    
+    :param datos: Diccionario con los datos extraídos
+    :param file_name: Nombre del archivo procesado
+    :param processed_at: Fecha de procesamiento (por defecto, ahora)
+    :return: Lista de valores en el orden de las columnas de la hoja
+    """
+    return [
+        datos['fecha'],
+        datos['negocio'],
+        datos['descripcion'],
+        datos['importe'],
+        datos['categoria'],
+        file_name,
+        processed_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    ]
+
+@metrics.instrument('sheets', failed=lambda saved: not saved)
 def save_to_google_sheets(datos, file_name):
     """
     Guarda los datos extraídos en la hoja de Google Sheets.
@@ -495,18 +1581,10 @@ def save_to_google_sheets(datos, file_name):
     """
     try:
         # Preparar fila para Google Sheets
-        row_data = [
-            datos['fecha'],
-            datos['negocio'],
-            datos['descripcion'],
-            datos['importe'],
-            datos['categoria'],
-            file_name,
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ]
+        row_data = build_sheet_row(datos, file_name)
         
         # Añadir la fila a Google Sheets
-        gastos_sheet.append_row(row_data)
+        get_gastos_sheet().append_row(row_data)
         
         logging.info(f"Datos guardados correctamente en Google Sheets")
         return True
@@ -516,104 +1594,617 @@ def save_to_google_sheets(datos, file_name):
         return False
 
 # ================================
-# Función principal para procesar tickets
+# Etapas finales: Google Sheets, CSV y copia en Drive
 # ================================
-def process_tickets(days_threshold=7):
+def new_run_stats():
     """
-    Procesa los tickets de imágenes en la carpeta de origen que fueron creados/modificados
-    en los últimos days_threshold días.
+    Contadores de una ejecución: archivos procesados, omitidos (de ellos, cuántos por ser casi
+    duplicados de otro ticket), los reanudados desde el diario, los que pasaron a descartados y
+    los que fallaron por un error (estos últimos se reintentarán en la próxima ejecución).
+    En latencies se guardan los segundos entre la subida a Drive y la escritura en la hoja.
+    """
+    return {'processed': 0, 'skipped': 0, 'near_duplicates': 0, 'resumed': 0, 'dead_letters': 0,
+            'failed_files': [], 'latencies': []}
+
+def upload_latency(file, now=None):
+    """
+    Segundos desde que el archivo se subió a Drive (createdTime) hasta ahora, o None si
+    Drive no devolvió la fecha de creación.
+    """
+    created = file.get('createdTime')
+    if not created:
+        return None
+    created = datetime.fromisoformat(created.replace('Z', '+00:00'))
+    now = now or datetime.now(created.tzinfo)
+    return max(0.0, (now - created).total_seconds())
+
+def record_failure(run_stats, file, error):
+    """
+    Anota el fallo de un archivo en el diario y en los contadores de la ejecución. Los que pasan
+    a descartados no cuentan como fallidos, así la marca de sincronización puede avanzar.
+    """
+    run_stats['skipped'] += 1
+    run_report.set(file, resultado='fallido', motivo=error)
+    if job_journal.fail(file, error):
+        run_stats['dead_letters'] += 1
+    else:
+        run_stats['failed_files'].append(file)
+
+def finish_saved_entries(entries, run_stats, stored_names=None):
+    """
+    Completa las etapas posteriores a Google Sheets para filas que ya están en la hoja: CSV (o
+    almacén en Parquet), índice de procesados, agregados, tabla de negocios y copia en Drive
+    (todas las del lote juntas, ver copy_files_to_folder). Cada etapa completada se anota en el diario.
     
-    1. Extrae datos estructurados usando OpenAI
-    2. Guarda la información en un CSV local
-    3. Guarda la información en la hoja de Google Sheets
-    4. Copia el archivo a la carpeta de destino
+    :param entries: Lista de (file, datos, processed_at, stage), con stage la última etapa
+                    completada ('hoja_guardada' o 'csv_guardado' si se reanuda tras la copia)
+    :param run_stats: Contadores de la ejecución
+    :param stored_names: Archivos que ya están en el CSV o el almacén (ver local_file_names), al
+                         reanudar: si la ejecución anterior se cortó tras guardarlos en local y
+                         antes de anotarlo en el diario, no se vuelven a escribir
+    """
+    stored_names = stored_names or set()
+    # El almacén en Parquet recibe el lote entero en una sola escritura
+    pending_local = [(datos, file['name'], processed_at)
+                     for file, datos, processed_at, stage in entries
+                     if stage == 'hoja_guardada' and file['name'] not in stored_names]
+    store_saved = True
+    if expense_store and pending_local:
+        store_saved = save_to_store(pending_local)
     
-    :param days_threshold: Número de días hacia atrás para considerar
+    to_copy = []
+    for file, datos, processed_at, stage in entries:
+        with run_report.activate(file):
+            file_id = file['id']
+            file_name = file['name']
+        
+            if stage == 'hoja_guardada':
+                # Guardar en local solo lo que ya está en la hoja, para que no se desincronicen
+                if file_name in stored_names:
+                    logging.info(f"El archivo {file_name} ya estaba guardado en local; no se vuelve a escribir.")
+                    csv_saved = True
+                elif expense_store:
+                    csv_saved = store_saved
+                else:
+                    csv_saved = save_to_csv(datos, file_name, processed_at)
+            
+                # El archivo ya está en la hoja: registrarlo para no volver a extraerlo ni duplicar filas
+                processed_index.add(file_name, file_id)
+                perceptual_index.commit(file_id, datos)
+            
+                if not csv_saved:
+                    logging.error(f"❌ Error al guardar los datos del archivo {file_name} en el CSV.")
+                    record_failure(run_stats, file, "CSV")
+                    continue
+                job_journal.advance(file, 'csv_guardado')
+                add_to_aggregates(datos)
+                # Solo aprende las categorías del modelo: una coincidencia aproximada de la propia
+                # tabla guardada como exacta se propagaría a los negocios parecidos
+                if datos.get('categoria_origen') != CATEGORY_FROM_MEMO:
+                    merchant_memo.add(datos['negocio'], datos['categoria'])
+        
+            # Si se guardó correctamente en ambos lugares, copiar el archivo a la carpeta de destino
+            to_copy.append(file)
+    
+    # Las copias del lote se hacen juntas, en peticiones batch de Drive
+    copied = copy_files_to_folder(to_copy, TICKETS_CARGADOS_FOLDER_ID)
+    for file in to_copy:
+        copied_id = copied.get(file['id'])
+        if copied_id:
+            job_journal.complete(file['id'])
+            logging.info(f"✅ Archivo {file['name']} procesado completamente y copiado a la carpeta de destino.")
+        else:
+            # La copia se reintenta en la próxima ejecución, sin volver a guardar los datos
+            logging.warning(f"⚠️ Archivo {file['name']} procesado pero no se pudo copiar a la carpeta de destino.")
+            if job_journal.fail(file, "copia en Drive"):
+                run_stats['dead_letters'] += 1
+        # Aún contamos como procesado aunque no se copie, porque los datos se guardaron
+        run_stats['processed'] += 1
+        run_report.set(file, resultado='procesado', copiado=bool(copied_id))
+
+def save_local_state():
     """
-    # Primero verificamos y actualizamos la estructura de la hoja si es necesario
-    verify_sheet_structure()
+    Guarda en disco los agregados del dashboard y la tabla de negocios.
+    """
+    try:
+        aggregates.save()
+    except Exception as e:
+        logging.warning(f"Error al guardar los agregados del dashboard: {e}")
+    save_merchant_memo()
+
+def create_sheet_writer(run_stats):
+    """
+    Crea el escritor por lotes de Google Sheets. Tras cada lote, las filas que llegaron a la hoja
+    se guardan en el CSV (o en el almacén en Parquet), en los agregados del dashboard y en la tabla de negocios, se registran en el índice y se copian a la carpeta de destino.
     
-    # Obtener archivos recientes
-    files = get_files_by_creation_date(TICKETS_FOLDER_ID, days_threshold)
+    :param run_stats: Contadores de la ejecución (ver new_run_stats), se actualizan en cada lote
+    :return: SheetWriter al que añadir filas con add(row, (file, datos, processed_at))
+    """
+    def on_sheet_flush(written, failed):
+        """
+        Completa el resto de etapas para las filas de un lote según hayan llegado o no a la hoja.
+        """
+        # Lo primero, anotar que ya están en la hoja: al reanudar no se vuelven a añadir
+        for file, datos, processed_at in written:
+            job_journal.advance(file, 'hoja_guardada', processed_at=processed_at)
+            latency = upload_latency(file)
+            if latency is not None:
+                run_stats['latencies'].append(latency)
+        
+        finish_saved_entries([(file, datos, processed_at, 'hoja_guardada')
+                              for file, datos, processed_at in written], run_stats)
+        
+        for file, datos, processed_at in failed:
+            logging.error(f"❌ Error al guardar los datos del archivo {file['name']} en Google Sheets.")
+            perceptual_index.release(file['id'])
+            record_failure(run_stats, file, "Google Sheets")
+        
+        if written:
+            save_local_state()
     
-    if not files:
-        logging.info(f"No hay archivos nuevos para procesar en los últimos {days_threshold} días.")
-        return 0  # No hay archivos para procesar
+    return SheetWriter(
+        get_gastos_sheet(),
+        batch_size=SHEETS_BATCH_SIZE,
+        flush_interval=SHEETS_FLUSH_SECONDS,
+        on_flush=on_sheet_flush,
+        metrics=metrics,
+        key_column=5  # Archivo (ver build_sheet_row)
+    )
+
+def map_flushing(executor, function, items, sheet_writer):
+    """
+    Como executor.map, pero mientras espera cada resultado vacía el lote de la hoja cuando
+    toca por tiempo: con extracciones lentas las filas ya listas no se quedan sin escribir.
     
-    # Contadores para estadísticas
-    total_files = len(files)
-    processed_files = 0
-    skipped_files = 0
+    :return: Generador de (elemento, resultado) en el orden de items
+    """
+    futures = [executor.submit(function, item) for item in items]
+    for item, future in zip(items, futures):
+        while True:
+            try:
+                result = future.result(timeout=sheet_writer.flush_due_in())
+                break
+            except FutureTimeoutError:
+                sheet_writer.flush_if_due()
+        yield item, result
+
+def queue_result(sheet_writer, file, datos):
+    """
+    Añade los datos extraídos de un archivo al lote de Google Sheets; el CSV y la copia
+    se hacen al vaciar el lote.
+    """
+    processed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    sheet_writer.add(build_sheet_row(datos, file['name'], processed_at), (file, datos, processed_at))
+
+# ================================
+# Etapa concurrente: descarga y extracción
+# ================================
+def fetch_and_extract(file):
+    """
+    Comprueba si el archivo ya fue procesado, lo descarga y extrae sus datos con OpenAI.
+    Solo realiza operaciones de red, por lo que puede ejecutarse en paralelo desde varios hilos.
+    Si el diario ya tiene los datos extraídos de una ejecución anterior, se usan sin descargar
+    ni extraer otra vez.
     
-    # Procesar cada archivo
-    for file in files:
+    :param file: Diccionario con id y nombre del archivo en Drive
+    :return: Tupla (datos, motivo). datos es None si el archivo debe omitirse y motivo indica
+             por qué: 'duplicado', 'duplicado_visual', 'descarga' o 'extraccion'. Con datos,
+             motivo es 'reanudado' si vienen del diario y None si no
+    """
+    # Lo que se mida en este hilo (descarga, extracción, tokens) se atribuye al archivo en el informe
+    with run_report.activate(file):
         file_id = file['id']
         file_name = file['name']
         logging.info(f"Procesando el archivo: {file_name} (ID: {file_id})")
-        
+    
+        job = job_journal.get(file_id)
+        if job and job['stage'] == 'extraido' and job['datos']:
+            logging.info(f"Datos del archivo {file_name} recuperados del diario; no se vuelve a extraer.")
+            return job['datos'], 'reanudado'
+    
         # Verificar si este archivo ya fue procesado antes (evitar duplicados)
-        if is_file_already_processed(file_name):
+        if is_file_already_processed(file_name, file_id):
             logging.info(f"El archivo {file_name} ya fue procesado anteriormente. Omitiendo.")
-            skipped_files += 1
-            continue
-        
+            return None, 'duplicado'
+    
         # Descargar y procesar el archivo
         file_bytes = download_file(file_id)
         if not file_bytes:
             logging.error(f"No se pudo descargar el archivo {file_name}. Omitiendo.")
-            skipped_files += 1
-            continue
-        
-        # Procesar la imagen con OpenAI para extraer datos
-        datos = process_ticket_image_with_openai(file_bytes)
+            return None, 'descarga'
+        job_journal.advance(file, 'descargado')
+    
+        # Buscar otro ticket ya procesado con una imagen casi idéntica (otro escaneo o una foto)
+        near = find_near_duplicate(file, file_bytes)
+    
+        # Extraer los datos: caché, OCR local si es fiable y, si no, OpenAI
+        datos = extract_ticket_data(file_bytes)
         if not datos:
             logging.error(f"No se pudieron extraer datos del archivo {file_name}. Omitiendo.")
-            skipped_files += 1
-            continue
-        
-        # Guardar en CSV local
-        csv_saved = save_to_csv(datos, file_name)
-        
-        # Guardar en Google Sheets
-        sheets_saved = save_to_google_sheets(datos, file_name)
-        
-        # Si se guardó correctamente en ambos lugares, copiar el archivo a la carpeta de destino
-        if csv_saved and sheets_saved:
-            copied_id = copy_file_to_folder(file_id, TICKETS_CARGADOS_FOLDER_ID)
-            if copied_id:
-                logging.info(f"✅ Archivo {file_name} procesado completamente y copiado a la carpeta de destino.")
-                processed_files += 1
-            else:
-                logging.warning(f"⚠️ Archivo {file_name} procesado pero no se pudo copiar a la carpeta de destino.")
-                # Aún contamos como procesado porque los datos se guardaron
-                processed_files += 1
+            perceptual_index.release(file_id)
+            return None, 'extraccion'
+    
+        # Solo es un duplicado si, además de la imagen, coinciden la fecha y el importe
+        if near and resolve_near_duplicate(file, near, datos):
+            job_journal.complete(file_id)
+            return None, 'duplicado_visual'
+    
+        # Los datos quedan en el diario: si la ejecución se interrumpe no se vuelven a extraer
+        job_journal.advance(file, 'extraido', datos=datos)
+        return datos, None
+
+def sheet_file_names():
+    """
+    :return: Conjunto de nombres de la columna Archivo de Google Sheets, o None si no se puede leer
+    """
+    try:
+        return set(get_gastos_sheet().col_values(6)[1:])  # Omitir encabezado
+    except Exception as e:
+        logging.warning(f"Error al leer la columna Archivo de Google Sheets: {e}")
+        return None
+
+def local_file_names():
+    """
+    :return: Conjunto de archivos guardados en el almacén en Parquet o en el CSV (vacío si no se
+             pueden leer: entonces se escriben de nuevo, como antes de reanudar)
+    """
+    try:
+        if expense_store:
+            return set(expense_store.read(columns=['archivo'])['archivo'].dropna())
+        if os.path.isfile(CSV_FILE_PATH):
+            with open(CSV_FILE_PATH, 'r', newline='', encoding='utf-8') as csv_file:
+                return {row['Archivo'] for row in csv.DictReader(csv_file) if row.get('Archivo')}
+    except Exception as e:
+        logging.warning(f"Error al leer los archivos guardados en local: {e}")
+    return set()
+
+def plan_jobs(files):
+    """
+    Reparte los archivos de la ejecución según su estado en el diario. Se añaden los trabajos
+    sin terminar que ya no aparecen en el listado de Drive (fuera de la ventana de días o de
+    la marca incremental). Los que se reanudan con los datos ya extraídos se buscan antes en
+    la columna Archivo de la hoja, por si su fila llegó a escribirse.
+    
+    :param files: Archivos listados en Drive
+    :return: Tupla (files, to_fetch, saved, waiting, dead): todos los archivos de la ejecución,
+             los que hay que descargar y extraer (o recuperar del diario), los que ya están en la
+             hoja (file, datos, processed_at, stage), y cuántos esperan su próximo intento o
+             están descartados
+    """
+    jobs = {job['file']['id']: job for job in job_journal.pending() + job_journal.dead_letters()}
+    listed = {file['id'] for file in files}
+    files = files + [job['file'] for file_id, job in jobs.items() if file_id not in listed and not job['dead']]
+    
+    to_fetch, saved, extracted = [], [], []
+    waiting = dead = 0
+    for file in files:
+        job = jobs.get(file['id'])
+        if job is None:
+            to_fetch.append(file)
+        elif job['dead']:
+            dead += 1
+        elif not job_journal.is_due(job):
+            waiting += 1
+        elif job['stage'] in ('hoja_guardada', 'csv_guardado'):
+            saved.append((job['file'], job['datos'], job['processed_at'], job['stage']))
         else:
-            logging.error(f"❌ Error al guardar los datos del archivo {file_name}.")
-            skipped_files += 1
+            if job['stage'] == 'extraido' and job['datos']:
+                extracted.append(job)
+            to_fetch.append(file)
+    
+    if extracted:
+        # Si la ejecución anterior se cortó entre append_rows y la anotación en el diario, la
+        # fila ya está en la hoja: se comprueba por la columna Archivo antes de añadirla otra vez
+        in_sheet = sheet_file_names()
+        if in_sheet is None:
+            logging.warning(f"{len(extracted)} archivos extraídos esperan a que se pueda comprobar la hoja.")
+            waiting += len(extracted)
+        held = set()
+        for job in extracted:
+            file = job['file']
+            if in_sheet is None:
+                held.add(file['id'])
+            elif file['name'] in in_sheet:
+                logging.info(f"El archivo {file['name']} ya estaba en Google Sheets; no se vuelve a añadir.")
+                processed_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                job_journal.advance(file, 'hoja_guardada', processed_at=processed_at)
+                saved.append((file, job['datos'], processed_at, 'hoja_guardada'))
+                held.add(file['id'])
+        to_fetch = [file for file in to_fetch if file['id'] not in held]
+    return files, to_fetch, saved, waiting, dead
+
+# ================================
+# Función principal para procesar tickets
+# ================================
+def prepare_run(rebuild_index=False, rebuild_aggregates=False, rebuild_merchants=False):
+    """
+    Verifica la hoja y carga el estado local que se reutiliza entre lotes: índice de procesados,
+    agregados del dashboard, tabla de negocios y hashes perceptuales. Basta con hacerlo una vez
+    por proceso (el servicio de vigilancia lo hace al arrancar).
+    
+    :param rebuild_index: Reconstruir el índice de procesados
+    :param rebuild_aggregates: Recalcular los agregados del dashboard
+    :param rebuild_merchants: Reconstruir la tabla negocio -> categoría
+    """
+    # Primero verificamos y actualizamos la estructura de la hoja si es necesario
+    verify_sheet_structure()
+    
+    load_expense_store()
+    load_processed_index(rebuild=rebuild_index)
+    load_aggregates(rebuild=rebuild_aggregates)
+    load_merchant_memo(rebuild=rebuild_merchants)
+    if DUPLICATE_MODE != 'off':
+        perceptual_index.load()
+
+def write_metrics():
+    """
+    Muestra el tiempo acumulado por etapa y escribe las métricas en METRICS_FILE.
+    """
+    metrics.report()
+    if not METRICS_FILE:
+        return
+    try:
+        metrics.write(METRICS_FILE)
+    except Exception as e:
+        logging.warning(f"No se pudieron escribir las métricas en {METRICS_FILE}: {e}")
+
+def write_run_report(run_stats):
+    """
+    Escribe el informe JSON de la ejecución en RUN_REPORTS_DIR y muestra el consumo de tokens.
+    """
+    if not RUN_REPORTS_DIR:
+        return
+    report = run_report.to_dict(run_stats)
+    try:
+        path = write_report(report, RUN_REPORTS_DIR)
+    except Exception as e:
+        logging.warning(f"No se pudo escribir el informe de la ejecución: {e}")
+        return
+    totals = report['totales']
+    logging.info(f"Tokens de la ejecución: {totals['prompt_tokens']} de entrada y "
+                 f"{totals['completion_tokens']} de salida en {totals['llamadas_api']} llamadas. Informe: {path}")
+
+def log_latencies(latencies):
+    """
+    Muestra la mediana y el máximo de la latencia entre la subida a Drive y la fila en la hoja.
+    """
+    if not latencies:
+        return
+    ordered = sorted(latencies)
+    logging.info(f"Latencia subida -> hoja: mediana {ordered[len(ordered) // 2]:.0f}s, "
+                 f"máxima {ordered[-1]:.0f}s ({len(ordered)} archivos)")
+
+def process_files(files, max_workers=None, idle_level=logging.INFO):
+    """
+    Procesa un lote de archivos de Drive con el estado ya cargado (ver prepare_run). Junto con
+    los archivos listados se procesan los trabajos del diario cuyo reintento ya toca.
+    
+    :param files: Archivos listados en Drive (con id, name, createdTime y modifiedTime)
+    :param max_workers: Número de hilos para descarga y extracción (por defecto MAX_WORKERS)
+    :param idle_level: Nivel de log del aviso de que no hay nada que procesar (el servicio de
+                       vigilancia usa DEBUG para no repetirlo en cada sondeo)
+    :return: Contadores de la ejecución (ver new_run_stats) o None si no había nada que procesar
+    """
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+    max_workers = max(1, max_workers)
+    extractor_chain.reset_stats()
+    reset_api_usage()
+    receipt_batcher.reset_stats()
+    # Los tickets de un grupo son los que los hilos tienen listos a la vez
+    receipt_batcher.max_receipts = min(MULTI_RECEIPT_SIZE, max_workers)
+    if MULTI_RECEIPT_SIZE > max_workers:
+        logging.info(f"Extracción múltiple limitada a {max_workers} tickets por petición (uno por hilo).")
+    
+    # Añadir los trabajos sin terminar del diario
+    files, to_fetch, saved, waiting, dead = plan_jobs(files)
+    
+    if not to_fetch and not saved:
+        if waiting or dead:
+            logging.log(idle_level, f"{waiting} archivos esperan su próximo reintento y {dead} están descartados.")
+        else:
+            logging.log(idle_level, "No hay archivos nuevos para procesar.")
+        return None  # No hay archivos para procesar
+    
+    # Contadores para estadísticas
+    total_files = len(files)
+    run_stats = new_run_stats()
+    run_report.reset(modelo=OPENAI_MODEL, prompt='corto' if use_short_prompt else 'completo',
+                     tickets_por_peticion=receipt_batcher.max_receipts, hilos=max_workers, en_espera=waiting, descartados=dead)
+    run_stats['skipped'] += waiting + dead
+    sheet_writer = create_sheet_writer(run_stats)
+    
+    logging.info(f"Procesando {total_files} archivos con {max_workers} hilo(s).")
+    if waiting or dead:
+        logging.info(f"{waiting} archivos esperan su próximo reintento y {dead} están descartados.")
+    
+    # Los que ya estaban en la hoja solo necesitan las etapas que les faltan
+    if saved:
+        logging.info(f"Reanudando {len(saved)} archivos que ya están en Google Sheets.")
+        run_stats['resumed'] += len(saved)
+        for file, datos, processed_at, stage in saved:
+            run_report.set(file, reanudado=True)
+        stored_names = local_file_names() if any(stage == 'hoja_guardada' for *_, stage in saved) else None
+        finish_saved_entries(saved, run_stats, stored_names)
+        save_local_state()
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Los resultados llegan en el orden original, así las escrituras quedan ordenadas
+        for file, (datos, skip_reason) in map_flushing(executor, fetch_and_extract, to_fetch, sheet_writer):
+            if not datos:
+                if skip_reason in ('duplicado', 'duplicado_visual'):
+                    run_report.set(file, resultado='omitido', motivo=skip_reason)
+                if skip_reason == 'duplicado_visual':
+                    # Registrarlo para no volver a descargarlo (--near-duplicates lo lista y
+                    # --keep-duplicate lo recupera)
+                    processed_index.add(file['name'], file['id'], source='duplicado_visual')
+                    run_stats['near_duplicates'] += 1
+                    run_stats['skipped'] += 1
+                elif skip_reason == 'duplicado':
+                    run_stats['skipped'] += 1
+                else:
+                    record_failure(run_stats, file, skip_reason)
+                continue
+            
+            if skip_reason == 'reanudado':
+                run_stats['resumed'] += 1
+                run_report.set(file, reanudado=True)
+            queue_result(sheet_writer, file, datos)
+    
+    # Vaciar las filas pendientes al terminar
+    sheet_writer.flush()
+    finish_local_storage()
+    write_dashboard_snapshot()
+    save_merchant_memo()
+    
+    # Recordar hasta dónde se ha procesado la carpeta para la sincronización incremental
+    try:
+        advance_sync_state(TICKETS_FOLDER_ID, files, run_stats['failed_files'])
+    except Exception as e:
+        logging.warning(f"No se pudo guardar el estado de sincronización: {e}")
     
     # Mostrar estadísticas
     logging.info(f"Procesamiento completado.")
     logging.info(f"Total de archivos: {total_files}")
-    logging.info(f"Archivos procesados: {processed_files}")
-    logging.info(f"Archivos omitidos: {skipped_files}")
+    logging.info(f"Archivos procesados: {run_stats['processed']}")
+    logging.info(f"Archivos omitidos: {run_stats['skipped']}")
+    if run_stats['near_duplicates']:
+        logging.info(f"Casi duplicados omitidos: {run_stats['near_duplicates']} (ver {NEAR_DUPLICATES_LOG_PATH})")
+    if run_stats['resumed']:
+        logging.info(f"Archivos reanudados desde el diario: {run_stats['resumed']}")
+    if run_stats['dead_letters']:
+        logging.warning(f"Archivos que pasan a descartados: {run_stats['dead_letters']} "
+                        f"(ver python assistant_goupbi.py --dead-letters)")
+    log_latencies(run_stats['latencies'])
+    report_extractor_stats()
+    report_merchant_memo_savings()
+    report_multi_receipt_usage()
+    write_metrics()
+    write_run_report(run_stats)
     
-    return processed_files
+    return run_stats
+
+def process_tickets(days_threshold=7, max_workers=None, rebuild_index=False, incremental=False,
+                    rebuild_aggregates=False, rebuild_merchants=False):
+    """
+    Procesa los tickets de imágenes en la carpeta de origen que fueron creados/modificados
+    en los últimos days_threshold días.
+    
+    1. Extrae datos estructurados usando OpenAI
+    2. Guarda la información en la hoja de Google Sheets (por lotes)
+    3. Guarda la información en un CSV local
+    4. Copia el archivo a la carpeta de destino
+    
+    Cada etapa completada se anota en el diario de trabajos: un archivo interrumpido en una
+    ejecución anterior continúa desde su última etapa, y los que fallan se reintentan con
+    espera creciente hasta pasar a descartados.
+    
+    Las descargas y las llamadas a OpenAI se reparten entre max_workers hilos; las escrituras
+    en Google Sheets, en el CSV y la copia en Drive se hacen desde el hilo principal, en el
+    mismo orden en que se listaron los archivos. Solo se escriben en el CSV las filas que
+    Google Sheets confirma, para que ambos registros no se desincronicen.
+    
+    :param days_threshold: Número de días hacia atrás para considerar
+    :param max_workers: Número de hilos para descarga y extracción (por defecto MAX_WORKERS)
+    :param rebuild_index: Reconstruir el índice de procesados antes de empezar
+    :param incremental: Buscar solo archivos nuevos desde la ejecución anterior
+    :param rebuild_aggregates: Recalcular los agregados del dashboard antes de empezar
+    :param rebuild_merchants: Reconstruir la tabla negocio -> categoría antes de empezar
+    """
+    prepare_run(rebuild_index=rebuild_index, rebuild_aggregates=rebuild_aggregates,
+                rebuild_merchants=rebuild_merchants)
+    
+    # Obtener archivos recientes
+    files = get_new_files(TICKETS_FOLDER_ID, days_threshold, incremental=incremental)
+    try:
+        run_stats = process_files(files, max_workers)
+    finally:
+        shutdown_image_pool()
+    return run_stats['processed'] if run_stats else 0
 
 # ================================
 # Punto de entrada principal
 # ================================
+def parse_args():
+    """
+    Lee los argumentos de la línea de comandos.
+    """
+    parser = argparse.ArgumentParser(description="Procesa tickets de gastos desde Google Drive.")
+    parser.add_argument('--days', type=int, default=7,
+                        help="Número de días hacia atrás para buscar tickets (por defecto 7)")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help=f"Hilos para descarga y extracción en paralelo (por defecto {MAX_WORKERS})")
+    parser.add_argument('--multi', type=int, default=MULTI_RECEIPT_SIZE,
+                        help=f"Tickets por petición a OpenAI (por defecto {MULTI_RECEIPT_SIZE}; no pasa de --workers)")
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help="Reconstruir el índice de procesados desde el CSV, Sheets y Drive")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Buscar solo los archivos nuevos desde la ejecución anterior")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="Vaciar la caché de extracciones antes de procesar")
+    parser.add_argument('--rebuild-aggregates', action='store_true',
+                        help="Recalcular los agregados del dashboard desde los gastos guardados")
+    parser.add_argument('--rebuild-merchants', action='store_true',
+                        help="Reconstruir la tabla negocio -> categoría desde Google Sheets y los gastos locales")
+    parser.add_argument('--dead-letters', action='store_true',
+                        help="Mostrar los archivos descartados por fallar repetidamente y salir")
+    parser.add_argument('--retry-dead', action='store_true',
+                        help="Volver a intentar los archivos descartados en esta ejecución")
+    parser.add_argument('--near-duplicates', action='store_true',
+                        help="Mostrar los tickets omitidos por casi duplicados y salir")
+    parser.add_argument('--keep-duplicate', action='append', metavar='ARCHIVO',
+                        help="Guardar en esta ejecución un ticket omitido por casi duplicado (se puede repetir)")
+    parser.add_argument('--index-phash', action='store_true',
+                        help="Calcular el hash perceptual de los tickets ya procesados y salir")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
+    MULTI_RECEIPT_SIZE = max(1, args.multi)
+    
+    if args.clear_cache:
+        extraction_cache.clear()
+    
+    if args.index_phash:
+        index_processed_images(args.workers)
+        raise SystemExit(0)
+    
+    if args.dead_letters:
+        for job in job_journal.dead_letters():
+            print(f"{job['file']['name']} ({job['file']['id']}): {job['attempts']} fallos, "
+                  f"etapa completada: {job['stage'] or 'ninguna'}, último error: {job['last_error']}")
+        raise SystemExit(0)
+    
+    if args.near_duplicates:
+        for entry in skipped_near_duplicates():
+            datos = entry['datos']
+            print(f"{entry['archivo']} ({entry['fecha']}): igual que {entry['coincide_con']} "
+                  f"(distancia {entry['distancia']}), {datos.get('fecha')} {datos.get('importe')} {datos.get('negocio')}")
+        raise SystemExit(0)
+    
+    for file_name in args.keep_duplicate or []:
+        if keep_near_duplicate(file_name):
+            logging.info(f"El archivo {file_name} se guardará en esta ejecución con los datos ya extraídos.")
+        else:
+            logging.warning(f"El archivo {file_name} no está entre los casi duplicados omitidos.")
+    
+    if args.retry_dead:
+        logging.info(f"Archivos descartados que se vuelven a intentar: {job_journal.retry_dead()}")
+    
     logging.info("=== Iniciando el sistema de procesamiento de tickets ===")
     logging.info(f"Carpeta de tickets origen: {TICKETS_FOLDER_ID}")
     logging.info(f"Carpeta de tickets destino: {TICKETS_CARGADOS_FOLDER_ID}")
     logging.info(f"Archivo CSV local: {CSV_FILE_PATH}")
     
-    # Procesar tickets de los últimos 7 días (puedes ajustar este valor)
-    processed_count = process_tickets(days_threshold=7)
+    # Procesar tickets de los últimos días indicados (7 por defecto)
+    processed_count = process_tickets(days_threshold=args.days, max_workers=args.workers,
+                                      rebuild_index=args.rebuild_index, incremental=args.incremental,
+                                      rebuild_aggregates=args.rebuild_aggregates,
+                                      rebuild_merchants=args.rebuild_merchants)
     
     if processed_count > 0:
         logging.info(f"Se procesaron {processed_count} tickets correctamente.")
     else:
         logging.info("No se procesaron tickets nuevos.")
     
-    logging.info("=== Procesamiento finalizado ===")
\ No newline at end of file
+    logging.info("=== Procesamiento finalizado ===")
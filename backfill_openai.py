@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import logging
+import argparse
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import assistant_goupbi as app
+from cache_extracciones import content_hash
+
+# ================================
+# Carga histórica (backfill) con la Batch API de OpenAI
+# ================================
+# Flujo: preparar archivos JSONL con una petición por ticket -> subirlos y crear los lotes ->
+# esperar a que terminen -> ingerir los resultados por el mismo camino que process_tickets
+# (Google Sheets por lotes, CSV, índice y copia en Drive).
+#
+# Todo el estado se guarda en BACKFILL_STATE_PATH tras cada paso, así que si el proceso se
+# reinicia con lotes en curso, la siguiente ejecución retoma la espera y la ingesta sin volver
+# a descargar ni a enviar nada. Durante la preparación cada archivo JSONL se sube en cuanto se
+# completa: tras un reinicio solo se descargan los tickets que no estaban en ninguno.
+
+BACKFILL_DIR = os.path.join(app.STATE_DIR, "backfill")
+BACKFILL_STATE_PATH = os.path.join(BACKFILL_DIR, "estado.json")
+
+# Límites de la Batch API: 50.000 peticiones y 200 MB por archivo de entrada
+MAX_BATCH_REQUESTS = 50000
+DEFAULT_MAX_BATCH_MB = 100
+
+# Descargas en curso o terminadas sin escribir, por hilo: cada una guarda la imagen en base64, así
+# que mientras se sube un lote no se acumulan más de PREPARE_WINDOW_PER_WORKER * MAX_WORKERS
+PREPARE_WINDOW_PER_WORKER = 4
+
+# Estados finales de un lote en OpenAI
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+def load_state():
+    """
+    Lee el estado del backfill en curso.
+
+    :return: Diccionario con el estado o None si no hay ninguno en curso
+    """
+    try:
+        with open(BACKFILL_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_state(state):
+    """
+    Guarda el estado del backfill de forma atómica (archivo temporal + rename).
+    """
+    os.makedirs(BACKFILL_DIR, exist_ok=True)
+    tmp_path = BACKFILL_STATE_PATH + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, BACKFILL_STATE_PATH)
+
+def archive_state(state):
+    """
+    Mueve el estado terminado a un archivo con fecha para que la siguiente ejecución empiece de cero
+    y borra los archivos JSONL de entrada.
+    """
+    archived_path = os.path.join(BACKFILL_DIR, f"estado-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    # Los archivos JSONL de entrada pueden ocupar cientos de MB y ya no se necesitan
+    for batch in state['batches']:
+        try:
+            os.remove(batch['jsonl_path'])
+        except FileNotFoundError:
+            pass
+    save_state(state)
+    os.replace(BACKFILL_STATE_PATH, archived_path)
+    logging.info(f"Backfill terminado. Estado archivado en {archived_path}")
+
+# ================================
+# Paso 1: preparar los archivos JSONL
+# ================================
+def _prepare_request(file):
+    """
+    Descarga y preprocesa un ticket. Si su contenido ya está en la caché de extracciones,
+    devuelve los datos directamente en lugar de la petición.
+
+    :return: Tupla (hash, datos en caché o None, línea JSONL o None)
+    """
+    file_bytes = app.download_file(file['id'])
+    if not file_bytes:
+        return None, None, None
+
+    image_data = file_bytes.getvalue()
+    image_hash = content_hash(image_data)
+    cached = app.extraction_cache.get(image_hash)
+    if cached is not None:
+        return image_hash, cached, None
+
+    send_data, mime_type = app.prepare_image(image_data)
+    line = json.dumps({
+        "custom_id": file['id'],
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": app.build_extraction_payload(send_data, mime_type)
+    })
+    return image_hash, None, line
+
+def new_state():
+    """
+    :return: Estado vacío de un backfill que empieza
+    """
+    return {'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'prepared': False, 'batches': []}
+
+def _close_batch(state, batch, handle):
+    """
+    Cierra el archivo JSONL de un lote, guarda el estado y lo sube a OpenAI.
+    """
+    handle.close()
+    batch['status'] = 'prepared'
+    save_state(state)
+    submit(batch)
+    save_state(state)
+
+def _map_bounded(executor, function, items, window):
+    """
+    Como executor.map, pero con como mucho window tareas enviadas sin recoger su resultado.
+
+    :return: Generador de (elemento, resultado) en el orden de items
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            done_item, future = pending.popleft()
+            yield done_item, future.result()
+        pending.append((item, executor.submit(function, item)))
+    while pending:
+        done_item, future = pending.popleft()
+        yield done_item, future.result()
+
+def prepare(files, sheet_writer, max_batch_bytes, state=None):
+    """
+    Genera los archivos JSONL de entrada, repartiendo las peticiones en varios lotes si se
+    superan los límites de la Batch API, y sube cada lote en cuanto se completa. Los tickets
+    que ya están en la caché se ingieren directamente.
+
+    :param files: Archivos de Drive a procesar
+    :param sheet_writer: Escritor de Google Sheets para los resultados en caché
+    :param max_batch_bytes: Tamaño máximo de cada archivo JSONL
+    :param state: Estado de una preparación interrumpida que continuar (por defecto, uno nuevo)
+    :return: Estado del backfill
+    """
+    os.makedirs(BACKFILL_DIR, exist_ok=True)
+    state = state or new_state()
+    batch, handle, size = None, None, 0
+
+    workers = max(1, app.MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        prepared = _map_bounded(executor, _prepare_request, files, PREPARE_WINDOW_PER_WORKER * workers)
+        for file, (image_hash, cached, line) in prepared:
+            sheet_writer.flush_if_due()
+            if image_hash is None:
+                logging.error(f"No se pudo descargar el archivo {file['name']}. Omitiendo.")
+                continue
+            if cached is not None:
+                logging.info(f"Datos de {file['name']} obtenidos de la caché.")
+                app.queue_result(sheet_writer, file, cached)
+                continue
+
+            line_bytes = len(line.encode('utf-8')) + 1
+            if batch is None or size + line_bytes > max_batch_bytes or len(batch['files']) >= MAX_BATCH_REQUESTS:
+                if handle:
+                    _close_batch(state, batch, handle)
+                batch = {
+                    'jsonl_path': os.path.join(BACKFILL_DIR, f"lote-{len(state['batches']) + 1:03d}.jsonl"),
+                    'status': 'preparing',
+                    'files': {}
+                }
+                state['batches'].append(batch)
+                handle = open(batch['jsonl_path'], 'w', encoding='utf-8')
+                size = 0
+
+            handle.write(line + "\n")
+            size += line_bytes
+            batch['files'][file['id']] = {'name': file['name'], 'hash': image_hash}
+
+    if handle:
+        _close_batch(state, batch, handle)
+    state['prepared'] = True
+    save_state(state)
+    total = sum(len(b['files']) for b in state['batches'])
+    logging.info(f"Preparadas {total} peticiones en {len(state['batches'])} lote(s).")
+    return state
+
+def resume_prepare(state, days_threshold, sheet_writer, max_batch_bytes):
+    """
+    Continúa una preparación interrumpida: descarta el lote que se estaba escribiendo (su
+    archivo JSONL puede estar a medias) y prepara los tickets que no estaban en ningún lote.
+    """
+    for batch in [b for b in state['batches'] if b['status'] == 'preparing']:
+        try:
+            os.remove(batch['jsonl_path'])
+        except FileNotFoundError:
+            pass
+        state['batches'].remove(batch)
+    queued = {file_id for batch in state['batches'] for file_id in batch['files']}
+    files = app.get_files_by_creation_date(app.TICKETS_FOLDER_ID, days_threshold)
+    files = [f for f in files
+             if f['id'] not in queued and not app.is_file_already_processed(f['name'], f['id'])]
+    logging.info(f"Preparación interrumpida: {len(queued)} tickets ya enviados, {len(files)} pendientes.")
+    return prepare(files, sheet_writer, max_batch_bytes, state)
+
+# ================================
+# Paso 2: subir y crear los lotes
+# ================================
+def submit(batch):
+    """
+    Sube el archivo JSONL de un lote y crea el lote en OpenAI.
+    """
+    client = app.openai_client
+    if not batch.get('input_file_id'):
+        # Se lee entero para que un reintento vuelva a enviar el contenido completo
+        with open(batch['jsonl_path'], 'rb') as f:
+            content = f.read()
+        response = client.request('POST', '/files', data={'purpose': 'batch'},
+                                  files={'file': (os.path.basename(batch['jsonl_path']), content, 'application/jsonl')})
+        response.raise_for_status()
+        batch['input_file_id'] = response.json()['id']
+
+    response = client.post_json('/batches', {
+        'input_file_id': batch['input_file_id'],
+        'endpoint': '/v1/chat/completions',
+        'completion_window': '24h'
+    })
+    response.raise_for_status()
+    batch['batch_id'] = response.json()['id']
+    batch['status'] = 'submitted'
+    logging.info(f"Lote {batch['batch_id']} enviado con {len(batch['files'])} peticiones.")
+
+# ================================
+# Paso 3: esperar a que terminen
+# ================================
+def poll(batch, poll_interval):
+    """
+    Consulta el estado de un lote hasta que llega a un estado final.
+    """
+    while True:
+        response = app.openai_client.request('GET', f"/batches/{batch['batch_id']}")
+        response.raise_for_status()
+        info = response.json()
+        batch['output_file_id'] = info.get('output_file_id')
+        batch['error_file_id'] = info.get('error_file_id')
+        counts = info.get('request_counts') or {}
+        logging.info(f"Lote {batch['batch_id']}: {info['status']} "
+                     f"({counts.get('completed', 0)}/{counts.get('total', len(batch['files']))} completadas)")
+        if info['status'] in TERMINAL_STATUSES:
+            batch['status'] = info['status']
+            return
+        time.sleep(poll_interval)
+
+# ================================
+# Paso 4: ingerir los resultados
+# ================================
+def ingest(batch, sheet_writer):
+    """
+    Descarga los resultados de un lote y los guarda por el mismo camino que process_tickets.
+    Los archivos ya presentes en el índice (por ejemplo, si se reinició a mitad de la ingesta)
+    se omiten.
+    """
+    results = {}
+    if batch.get('output_file_id'):
+        response = app.openai_client.request('GET', f"/files/{batch['output_file_id']}/content")
+        response.raise_for_status()
+        for line in response.text.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                results[result['custom_id']] = result
+
+    failed = 0
+    # Recorrer en el orden original, no en el de la salida de OpenAI
+    for file_id, info in batch['files'].items():
+        file = {'id': file_id, 'name': info['name']}
+        if app.is_file_already_processed(file['name'], file_id):
+            continue
+
+        result = results.get(file_id)
+        response = (result or {}).get('response') or {}
+        datos = None
+        if response.get('status_code') == 200:
+            try:
+                datos = app.parse_extraction_response(response['body'])
+            except (KeyError, IndexError, TypeError) as e:
+                logging.error(f"Respuesta inesperada para {file['name']}: {e}")
+            # La Batch API no mide la duración de cada petición: solo se anotan los tokens
+            app.record_api_call('lote', 0.0, response.get('body', {}).get('usage'), failed=datos is None)
+        if not datos:
+            logging.error(f"No se pudieron extraer datos del archivo {file['name']} en el lote.")
+            failed += 1
+            continue
+
+        app.extraction_cache.put(info['hash'], datos)
+        app.queue_result(sheet_writer, file, datos)
+
+    sheet_writer.flush()
+    batch['status'] = 'ingested'
+    batch['failed'] = failed
+    logging.info(f"Lote {batch.get('batch_id')} ingerido ({failed} peticiones sin resultado).")
+
+# ================================
+# Ejecución completa (reanudable)
+# ================================
+def run_backfill(days_threshold=3650, poll_interval=60, max_batch_mb=DEFAULT_MAX_BATCH_MB):
+    """
+    Ejecuta el backfill de principio a fin, o retoma el que esté en curso.
+
+    :param days_threshold: Antigüedad máxima de los tickets a cargar (en días)
+    :param poll_interval: Segundos entre consultas del estado de los lotes
+    :param max_batch_mb: Tamaño máximo de cada archivo JSONL en MB
+    :return: Contadores de la ejecución (ver assistant_goupbi.new_run_stats)
+    """
+    app.verify_sheet_structure()
+    app.load_expense_store()
+    app.load_processed_index()
+    app.load_aggregates()
+    app.load_merchant_memo()
+    run_stats = app.new_run_stats()
+    sheet_writer = app.create_sheet_writer(run_stats)
+
+    state = load_state()
+    if state and not state.get('prepared', True):
+        logging.info(f"Retomando la preparación del backfill iniciado el {state['created_at']}.")
+        state = resume_prepare(state, days_threshold, sheet_writer, max_batch_mb * 1024 * 1024)
+        sheet_writer.flush()
+    elif state:
+        logging.info(f"Retomando backfill iniciado el {state['created_at']}.")
+    else:
+        files = app.get_files_by_creation_date(app.TICKETS_FOLDER_ID, days_threshold)
+        files = [f for f in files if not app.is_file_already_processed(f['name'], f['id'])]
+        if not files:
+            logging.info("No hay tickets pendientes para el backfill.")
+            return run_stats
+        state = prepare(files, sheet_writer, max_batch_mb * 1024 * 1024)
+        sheet_writer.flush()
+
+    for batch in state['batches']:
+        if batch['status'] == 'prepared':
+            submit(batch)
+            save_state(state)
+
+    for batch in state['batches']:
+        if batch['status'] == 'submitted':
+            poll(batch, poll_interval)
+            save_state(state)
+        if batch['status'] in TERMINAL_STATUSES:
+            ingest(batch, sheet_writer)
+            save_state(state)
+
+    archive_state(state)
+    usage = app.api_usage.get('lote')
+    if usage:
+        logging.info(f"Tokens de los lotes: {usage['tokens']} en {usage['llamadas']} peticiones.")
+    app.shutdown_image_pool()
+    app.finish_local_storage()
+    app.write_dashboard_snapshot()
+    logging.info(f"Backfill completado: {run_stats['processed']} tickets procesados, "
+                 f"{run_stats['skipped']} omitidos.")
+    return run_stats
+
+def print_status():
+    """
+    Muestra el estado del backfill en curso.
+    """
+    state = load_state()
+    if not state:
+        print("No hay ningún backfill en curso.")
+        return
+    print(f"Backfill iniciado el {state['created_at']}")
+    for batch in state['batches']:
+        print(f"  {os.path.basename(batch['jsonl_path'])}: {batch['status']} "
+              f"({len(batch['files'])} peticiones, lote {batch.get('batch_id') or '-'})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga histórica de tickets con la Batch API de OpenAI.")
+    parser.add_argument('--days', type=int, default=3650,
+                        help="Antigüedad máxima de los tickets a cargar (por defecto 3650 días)")
+    parser.add_argument('--poll-interval', type=int, default=60,
+                        help="Segundos entre consultas del estado de los lotes (por defecto 60)")
+    parser.add_argument('--max-batch-mb', type=int, default=DEFAULT_MAX_BATCH_MB,
+                        help=f"Tamaño máximo de cada archivo de lote en MB (por defecto {DEFAULT_MAX_BATCH_MB})")
+    parser.add_argument('--status', action='store_true', help="Mostrar el estado del backfill en curso y salir")
+    args = parser.parse_args()
+
+    if args.status:
+        print_status()
+    else:
+        run_backfill(args.days, args.poll_interval, args.max_batch_mb)
@@ -0,0 +1,149 @@
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from analisis_datos import analyze_data
+
+# ================================
+# Benchmark de analisis_datos.analyze_data
+# ================================
+# Genera gastos sintéticos reproducibles (misma semilla = mismos datos) y mide el tiempo
+# y el pico de memoria de analyze_data para cada tamaño. Los resultados se pueden guardar
+# en JSON y comparar con una ejecución anterior para detectar regresiones.
+
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+
+CATEGORIES = ['Suscripciones', 'Salud', 'Vivienda', 'Movilidad', 'Educación',
+              'Alimentos', 'Salidas', 'Gastos extraordinarios']
+PAYMENT_METHODS = ['Tarjeta', 'Efectivo', 'Transferencia', 'Bizum', 'Desconocido']
+
+def generate_expenses(rows, seed=42, businesses=500, years=5):
+    """
+    Genera un DataFrame de gastos sintéticos con las columnas que espera analyze_data.
+
+    :param rows: Número de filas
+    :param seed: Semilla del generador aleatorio
+    :param businesses: Número de negocios distintos
+    :param years: Años de histórico que cubren las fechas
+    :return: DataFrame de pandas
+    """
+    rng = np.random.default_rng(seed)
+    business_names = np.array([f"Negocio {i:04d}" for i in range(businesses)], dtype=object)
+    descriptions = np.array([f"Compra {i:03d}" for i in range(200)], dtype=object)
+
+    start = np.datetime64('2020-01-01')
+    return pd.DataFrame({
+        'Fecha': start + rng.integers(0, 365 * years, rows).astype('timedelta64[D]'),
+        # Importes con cola larga, como los tickets reales (muchos pequeños, pocos grandes)
+        'importe': np.round(rng.lognormal(mean=3.0, sigma=1.1, size=rows), 2),
+        # Negocios con popularidad desigual (Zipf) para que el top 10 sea significativo
+        'empresa': business_names[np.minimum(rng.zipf(1.3, rows), businesses) - 1],
+        'categoria': np.array(CATEGORIES, dtype=object)[rng.integers(0, len(CATEGORIES), rows)],
+        'forma_pago': np.array(PAYMENT_METHODS, dtype=object)[rng.integers(0, len(PAYMENT_METHODS), rows)],
+        'descripcion': descriptions[rng.integers(0, len(descriptions), rows)],
+    })
+
+def measure(df, repeat=3):
+    """
+    Mide analyze_data sobre un DataFrame.
+
+    :param df: DataFrame de entrada
+    :param repeat: Repeticiones para el tiempo (se toma la mejor)
+    :return: Diccionario con tiempos (s) y pico de memoria (MB)
+    """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        analyze_data(df)
+        timings.append(time.perf_counter() - start)
+
+    # La memoria se mide en una pasada aparte: tracemalloc ralentiza la ejecución
+    gc.collect()
+    tracemalloc.start()
+    analyze_data(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'best_seconds': round(min(timings), 4),
+        'median_seconds': round(float(np.median(timings)), 4),
+        'peak_memory_mb': round(peak / 1024 / 1024, 1),
+    }
+
+def run_benchmark(sizes=None, repeat=3, seed=42):
+    """
+    Ejecuta el benchmark para cada tamaño.
+
+    :return: Diccionario con el entorno y los resultados por tamaño
+    """
+    results = {
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'seed': seed,
+        'sizes': {}
+    }
+    for rows in sizes or DEFAULT_SIZES:
+        df = generate_expenses(rows, seed=seed)
+        input_mb = df.memory_usage(deep=False).sum() / 1024 / 1024
+        result = measure(df, repeat=repeat)
+        result['input_memory_mb'] = round(input_mb, 1)
+        results['sizes'][str(rows)] = result
+        print(f"{rows:>12,} filas: {result['best_seconds']:.4f}s (mediana {result['median_seconds']:.4f}s), "
+              f"pico {result['peak_memory_mb']:.1f} MB (entrada {input_mb:.1f} MB)")
+        del df
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compara los resultados con una ejecución anterior.
+
+    :param tolerance: Empeoramiento relativo permitido (0.2 = 20%)
+    :return: Lista de regresiones encontradas (vacía si no hay)
+    """
+    regressions = []
+    for rows, current in results['sizes'].items():
+        previous = baseline.get('sizes', {}).get(rows)
+        if not previous:
+            continue
+        for metric in ('best_seconds', 'peak_memory_mb'):
+            if previous[metric] and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{int(rows):,} filas: {metric} {previous[metric]} -> {current[metric]}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de analyze_data con gastos sintéticos.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Número de filas de cada prueba (por defecto 10k, 1M y 10M)")
+    parser.add_argument('--repeat', type=int, default=3, help="Repeticiones por tamaño (por defecto 3)")
+    parser.add_argument('--seed', type=int, default=42, help="Semilla de los datos sintéticos")
+    parser.add_argument('--output', help="Guardar los resultados en este archivo JSON")
+    parser.add_argument('--baseline', help="Comparar con los resultados de un JSON anterior")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Empeoramiento relativo permitido frente a la referencia (por defecto 0.2)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, repeat=args.repeat, seed=args.seed)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regresiones detectadas:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            raise SystemExit(1)
+        print("Sin regresiones respecto a la referencia.")
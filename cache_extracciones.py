@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# ================================
+# Caché de extracciones por contenido
+# ================================
+def content_hash(data):
+    """
+    Calcula el hash SHA-256 de los bytes de una imagen.
+
+    :param data: Bytes del archivo descargado
+    :return: Hash en hexadecimal
+    """
+    return hashlib.sha256(data).hexdigest()
+
+def extraction_fingerprint(*parts):
+    """
+    Huella del modelo y del prompt usados para extraer. Si cualquiera cambia,
+    la huella cambia y las entradas anteriores dejan de ser válidas.
+    """
+    return hashlib.sha256("\x00".join(str(p) for p in parts).encode('utf-8')).hexdigest()[:16]
+
+class ExtractionCache:
+    """
+    Caché persistente (SQLite) de los datos extraídos de cada ticket, indexada por el hash
+    de los bytes de la imagen. Evita pagar dos veces por el mismo recibo subido con otro nombre.
+
+    Las entradas caducan por antigüedad (max_age_days) y, si se supera max_entries,
+    se eliminan las usadas hace más tiempo.
+    """
+
+    def __init__(self, db_path, fingerprint, max_entries=5000, max_age_days=180):
+        """
+        :param db_path: Ruta al archivo SQLite de la caché
+        :param fingerprint: Huella del modelo y prompt actuales (ver extraction_fingerprint)
+        :param max_entries: Número máximo de entradas a conservar
+        :param max_age_days: Antigüedad máxima de una entrada en días
+        """
+        self.db_path = db_path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS extractions ("
+                    " content_hash TEXT PRIMARY KEY,"
+                    " fingerprint TEXT NOT NULL,"
+                    " datos TEXT NOT NULL,"
+                    " created_at REAL NOT NULL,"
+                    " last_used_at REAL NOT NULL)"
+                )
+                # Las entradas de otro modelo/prompt ya no sirven
+                deleted = self._conn.execute(
+                    "DELETE FROM extractions WHERE fingerprint != ?", (self.fingerprint,)
+                ).rowcount
+            if deleted:
+                logging.info(f"Caché de extracciones: {deleted} entradas invalidadas por cambio de modelo o prompt.")
+        return self._conn
+
+    def get(self, key):
+        """
+        Devuelve los datos extraídos para un hash de contenido, o None si no están en caché.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT datos, created_at FROM extractions WHERE content_hash = ? AND fingerprint = ?",
+                (key, self.fingerprint)
+            ).fetchone()
+            if row is None:
+                return None
+            datos, created_at = row
+            with conn:
+                if now - created_at > self.max_age:
+                    conn.execute("DELETE FROM extractions WHERE content_hash = ?", (key,))
+                    return None
+                conn.execute("UPDATE extractions SET last_used_at = ? WHERE content_hash = ?", (now, key))
+        return json.loads(datos)
+
+    def put(self, key, datos):
+        """
+        Guarda los datos extraídos para un hash de contenido y aplica la política de expulsión.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extractions (content_hash, fingerprint, datos, created_at, last_used_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (key, self.fingerprint, json.dumps(datos, ensure_ascii=False), now, now)
+                )
+                self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM extractions WHERE created_at < ?", (now - self.max_age,))
+        conn.execute(
+            "DELETE FROM extractions WHERE content_hash IN ("
+            " SELECT content_hash FROM extractions ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def clear(self):
+        """
+        Vacía la caché por completo.
+
+        :return: Número de entradas eliminadas
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                deleted = conn.execute("DELETE FROM extractions").rowcount
+        logging.info(f"Caché de extracciones vaciada: {deleted} entradas eliminadas.")
+        return deleted
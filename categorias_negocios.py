@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import difflib
+import logging
+import argparse
+import threading
+
+from formatos_gastos import merchant_key
+
+# ================================
+# Memoria negocio -> categoría aprendida del histórico
+# ================================
+# La mayoría de los tickets vienen de unas pocas decenas de negocios cuya categoría no cambia.
+# Esta tabla cuenta, para cada negocio (con el nombre normalizado: sin tildes, mayúsculas,
+# signos ni forma jurídica final como S.A. o S.L.), cuántas veces se ha guardado con cada
+# categoría. Un negocio es "conocido" cuando se ha visto al menos MIN_COUNT veces y casi
+# siempre con la misma categoría; para esos la categoría se asigna en local en lugar de
+# pedírsela al modelo. Los nombres que no coinciden exactamente se buscan entre los negocios
+# conocidos por prefijo ('alcampo plaza del toro' -> 'alcampo') y después por similitud (difflib).
+#
+# El mismo archivo guarda el consumo medio (tokens y segundos) de cada tipo de extracción, para
+# poder estimar lo que ahorra el prompt corto frente al completo.
+
+CATEGORIES = ['Suscripciones', 'Salud', 'Vivienda', 'Movilidad', 'Educación',
+              'Alimentos', 'Salidas', 'Gastos extraordinarios']
+
+# Veces que hay que haber visto un negocio para fiarse de su categoría
+MIN_COUNT = 2
+# Fracción mínima de sus gastos que tienen que estar en la categoría más frecuente
+MIN_SHARE = 0.9
+# Similitud mínima (0-1) entre nombres normalizados para considerarlos el mismo negocio
+MATCH_CUTOFF = 0.88
+
+# Formas jurídicas que se quitan del final del nombre normalizado ('mercadona s a' -> 'mercadona')
+_LEGAL_SUFFIX = re.compile(r'(\s+(s ?a ?u?|s ?l ?[lu]?|s ?c ?p|c ?b|sociedad (anonima|limitada)))+$')
+
+def memo_key(name):
+    """
+    Clave de un negocio en la tabla: merchant_key sin la forma jurídica final.
+    """
+    key = merchant_key(name) if name else ''
+    return _LEGAL_SUFFIX.sub('', key) or key
+
+def _empty_state():
+    return {'version': 1, 'negocios': {}, 'consumo': {}}
+
+def _valid_category(category):
+    return isinstance(category, str) and category.strip() in CATEGORIES
+
+class MerchantCategoryMemo:
+    """
+    Tabla persistente negocio -> recuento por categoría, con búsqueda exacta y aproximada.
+    """
+
+    def __init__(self, path, min_count=MIN_COUNT, min_share=MIN_SHARE, match_cutoff=MATCH_CUTOFF):
+        """
+        :param path: Ruta del JSON donde se guarda la tabla
+        :param min_count: Veces que hay que haber visto un negocio para considerarlo conocido
+        :param min_share: Fracción mínima de sus gastos en la categoría más frecuente
+        :param match_cutoff: Similitud mínima para la búsqueda aproximada
+        """
+        self.path = path
+        self.min_count = min_count
+        self.min_share = min_share
+        self.match_cutoff = match_cutoff
+        self._lock = threading.Lock()
+        self.state = _empty_state()
+        self._known = None
+        self._matches = {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """
+        Carga la tabla desde disco.
+
+        :return: Número de negocios conocidos
+        """
+        with self._lock:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except FileNotFoundError:
+                self.state = _empty_state()
+            self._invalidate()
+        return len(self)
+
+    def save(self):
+        """
+        Guarda la tabla de forma atómica (archivo temporal + rename).
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def _invalidate(self):
+        self._known = None
+        self._matches = {}
+
+    def add(self, merchant, category):
+        """
+        Anota un gasto guardado.
+
+        :param merchant: Nombre del negocio tal como aparece en el ticket
+        :param category: Categoría con la que se guardó
+        :return: True si se anotó, False si el negocio o la categoría no son válidos
+        """
+        key = memo_key(merchant)
+        if not key or not _valid_category(category):
+            return False
+        with self._lock:
+            entry = self.state['negocios'].setdefault(key, {'nombre': str(merchant).strip(), 'categorias': {}})
+            categories = entry['categorias']
+            categories[category.strip()] = categories.get(category.strip(), 0) + 1
+            self._invalidate()
+        return True
+
+    def rebuild(self, rows):
+        """
+        Recalcula la tabla desde cero (conservando el consumo medido) y la guarda.
+
+        :param rows: Iterable de tuplas (negocio, categoría)
+        :return: Número de negocios conocidos
+        """
+        with self._lock:
+            self.state = dict(_empty_state(), consumo=self.state.get('consumo', {}))
+            self._invalidate()
+        for merchant, category in rows:
+            self.add(merchant, category)
+        self.save()
+        logging.info(f"Tabla de negocios reconstruida: {len(self.state['negocios'])} negocios, "
+                     f"{len(self)} con categoría conocida ({self.coverage():.0%} de los gastos).")
+        return len(self)
+
+    def _known_categories(self):
+        """
+        Negocios conocidos: {clave: (categoría, nombre)}. Se calcula una vez y se invalida al añadir.
+        """
+        if self._known is None:
+            known = {}
+            for key, entry in self.state['negocios'].items():
+                counts = entry['categorias']
+                total = sum(counts.values())
+                category, count = max(counts.items(), key=lambda item: item[1])
+                if total >= self.min_count and count >= self.min_share * total:
+                    known[key] = (category, entry['nombre'])
+            self._known = known
+        return self._known
+
+    def __len__(self):
+        with self._lock:
+            return len(self._known_categories())
+
+    def coverage(self):
+        """
+        Fracción de los gastos anotados que son de negocios conocidos.
+        """
+        with self._lock:
+            known = self._known_categories()
+            total = covered = 0
+            for key, entry in self.state['negocios'].items():
+                count = sum(entry['categorias'].values())
+                total += count
+                if key in known:
+                    covered += count
+        return covered / total if total else 0.0
+
+    def lookup(self, merchant):
+        """
+        Busca la categoría de un negocio: por nombre normalizado, por prefijo y por similitud.
+
+        :param merchant: Nombre del negocio extraído del ticket
+        :return: Tupla (categoría, nombre del negocio conocido, similitud) o None si no se conoce
+        """
+        key = memo_key(merchant)
+        if not key:
+            return None
+        with self._lock:
+            known = self._known_categories()
+            if key in known:
+                category, name = known[key]
+                return category, name, 1.0
+            if key not in self._matches:
+                self._matches[key] = self._closest(key, known)
+            match = self._matches[key]
+            if match is None:
+                return None
+            category, name = known[match]
+            return category, name, round(difflib.SequenceMatcher(None, key, match).ratio(), 3)
+
+    def _closest(self, key, known):
+        # El negocio conocido más largo cuyo nombre es el principio de este (mismo negocio con
+        # la dirección o el número de tienda detrás) y, si no hay, el más parecido
+        prefixes = [candidate for candidate in known if key.startswith(candidate + ' ')]
+        if prefixes:
+            return max(prefixes, key=len)
+        close = difflib.get_close_matches(key, list(known), n=1, cutoff=self.match_cutoff)
+        return close[0] if close else None
+
+    # ---------- Consumo por tipo de extracción ----------
+    def record_usage(self, path, seconds, prompt_tokens, completion_tokens, failed=False):
+        """
+        Acumula el consumo de una llamada a la API.
+
+        :param path: Tipo de llamada ('completo', 'corto', 'multiple', 'lote' o 'clasificacion')
+        :param seconds: Duración de la llamada
+        :param prompt_tokens: Tokens de entrada (usage.prompt_tokens)
+        :param completion_tokens: Tokens de salida (usage.completion_tokens)
+        :param failed: La respuesta no se pudo interpretar
+        """
+        with self._lock:
+            entry = self.state.setdefault('consumo', {}).setdefault(
+                path, {'llamadas': 0, 'segundos': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0})
+            entry['llamadas'] += 1
+            entry['segundos'] += seconds
+            entry['prompt_tokens'] += prompt_tokens or 0
+            entry['completion_tokens'] += completion_tokens or 0
+            entry['fallos'] = entry.get('fallos', 0) + (1 if failed else 0)
+
+    def average_usage(self, path):
+        """
+        :return: Diccionario con la media de segundos y tokens por llamada y la proporción de
+                 respuestas que no se pudieron interpretar, o None si no hay datos
+        """
+        with self._lock:
+            entry = self.state.get('consumo', {}).get(path)
+            if not entry or not entry['llamadas']:
+                return None
+            calls = entry['llamadas']
+            return {'segundos': entry['segundos'] / calls,
+                    'tokens': (entry['prompt_tokens'] + entry['completion_tokens']) / calls,
+                    'fallos': entry.get('fallos', 0) / calls}
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    state_dir = os.getenv('STATE_DIR', os.path.join(script_dir, ".asistente"))
+
+    parser = argparse.ArgumentParser(description="Consulta la tabla negocio -> categoría aprendida.")
+    parser.add_argument('negocios', nargs='*', help="Nombres de negocio que buscar")
+    args = parser.parse_args()
+
+    memo = MerchantCategoryMemo(os.path.join(state_dir, "negocios_categorias.json"))
+    memo.load()
+    print(f"{len(memo)} negocios conocidos ({memo.coverage():.0%} de los gastos).")
+    for name in args.negocios:
+        found = memo.lookup(name)
+        print(f"{name}: " + (f"{found[0]} (como '{found[1]}', similitud {found[2]})" if found else "desconocido"))
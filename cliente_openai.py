@@ -0,0 +1,228 @@
+import re
+import time
+import logging
+import threading
+
+from reintentos import RETRYABLE_STATUS_CODES, backoff_delay, retry_after_seconds
+
+# ================================
+# Cliente HTTP reutilizable para la API de OpenAI
+# ================================
+# Tokens aproximados que cuesta una imagen en detalle alto (tamaño típico de un ticket)
+IMAGE_TOKEN_ESTIMATE = 765
+
+def parse_reset_duration(value):
+    """
+    Convierte las duraciones de las cabeceras x-ratelimit-reset-* ('1s', '6m0s', '20ms') a segundos.
+
+    :param value: Cadena de la cabecera
+    :return: Segundos (float) o None si no se puede interpretar
+    """
+    if not value:
+        return None
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    factors = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    return sum(float(number) * factors[unit] for number, unit in parts)
+
+def estimate_request_tokens(payload):
+    """
+    Estimación conservadora de los tokens que consumirá una petición de chat
+    (texto del prompt, imágenes y max_tokens de la respuesta).
+    """
+    tokens = payload.get('max_tokens', 0)
+    for message in payload.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                tokens += len(part.get('text', '')) // 4
+            elif part.get('type') == 'image_url':
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+class TokenBucket:
+    """
+    Cubo de tokens thread-safe: se rellena a 'rate' unidades por segundo hasta 'capacity'.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """
+        Bloquea hasta que haya 'amount' unidades disponibles y las consume.
+        Una petición mayor que la capacidad solo espera a tener el cubo lleno.
+        """
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def sync(self, limit=None, remaining=None, reset_seconds=None):
+        """
+        Ajusta el cubo a lo que indica el servidor en las cabeceras de límite de uso.
+
+        :param limit: Límite por minuto
+        :param remaining: Unidades que quedan en la ventana actual
+        :param reset_seconds: Segundos hasta que la ventana se recupera por completo
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if limit:
+                self.capacity = float(limit)
+                self.rate = float(limit) / 60.0
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))
+            if reset_seconds and remaining is not None and self.capacity > remaining:
+                self.rate = max(self.rate, (self.capacity - remaining) / reset_seconds)
+
+    def drain(self):
+        """
+        Vacía el cubo (por ejemplo tras un 429) para que todos los hilos esperen.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = 0.0
+
+class OpenAIClient:
+    """
+    Cliente de la API de OpenAI con una sesión HTTP compartida (conexiones keep-alive en pool),
+    timeouts, reintentos con backoff y jitter ante 429/5xx, y un limitador de peticiones y de
+    tokens por minuto que se sincroniza con las cabeceras x-ratelimit-* de cada respuesta.
+    Es seguro usarlo desde varios hilos.
+    """
+
+    def __init__(self, api_key, base_url='https://api.openai.com/v1', timeout=(10, 120), max_retries=5,
+                 pool_size=10, requests_per_minute=500, tokens_per_minute=30000, metrics=None):
+        """
+        :param api_key: Clave de la API de OpenAI
+        :param base_url: URL base de la API (permite usar un servidor local de pruebas)
+        :param timeout: Tupla (conexión, lectura) en segundos
+        :param max_retries: Reintentos ante errores transitorios
+        :param pool_size: Conexiones simultáneas máximas en el pool
+        :param requests_per_minute: Límite inicial de peticiones por minuto
+        :param tokens_per_minute: Límite inicial de tokens por minuto
+        :param metrics: PipelineMetrics opcional donde contar los reintentos
+        """
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.request_limiter = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.token_limiter = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.metrics = metrics
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        Sesión HTTP compartida. Se crea en la primera petición para no pagar el import de
+        requests ni abrir el pool si la ejecución no llega a llamar a OpenAI.
+        """
+        with self._session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({"Authorization": f"Bearer {self.api_key}"})
+                self._session = session
+            return self._session
+
+    def _update_limits(self, headers):
+        def number(name):
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        self.request_limiter.sync(
+            number('x-ratelimit-limit-requests'),
+            number('x-ratelimit-remaining-requests'),
+            parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+        )
+        self.token_limiter.sync(
+            number('x-ratelimit-limit-tokens'),
+            number('x-ratelimit-remaining-tokens'),
+            parse_reset_duration(headers.get('x-ratelimit-reset-tokens'))
+        )
+
+    def request(self, method, path, estimated_tokens=0, **kwargs):
+        """
+        Realiza una petición a la API respetando los límites de uso y reintentando los
+        errores transitorios.
+
+        :param method: Método HTTP
+        :param path: Ruta relativa a base_url (por ejemplo '/chat/completions')
+        :param estimated_tokens: Tokens que se espera consumir (para el limitador)
+        :return: requests.Response de la última petición
+        """
+        import requests
+
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            self.request_limiter.acquire(1)
+            if estimated_tokens:
+                self.token_limiter.acquire(estimated_tokens)
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning(f"Error de conexión con OpenAI ({e}). Reintentando en {delay:.1f}s.")
+                if self.metrics:
+                    self.metrics.retry('openai')
+                time.sleep(delay)
+                continue
+
+            self._update_limits(response.headers)
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                return response
+
+            delay = retry_after_seconds(response.headers, backoff_delay(attempt))
+            if response.status_code == 429:
+                # Frenar también al resto de hilos hasta que pase la espera
+                self.request_limiter.drain()
+            logging.warning(f"OpenAI respondió {response.status_code}. Reintentando en {delay:.1f}s "
+                            f"(intento {attempt + 1}/{self.max_retries}).")
+            if self.metrics:
+                self.metrics.retry('openai')
+            time.sleep(delay)
+
+    def post_json(self, path, payload):
+        """
+        Envía un POST con cuerpo JSON, estimando los tokens de la petición para el limitador.
+        """
+        return self.request('POST', path, estimated_tokens=estimate_request_tokens(payload), json=payload)
+
+    def close(self):
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
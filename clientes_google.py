@@ -0,0 +1,212 @@
+import os
+import re
+import json
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+
+# ================================
+# Clientes de Google compartidos y con inicialización diferida
+# ================================
+# Las librerías de Google se importan dentro de las funciones: importar este módulo
+# (o los scripts que lo usan) no autentica ni abre conexiones. Todo se crea la primera
+# vez que se usa y se reutiliza durante el resto del proceso.
+
+# Alcance de los permisos necesarios para Sheets y Drive
+SCOPES = ['https://spreadsheets.google.com/feeds',
+          'https://www.googleapis.com/auth/drive']
+
+# Ruta por defecto del archivo de credenciales si no se indica en el .env
+DEFAULT_CREDENTIALS_FILE = "C:/Users/nicol/OneDrive/Desktop/Asistente/credentials.json"
+DEFAULT_SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1_fOKbe6g5dlkRNJl4nWujfcLh7if_5oD4oLBJWPPvJI/edit?usp=drive_link"
+
+# Margen antes de la caducidad a partir del cual un token guardado ya no se reutiliza
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
+class GoogleClients:
+    """
+    Contexto con las credenciales, el cliente de gspread, el servicio de Drive, la hoja de
+    cálculo y la hoja de gastos. Cada elemento se crea al accederlo por primera vez.
+
+    El token OAuth se guarda en disco al terminar el proceso y se reutiliza en la siguiente
+    ejecución mientras no caduque, evitando una ida y vuelta al servidor de autenticación.
+    El documento de descubrimiento de Drive se lee de la copia que incluye
+    google-api-python-client, sin pedirlo por red.
+    """
+
+    def __init__(self, credentials_file, spreadsheet_url, token_cache_path=None, worksheet_title="Gastos"):
+        """
+        :param credentials_file: Ruta al JSON de la cuenta de servicio
+        :param spreadsheet_url: URL de la hoja de cálculo de Google Sheets
+        :param token_cache_path: Ruta donde guardar el token OAuth entre ejecuciones (None = no guardar)
+        :param worksheet_title: Nombre de la hoja de gastos
+        """
+        self.credentials_file = credentials_file
+        self.spreadsheet_url = spreadsheet_url
+        self.token_cache_path = token_cache_path
+        self.worksheet_title = worksheet_title
+        self._lock = threading.RLock()
+        self._thread_local = threading.local()
+        self._creds = None
+        self._client = None
+        self._drive_service = None
+        self._spreadsheet = None
+        self._gastos_sheet = None
+
+    # ---------- Credenciales ----------
+    @property
+    def creds(self):
+        with self._lock:
+            if self._creds is None:
+                from google.oauth2.service_account import Credentials
+
+                if not os.path.exists(self.credentials_file):
+                    logging.error(f"No se encontró el archivo de credenciales en {self.credentials_file}")
+                    logging.error("Por favor, verifica la ubicación del archivo o crea un archivo .env con la ruta correcta")
+                    raise FileNotFoundError(f"No se encontró el archivo de credenciales: {self.credentials_file}")
+
+                logging.info(f"Cargando credenciales desde: {self.credentials_file}")
+                self._creds = Credentials.from_service_account_file(self.credentials_file, scopes=SCOPES)
+                self._load_cached_token()
+                if self.token_cache_path:
+                    atexit.register(self.save_token)
+            return self._creds
+
+    def _load_cached_token(self):
+        if not self.token_cache_path:
+            return
+        try:
+            with open(self.token_cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            expiry = datetime.fromisoformat(cached['expiry'])
+            if cached.get('account') != self._creds.service_account_email:
+                return
+            if expiry - TOKEN_EXPIRY_MARGIN > datetime.utcnow():
+                self._creds.token = cached['token']
+                self._creds.expiry = expiry
+                logging.info("Reutilizando token OAuth guardado.")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"No se pudo leer el token guardado: {e}")
+
+    def save_token(self):
+        """
+        Guarda en disco el token OAuth actual para reutilizarlo en la siguiente ejecución.
+        """
+        creds = self._creds
+        if not self.token_cache_path or creds is None or not creds.token or not creds.expiry:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.token_cache_path), exist_ok=True)
+            tmp_path = self.token_cache_path + ".tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'account': creds.service_account_email,
+                    'token': creds.token,
+                    'expiry': creds.expiry.isoformat()
+                }, f)
+            os.replace(tmp_path, self.token_cache_path)
+        except Exception as e:
+            logging.warning(f"No se pudo guardar el token OAuth: {e}")
+
+    # ---------- Clientes ----------
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import gspread
+
+                self._client = gspread.authorize(self.creds)
+                logging.info("Cliente de Google Sheets inicializado.")
+            return self._client
+
+    def _build_drive_service(self):
+        from googleapiclient.discovery import build
+
+        # Documento de descubrimiento estático (incluido en la librería): no hay petición de red
+        return build('drive', 'v3', credentials=self.creds, cache_discovery=False, static_discovery=True)
+
+    @property
+    def drive_service(self):
+        """
+        Servicio de Drive del hilo actual. httplib2 no es thread-safe, así que cada hilo
+        trabajador tiene su propio servicio con las mismas credenciales.
+        """
+        if threading.current_thread() is threading.main_thread():
+            with self._lock:
+                if self._drive_service is None:
+                    self._drive_service = self._build_drive_service()
+                    logging.info("Servicio de Google Drive inicializado.")
+                return self._drive_service
+        service = getattr(self._thread_local, 'drive_service', None)
+        if service is None:
+            service = self._build_drive_service()
+            self._thread_local.drive_service = service
+        return service
+
+    @property
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                logging.info(f"Intentando abrir hoja de cálculo: {self.spreadsheet_url}")
+                self._spreadsheet = self.client.open_by_url(self.spreadsheet_url)
+                logging.info(f"Acceso a Google Sheets exitoso: {self._spreadsheet.title}")
+            return self._spreadsheet
+
+    @property
+    def spreadsheet_id(self):
+        match = re.search(r'/d/([a-zA-Z0-9-_]+)', self.spreadsheet_url)
+        return match.group(1) if match else None
+
+    @property
+    def gastos_sheet(self):
+        """
+        Hoja de gastos. Si no existe una hoja con el nombre esperado se usa la primera,
+        y si la hoja de cálculo está vacía se crea.
+        """
+        with self._lock:
+            if self._gastos_sheet is None:
+                from gspread.exceptions import WorksheetNotFound
+
+                try:
+                    self._gastos_sheet = self.spreadsheet.worksheet(self.worksheet_title)
+                    logging.info(f"Hoja '{self.worksheet_title}' encontrada")
+                except WorksheetNotFound:
+                    worksheet_list = self.spreadsheet.worksheets()
+                    if worksheet_list:
+                        self._gastos_sheet = worksheet_list[0]
+                        logging.warning(f"No se encontró hoja '{self.worksheet_title}'. "
+                                        f"Usando la primera hoja: {self._gastos_sheet.title}")
+                    else:
+                        self._gastos_sheet = self.spreadsheet.add_worksheet(title=self.worksheet_title, rows=1000, cols=10)
+                        logging.info(f"Creada nueva hoja '{self.worksheet_title}'")
+            return self._gastos_sheet
+
+_clients = None
+_clients_lock = threading.Lock()
+
+def get_google_clients(state_dir=None):
+    """
+    Devuelve el contexto de clientes de Google compartido por todo el proceso.
+    La configuración se lee de las variables de entorno la primera vez que se llama.
+
+    :param state_dir: Carpeta donde guardar el token OAuth entre ejecuciones
+    :return: GoogleClients
+    """
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            credentials_file = os.getenv('GOOGLE_CREDENTIALS_FILE')
+            if not credentials_file or not os.path.exists(credentials_file):
+                # Si no está en el .env o la ruta no existe, usamos la ubicación original
+                credentials_file = DEFAULT_CREDENTIALS_FILE
+                logging.info(f"Usando ruta a credenciales predeterminada: {credentials_file}")
+            _clients = GoogleClients(
+                credentials_file,
+                os.getenv('SPREADSHEET_URL', DEFAULT_SPREADSHEET_URL),
+                token_cache_path=os.path.join(state_dir, "google_token.json") if state_dir else None
+            )
+        return _clients
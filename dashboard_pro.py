@@ -1,12 +1,12 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 import logging
 import os
 import json
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import re
+
+from clientes_google import get_google_clients
+from esquema_gastos import apply_schema, concat_typed
 
 # Configuración del logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,81 +18,36 @@ ENV_FILE = os.path.join(SCRIPT_DIR, ".env")
 # Cargar variables de entorno
 load_dotenv(ENV_FILE)
 
-# ================================
-# Verificar y cargar credenciales
-# ================================
-GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE')
-if not GOOGLE_CREDENTIALS_FILE or not os.path.exists(GOOGLE_CREDENTIALS_FILE):
-    # Si no está en el .env o la ruta no existe, usamos la ubicación original
-    GOOGLE_CREDENTIALS_FILE = "C:/Users/nicol/OneDrive/Desktop/Asistente/credentials.json"
-    logging.info(f"Usando ruta a credenciales predeterminada: {GOOGLE_CREDENTIALS_FILE}")
+# Carpeta para el estado local (compartida con assistant_goupbi)
+STATE_DIR = os.getenv('STATE_DIR', os.path.join(SCRIPT_DIR, ".asistente"))
 
-# Spreadsheet URL
-SPREADSHEET_URL = os.getenv('SPREADSHEET_URL', "https://docs.google.com/spreadsheets/d/1_fOKbe6g5dlkRNJl4nWujfcLh7if_5oD4oLBJWPPvJI/edit?usp=drive_link")
-logging.info(f"URL de la hoja de cálculo: {SPREADSHEET_URL}")
+# Caché local de la hoja de gastos ya convertida a DataFrame
+SHEET_CACHE_DATA_PATH = os.path.join(STATE_DIR, "hoja_gastos.pkl")
+SHEET_CACHE_META_PATH = os.path.join(STATE_DIR, "hoja_gastos.json")
+# Horas tras las que se descarga la hoja completa aunque solo se hayan añadido filas
+# (recoge las ediciones manuales de filas antiguas)
+SHEET_CACHE_FULL_REFRESH_HOURS = float(os.getenv('SHEET_CACHE_FULL_REFRESH_HOURS', '24'))
 
 # ================================
-# Configuración de Google APIs
+# Clientes de Google (se conectan la primera vez que se usan)
 # ================================
-# Define el alcance de los permisos necesarios para Sheets y Drive
-scope = ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-
-try:
-    # Carga y autoriza las credenciales
-    logging.info(f"Intentando cargar credenciales desde: {GOOGLE_CREDENTIALS_FILE}")
-    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS_FILE, scope)
-    client = gspread.authorize(creds)
-    logging.info(f"Autenticación con Google API exitosa")
-except Exception as e:
-    logging.error(f"Error al autenticar con Google API: {e}")
-    raise
-
-try:
-    # Abre el documento de Google Sheets por URL
-    logging.info(f"Intentando abrir hoja de cálculo: {SPREADSHEET_URL}")
-    spreadsheet = client.open_by_url(SPREADSHEET_URL)
-    
-    # Acceder a la hoja de gastos
-    gastos_sheet = spreadsheet.worksheet("Gastos")
-    logging.info("Hoja 'Gastos' encontrada")
-    
-    # Extraer ID de la hoja de cálculo desde la URL
-    try:
-        spreadsheet_id = re.search(r'/d/([a-zA-Z0-9-_]+)', SPREADSHEET_URL).group(1)
-        logging.info(f"ID de la hoja de cálculo: {spreadsheet_id}")
-    except Exception as e:
-        spreadsheet_id = "spreadsheet_id"
-        logging.error(f"No se pudo extraer ID de la hoja: {e}")
-    
-    logging.info(f"Acceso a Google Sheets exitoso: {spreadsheet.title}")
-except Exception as e:
-    logging.error(f"Error al acceder a las hojas de Google Sheets: {e}")
-    raise
+def get_gastos_sheet():
+    """
+    Devuelve la hoja de gastos de Google Sheets.
+    """
+    return get_google_clients(STATE_DIR).gastos_sheet
 
 # ================================
 # Funciones para procesar datos
 # ================================
-def get_gastos_data():
-    """
-    Obtiene todos los datos de la hoja de gastos y los convierte en un DataFrame con formato adecuado
+def build_gastos_dataframe(headers, data):
     """
-    # Obtener todos los datos incluyendo encabezados
-    all_values = gastos_sheet.get_all_values()
-    
-    if not all_values or len(all_values) <= 1:  # Si no hay datos o solo hay encabezados
-        logging.warning("No hay datos en la hoja de Gastos o solo hay encabezados")
-        return None
-    
-    # Obtener encabezados y datos
-    headers = all_values[0]
-    data = all_values[1:]
-    
-    # Verificar que haya datos
-    if not data:
-        logging.warning("No hay datos en la hoja de Gastos (solo encabezados)")
-        return None
+    Convierte filas de la hoja de gastos en un DataFrame con formato adecuado
     
+    :param headers: Encabezados de la hoja
+    :param data: Lista de filas (listas de valores) sin el encabezado
+    :return: DataFrame con las columnas fecha, descripcion, importe, empresa, categoria y forma_pago
+    """
     # Convertir a DataFrame
     df = pd.DataFrame(data, columns=headers)
     
@@ -150,37 +105,147 @@ def get_gastos_data():
     if 'forma_pago' not in df.columns:
         df['forma_pago'] = 'Desconocido'
     
-    # Asegurarse de que 'Fecha' sea datetime
+    # Tipos compactos (fecha, importe y columnas categóricas) y solo filas con fecha e importe válidos
+    return apply_schema(df, source='sheets')
+
+# ================================
+# Caché incremental de la hoja de gastos
+# ================================
+# La caché guarda el DataFrame ya convertido junto con la revisión de la hoja en Drive
+# (modifiedTime y version) y el número de filas leídas. Si la revisión no cambia, basta con
+# una consulta de metadatos; si cambia, se leen solo las filas nuevas a partir de la última
+# cacheada (que se vuelve a leer para comprobar que no se ha movido nada). Si el encabezado
+# o esa fila no coinciden, o la caché es más antigua que SHEET_CACHE_FULL_REFRESH_HOURS,
+# se descarga la hoja completa.
+_sheet_cache = None
+
+def get_sheet_revision():
+    """
+    Consulta en Drive la revisión actual de la hoja de cálculo.
+    
+    :return: Diccionario con modifiedTime y version
+    """
+    clients = get_google_clients(STATE_DIR)
+    return clients.drive_service.files().get(
+        fileId=clients.spreadsheet_id, fields="modifiedTime, version"
+    ).execute()
+
+def load_sheet_cache():
+    """
+    Carga la caché de la hoja (de memoria si ya se cargó en este proceso, si no de disco).
+    
+    :return: Tupla (meta, df) o None si no hay caché válida
+    """
+    global _sheet_cache
+    if _sheet_cache is None:
+        try:
+            with open(SHEET_CACHE_META_PATH, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            _sheet_cache = (meta, pd.read_pickle(SHEET_CACHE_DATA_PATH))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"No se pudo leer la caché de la hoja de gastos: {e}")
+            return None
+    return _sheet_cache
+
+def save_sheet_cache(meta, df):
+    """
+    Guarda la caché de la hoja en memoria y en disco (archivos temporales + rename).
+    """
+    global _sheet_cache
+    _sheet_cache = (meta, df)
     try:
-        df['fecha'] = pd.to_datetime(df['fecha'], errors='coerce')
-    except:
-        logging.warning("Error al convertir fechas. Usando formato estándar.")
-        # Intentar detectar el formato de fecha
-        sample_dates = df['fecha'].dropna().head(5).tolist()
-        logging.info(f"Ejemplos de fechas: {sample_dates}")
-        
-        # Intentar diferentes formatos comunes
-        formats = ['%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%Y/%m/%d']
-        for fmt in formats:
-            try:
-                df['fecha'] = pd.to_datetime(df['fecha'], format=fmt, errors='coerce')
-                if not df['fecha'].isna().all():
-                    logging.info(f"Formato de fecha detectado: {fmt}")
-                    break
-            except:
-                continue
+        os.makedirs(STATE_DIR, exist_ok=True)
+        df.to_pickle(SHEET_CACHE_DATA_PATH + ".tmp")
+        with open(SHEET_CACHE_META_PATH + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(SHEET_CACHE_DATA_PATH + ".tmp", SHEET_CACHE_DATA_PATH)
+        os.replace(SHEET_CACHE_META_PATH + ".tmp", SHEET_CACHE_META_PATH)
+    except Exception as e:
+        logging.warning(f"No se pudo guardar la caché de la hoja de gastos: {e}")
+
+def _pad_rows(rows, width):
+    # La API omite las celdas vacías al final de cada fila; se normalizan al ancho del encabezado
+    return [(row + [''] * width)[:width] for row in rows]
+
+def _fetch_appended_rows(meta):
+    """
+    Lee el encabezado y las filas a partir de la última cacheada en una sola petición.
+    
+    :return: Lista de filas nuevas (no vacía), o None si la hoja no es una ampliación de la caché
+    """
+    import gspread.utils
+    
+    headers = meta['headers']
+    last_col = gspread.utils.rowcol_to_a1(1, len(headers)).rstrip('0123456789')
+    # Fila de la hoja con la última fila cacheada (la 1 es el encabezado)
+    last_row = meta['row_count'] + 1
+    header_range, tail_range = get_gastos_sheet().batch_get([f"A1:{last_col}1", f"A{last_row}:{last_col}"])
     
-    # Convertir 'Importe' a numérico
+    if _pad_rows(list(header_range)[:1], len(headers)) != [headers]:
+        logging.info("El encabezado de la hoja ha cambiado.")
+        return None
+    tail = _pad_rows(list(tail_range), len(headers))
+    if not tail or tail[0] != meta['last_row']:
+        logging.info("La última fila cacheada ya no coincide con la hoja.")
+        return None
+    if len(tail) == 1:
+        # La revisión cambió sin filas nuevas: se editó alguna fila anterior
+        logging.info("La hoja ha cambiado sin filas nuevas.")
+        return None
+    return tail[1:]
+
+def get_gastos_data(use_cache=True):
+    """
+    Obtiene todos los datos de la hoja de gastos y los convierte en un DataFrame con formato adecuado
+    
+    :param use_cache: Reutilizar la caché local si la hoja no ha cambiado o solo tiene filas nuevas
+    :return: DataFrame o None si la hoja no tiene datos
+    """
+    cache = load_sheet_cache() if use_cache else None
+    
+    revision = None
     try:
-        # Primero limpiar posibles símbolos de moneda o comas
-        df['importe'] = df['importe'].astype(str).str.replace('€', '')
-        df['importe'] = df['importe'].str.replace('$', '')
-        df['importe'] = df['importe'].str.replace(',', '.')
-        df['importe'] = pd.to_numeric(df['importe'], errors='coerce')
+        revision = get_sheet_revision()
     except Exception as e:
-        logging.error(f"Error al convertir importe a numérico: {e}")
+        logging.warning(f"No se pudo consultar la revisión de la hoja en Drive: {e}")
+    
+    if cache and revision:
+        meta, cached_df = cache
+        age_hours = (datetime.now() - datetime.fromisoformat(meta['full_refresh_at'])).total_seconds() / 3600
+        if age_hours < SHEET_CACHE_FULL_REFRESH_HOURS:
+            if meta['revision'] == revision:
+                logging.info(f"Hoja de gastos sin cambios: usando la caché ({meta['row_count']} filas).")
+                return cached_df.copy(deep=False)
+            
+            new_rows = _fetch_appended_rows(meta)
+            if new_rows:
+                df = concat_typed([cached_df, build_gastos_dataframe(meta['headers'], new_rows)])
+                meta = dict(meta, row_count=meta['row_count'] + len(new_rows), last_row=new_rows[-1])
+                logging.info(f"Hoja de gastos actualizada con {len(new_rows)} filas nuevas.")
+                save_sheet_cache(dict(meta, revision=revision), df)
+                return df.copy(deep=False)
+    
+    # Obtener todos los datos incluyendo encabezados
+    all_values = get_gastos_sheet().get_all_values()
+    
+    if not all_values or len(all_values) <= 1:  # Si no hay datos o solo hay encabezados
+        logging.warning("No hay datos en la hoja de Gastos o solo hay encabezados")
+        return None
     
-    # Eliminar filas con datos inválidos críticos
-    df = df.dropna(subset=['fecha', 'importe'])
+    # Obtener encabezados y datos
+    headers = all_values[0]
+    data = all_values[1:]
     
-    return df
\ No newline at end of file
+    df = build_gastos_dataframe(headers, data)
+    
+    if revision:
+        save_sheet_cache({
+            'revision': revision,
+            'headers': headers,
+            'row_count': len(data),
+            'last_row': _pad_rows([data[-1]], len(headers))[0],
+            'full_refresh_at': datetime.now().isoformat()
+        }, df)
+    return df.copy(deep=False)
\ No newline at end of file
@@ -0,0 +1,233 @@
+import os
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+# ================================
+# Diario persistente de los tickets en proceso
+# ================================
+# Cada ticket avanza por estas etapas, en este orden (la hoja va antes que el CSV para que el
+# registro local nunca tenga filas que no estén en Google Sheets):
+#
+#   descargado -> extraido -> hoja_guardada -> csv_guardado -> copiado
+#
+# Cada avance se confirma en SQLite en su propia transacción, así que si el proceso se
+# interrumpe la siguiente ejecución continúa desde la última etapa completada. Los datos
+# extraídos se guardan con la etapa 'extraido', de modo que ningún ticket se extrae dos veces.
+# Una escritura puede completarse sin que llegue a anotarse (corte entre las dos): al reanudar,
+# quien usa el diario comprueba si la fila ya está en la hoja o en el CSV antes de repetirla.
+# Un fallo aplaza el siguiente intento con espera exponencial acotada; tras max_attempts
+# fallos el ticket pasa a la lista de descartados hasta que se reintente a mano.
+# Al completar la última etapa el trabajo se borra del diario (queda en el índice de procesados).
+
+STAGES = ['descargado', 'extraido', 'hoja_guardada', 'csv_guardado', 'copiado']
+
+class JobJournal:
+    """
+    Diario (SQLite) de la etapa de cada ticket, sus intentos fallidos y los datos extraídos.
+    """
+
+    def __init__(self, db_path, max_attempts=5, retry_base_seconds=60, retry_max_seconds=6 * 3600):
+        """
+        :param db_path: Ruta al archivo SQLite del diario
+        :param max_attempts: Fallos tras los que el ticket pasa a descartados
+        :param retry_base_seconds: Espera tras el primer fallo (se duplica en cada fallo)
+        :param retry_max_seconds: Espera máxima entre intentos
+        """
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " file_id TEXT PRIMARY KEY,"
+                " file_json TEXT NOT NULL,"
+                " stage TEXT,"
+                " datos TEXT,"
+                " processed_at TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at TEXT,"
+                " last_error TEXT,"
+                " dead INTEGER NOT NULL DEFAULT 0,"
+                " updated_at TEXT)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def _now():
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    @staticmethod
+    def _row_to_job(row):
+        file_json, stage, datos, processed_at, attempts, next_attempt_at, last_error, dead = row
+        return {
+            'file': json.loads(file_json),
+            'stage': stage,
+            'datos': json.loads(datos) if datos else None,
+            'processed_at': processed_at,
+            'attempts': attempts,
+            'next_attempt_at': next_attempt_at,
+            'last_error': last_error,
+            'dead': bool(dead),
+        }
+
+    _COLUMNS = "file_json, stage, datos, processed_at, attempts, next_attempt_at, last_error, dead"
+
+    def get(self, file_id):
+        """
+        :return: Diccionario del trabajo (file, stage, datos, processed_at, attempts,
+                 next_attempt_at, last_error, dead) o None si no está en el diario
+        """
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE file_id = ?", (file_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def _upsert(self, file):
+        self._connect().execute(
+            "INSERT OR IGNORE INTO jobs (file_id, file_json, updated_at) VALUES (?, ?, ?)",
+            (file['id'], json.dumps(file, ensure_ascii=False), self._now())
+        )
+
+    def advance(self, file, stage, datos=None, processed_at=None):
+        """
+        Registra que un ticket ha completado una etapa. Los fallos se reinician solo si la etapa
+        es posterior a la anterior (volver a descargar un ticket que falló al extraerse no cuenta
+        como avance).
+
+        :param file: Diccionario del archivo en Drive (al menos id y name)
+        :param stage: Etapa completada (una de STAGES)
+        :param datos: Datos extraídos (se guardan con la etapa 'extraido')
+        :param processed_at: Fecha de procesamiento de la fila de la hoja
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Etapa desconocida: {stage}")
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                self._upsert(file)
+                previous = conn.execute("SELECT stage FROM jobs WHERE file_id = ?", (file['id'],)).fetchone()[0]
+                progressed = previous is None or STAGES.index(stage) > STAGES.index(previous)
+                conn.execute(
+                    "UPDATE jobs SET stage = ?,"
+                    " datos = COALESCE(?, datos), processed_at = COALESCE(?, processed_at),"
+                    " attempts = CASE WHEN ? THEN 0 ELSE attempts END,"
+                    " next_attempt_at = NULL, last_error = NULL, updated_at = ?"
+                    " WHERE file_id = ?",
+                    (stage, json.dumps(datos, ensure_ascii=False) if datos is not None else None,
+                     processed_at, progressed, self._now(), file['id'])
+                )
+
+    def fail(self, file, error):
+        """
+        Anota un fallo del ticket en la etapa siguiente a la última completada y programa
+        el próximo intento.
+
+        :param file: Diccionario del archivo en Drive
+        :param error: Descripción del fallo
+        :return: True si el ticket ha pasado a descartados
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                self._upsert(file)
+                attempts = conn.execute("SELECT attempts FROM jobs WHERE file_id = ?",
+                                        (file['id'],)).fetchone()[0] + 1
+                delay = min(self.retry_base_seconds * 2 ** (attempts - 1), self.retry_max_seconds)
+                next_attempt_at = (datetime.now() + timedelta(seconds=delay)).strftime('%Y-%m-%d %H:%M:%S')
+                dead = attempts >= self.max_attempts
+                conn.execute(
+                    "UPDATE jobs SET attempts = ?, next_attempt_at = ?, last_error = ?, dead = ?, updated_at = ?"
+                    " WHERE file_id = ?",
+                    (attempts, next_attempt_at, str(error)[:500], int(dead), self._now(), file['id'])
+                )
+        if dead:
+            logging.error(f"El archivo {file['name']} ha fallado {attempts} veces y pasa a descartados: {error}")
+        else:
+            logging.warning(f"Fallo {attempts}/{self.max_attempts} del archivo {file['name']} "
+                            f"({error}); próximo intento a partir de {next_attempt_at}.")
+        return dead
+
+    @staticmethod
+    def is_due(job, now=None):
+        """
+        Indica si ya se puede reintentar un trabajo (no descartado y pasada su espera).
+        """
+        if job['dead']:
+            return False
+        now = now or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return not job['next_attempt_at'] or job['next_attempt_at'] <= now
+
+    def complete(self, file_id):
+        """
+        Borra del diario un ticket que ha completado todas las etapas (o que no hay que procesar).
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM jobs WHERE file_id = ?", (file_id,))
+
+    def pending(self):
+        """
+        :return: Trabajos sin terminar y no descartados, del más antiguo al más reciente
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE dead = 0 ORDER BY updated_at").fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def dead_letters(self):
+        """
+        :return: Trabajos descartados por fallar repetidamente
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT {self._COLUMNS} FROM jobs WHERE dead = 1 ORDER BY updated_at").fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def retry_dead(self):
+        """
+        Devuelve los trabajos descartados a la cola, con los intentos a cero.
+
+        :return: Número de trabajos reactivados
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute(
+                    "UPDATE jobs SET dead = 0, attempts = 0, next_attempt_at = NULL, updated_at = ? WHERE dead = 1",
+                    (self._now(),))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    state_dir = os.getenv('STATE_DIR', os.path.join(script_dir, ".asistente"))
+
+    parser = argparse.ArgumentParser(description="Consulta el diario de tickets en proceso.")
+    parser.add_argument('--dead', action='store_true', help="Mostrar solo los descartados")
+    args = parser.parse_args()
+
+    journal = JobJournal(os.path.join(state_dir, "trabajos.sqlite"))
+    jobs = journal.dead_letters() if args.dead else journal.pending() + journal.dead_letters()
+    for job in jobs:
+        state = 'descartado' if job['dead'] else (job['stage'] or 'pendiente')
+        print(f"{job['file']['name']}: {state}, {job['attempts']} fallos"
+              + (f", último error: {job['last_error']}" if job['last_error'] else ""))
+    print(f"{len(jobs)} trabajos.")
@@ -0,0 +1,234 @@
+import io
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow es opcional: sin él no se detectan duplicados visuales
+    Image = None
+
+# ================================
+# Detección de tickets casi duplicados por hash perceptual
+# ================================
+# Un mismo ticket escaneado dos veces o fotografiado tiene bytes distintos (la caché de
+# extracciones no lo reconoce) pero un aspecto casi idéntico. Se calcula un dHash de 64 bits
+# de cada imagen y se buscan hashes a poca distancia de Hamming con un BK-tree.
+
+def dhash(data, hash_size=8):
+    """
+    Calcula el hash de diferencias (dHash) de una imagen: se reduce a (hash_size + 1) x hash_size
+    píxeles en escala de grises y cada bit indica si un píxel es más claro que su vecino derecho.
+
+    :param data: Bytes de la imagen
+    :param hash_size: Lado del hash (8 = 64 bits)
+    :return: Entero con el hash, o None si Pillow no está disponible o la imagen no se puede leer
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # En JPEG, draft decodifica directamente a baja resolución (mucho más rápido)
+            img.draft('L', (hash_size * 16, hash_size * 16))
+            img = ImageOps.exif_transpose(img).convert('L')
+            pixels = img.resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    except Exception as e:
+        logging.warning(f"No se pudo calcular el hash perceptual de la imagen: {e}")
+        return None
+
+    value = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * width + col]
+            value = (value << 1) | (left > pixels[row * width + col + 1])
+    return value
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """
+    Árbol BK sobre la distancia de Hamming: encuentra los hashes a distancia <= d sin
+    compararlos todos (cada nodo solo explora los hijos en [dist - d, dist + d]).
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value, item):
+        """
+        :param value: Hash perceptual
+        :param item: Objeto asociado al hash
+        """
+        self._size += 1
+        if self._root is None:
+            self._root = (value, item, {})
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (value, item, {})
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        :return: Lista de (distancia, hash, item) con distancia <= max_distance, de menor a mayor
+        """
+        results = []
+        pending = [self._root] if self._root else []
+        while pending:
+            node_value, item, children = pending.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                results.append((distance, node_value, item))
+            for child_distance in range(max(0, distance - max_distance), distance + max_distance + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    pending.append(child)
+        return sorted(results, key=lambda result: result[0])
+
+class PerceptualIndex:
+    """
+    Índice persistente (SQLite) de los hashes perceptuales de los tickets procesados, cargado en
+    un BK-tree en memoria.
+
+    Mientras un ticket está en proceso su hash queda reservado en memoria, de modo que dos casi
+    duplicados de la misma ejecución se detectan aunque ninguno haya terminado todavía. La
+    reserva se confirma en disco con commit() cuando el ticket se guarda, o se libera con
+    release() si falla. Junto al hash se guardan la fecha y el importe del ticket, para poder
+    confirmar un posible duplicado con los datos extraídos y no solo con la imagen.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Ruta al archivo SQLite del índice
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._tree = BKTree()
+        self._pending = {}
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            # El hash se guarda en hexadecimal: SQLite solo tiene enteros con signo de 64 bits
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS phashes ("
+                " file_name TEXT PRIMARY KEY,"
+                " file_id TEXT,"
+                " phash TEXT NOT NULL,"
+                " added_at TEXT,"
+                " fecha TEXT,"
+                " importe REAL)"
+            )
+            # Índices creados antes de guardar la fecha y el importe
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(phashes)")}
+            for column, kind in (('fecha', 'TEXT'), ('importe', 'REAL')):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE phashes ADD COLUMN {column} {kind}")
+            self._conn.commit()
+        return self._conn
+
+    def load(self):
+        """
+        Carga los hashes desde disco al BK-tree.
+
+        :return: Número de hashes en el índice
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT file_name, file_id, phash, fecha, importe FROM phashes").fetchall()
+            self._tree = BKTree()
+            for file_name, file_id, phash, fecha, importe in rows:
+                self._tree.add(int(phash, 16), {'name': file_name, 'id': file_id, 'fecha': fecha, 'importe': importe})
+            self._pending = {}
+        logging.info(f"Índice de hashes perceptuales cargado: {len(rows)} imágenes ({self.db_path})")
+        return len(rows)
+
+    def __len__(self):
+        return len(self._tree)
+
+    def contains(self, file_name):
+        with self._lock:
+            row = self._connect().execute("SELECT 1 FROM phashes WHERE file_name = ?", (file_name,)).fetchone()
+        return row is not None
+
+    def find_or_reserve(self, phash, file, max_distance):
+        """
+        Busca una imagen casi idéntica ya procesada o en proceso. Si no la hay, reserva el hash
+        para este archivo.
+
+        :param phash: Hash perceptual de la imagen
+        :param file: Diccionario con id y name del archivo en Drive
+        :param max_distance: Distancia de Hamming máxima para considerarla duplicada
+        :return: Tupla (distancia, archivo coincidente con name, id y, si se conocen, fecha e
+                 importe) o None si no hay coincidencias
+        """
+        with self._lock:
+            matches = self._tree.search(phash, max_distance)
+            for pending_file, pending_hash in self._pending.values():
+                distance = hamming_distance(phash, pending_hash)
+                if distance <= max_distance:
+                    matches.append((distance, pending_hash, pending_file))
+            if matches:
+                distance, _, match = min(matches, key=lambda m: m[0])
+                return distance, match
+            self._pending[file['id']] = ({'name': file['name'], 'id': file['id']}, phash)
+            return None
+
+    def commit(self, file_id, datos=None):
+        """
+        Confirma en disco el hash reservado para un archivo (no hace nada si no hay reserva).
+
+        :param datos: Datos extraídos del ticket (se guardan su fecha e importe)
+        """
+        with self._lock:
+            pending = self._pending.pop(file_id, None)
+            if pending is None:
+                return
+            file, phash = pending
+            if datos:
+                file = dict(file, fecha=datos.get('fecha'), importe=datos.get('importe'))
+            self._insert(file, phash)
+
+    def release(self, file_id):
+        """
+        Libera la reserva de un archivo que no se llegó a guardar.
+        """
+        with self._lock:
+            self._pending.pop(file_id, None)
+
+    def add(self, phash, file):
+        """
+        Añade directamente un hash al índice (por ejemplo al indexar tickets ya procesados).
+        """
+        with self._lock:
+            self._insert({'name': file['name'], 'id': file.get('id')}, phash)
+
+    def _insert(self, file, phash):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO phashes (file_name, file_id, phash, added_at, fecha, importe) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (file['name'], file['id'], f"{phash:016x}", datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                 file.get('fecha'), file.get('importe'))
+            )
+        self._tree.add(phash, file)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
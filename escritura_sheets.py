@@ -0,0 +1,190 @@
+import time
+import logging
+from contextlib import nullcontext
+
+from reintentos import RETRYABLE_STATUS_CODES, backoff_delay, retry_after_seconds
+
+# Filas del final de la hoja, además de las del lote, en las que se buscan las filas de un lote
+# cuyo resultado no se conoce (otros procesos pueden haber añadido filas después)
+VERIFY_TAIL_MARGIN = 100
+
+# ================================
+# Escritura por lotes en Google Sheets
+# ================================
+class SheetWriter:
+    """
+    Acumula filas y las añade a la hoja con una sola llamada a append_rows.
+
+    El lote se vacía al alcanzar batch_size filas, cuando han pasado flush_interval
+    segundos desde el último vaciado (al añadir una fila o cuando quien espera llama a
+    flush_if_due) y al final de la ejecución (flush). Tras cada
+    vaciado se llama a on_flush(written, failed) con los elementos asociados a las
+    filas que llegaron a la hoja y a las que no, en el mismo orden en que se añadieron.
+
+    append_rows no es idempotente: si la petición falla sin que se sepa si se aplicó (error 5xx,
+    timeout) o la hoja indica menos filas de las enviadas, se relee la columna key_column del
+    final de la hoja para saber qué filas llegaron, y solo se reintentan las que faltan. Sin
+    key_column (o si no se puede releer) esas filas se dan por fallidas en lugar de arriesgarse
+    a escribirlas dos veces.
+    """
+
+    def __init__(self, worksheet, batch_size=50, flush_interval=30.0, max_retries=5, on_flush=None, metrics=None,
+                 key_column=None):
+        """
+        :param worksheet: Hoja de gspread donde se añaden las filas
+        :param batch_size: Número de filas que provoca un vaciado
+        :param flush_interval: Segundos máximos que una fila puede esperar en el lote
+        :param max_retries: Reintentos ante errores 429/5xx antes de dar el lote por fallido
+        :param on_flush: Función llamada con (written, failed) tras cada vaciado
+        :param metrics: PipelineMetrics opcional donde medir los append_rows (etapa 'sheets') y sus reintentos
+        :param key_column: Índice (desde 0) de la columna que identifica cada fila, para comprobar
+                           qué filas llegaron a la hoja cuando el resultado no es seguro
+        """
+        self.worksheet = worksheet
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.on_flush = on_flush
+        self.metrics = metrics
+        self.key_column = key_column
+        self._rows = []
+        self._items = []
+        self._last_flush = time.monotonic()
+        self.rows_written = 0
+        self.rows_failed = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row, item=None):
+        """
+        Añade una fila al lote y lo vacía si se alcanza algún umbral.
+
+        :param row: Lista de valores de la fila
+        :param item: Objeto asociado a la fila que se devolverá en on_flush
+        """
+        self._rows.append(row)
+        self._items.append(item)
+        if len(self._rows) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush_due_in(self):
+        """
+        :return: Segundos que faltan para que toque vaciar el lote por tiempo (0 si ya toca),
+                 o None si no hay filas pendientes
+        """
+        if not self._rows:
+            return None
+        return max(0.0, self.flush_interval - (time.monotonic() - self._last_flush))
+
+    def flush_if_due(self):
+        """
+        Vacía el lote si han pasado flush_interval segundos desde el último vaciado, para que
+        las filas no esperen a la siguiente llamada a add mientras llegan más resultados.
+
+        :return: Tupla (written, failed) como flush, vacía si no tocaba
+        """
+        if self.flush_due_in() == 0:
+            return self.flush()
+        return [], []
+
+    def flush(self):
+        """
+        Escribe en la hoja todas las filas pendientes.
+
+        :return: Tupla (written, failed) con los elementos asociados a cada fila
+        """
+        self._last_flush = time.monotonic()
+        if not self._rows:
+            return [], []
+
+        rows, items = self._rows, self._items
+        self._rows, self._items = [], []
+
+        with self.metrics.track('sheets') if self.metrics else nullcontext({}) as call:
+            appended = self._append_with_retry(rows)
+            call['ok'] = all(appended)
+        written = [item for item, ok in zip(items, appended) if ok]
+        failed = [item for item, ok in zip(items, appended) if not ok]
+        self.rows_written += len(written)
+        self.rows_failed += len(failed)
+        if not failed:
+            logging.info(f"Lote de {len(rows)} filas guardado correctamente en Google Sheets.")
+        elif written:
+            logging.error(f"Solo {len(written)} de {len(rows)} filas del lote llegaron a Google Sheets.")
+        else:
+            logging.error(f"No se pudo guardar en Google Sheets un lote de {len(rows)} filas.")
+
+        if self.on_flush:
+            self.on_flush(written, failed)
+        return written, failed
+
+    def _append_with_retry(self, rows):
+        """
+        Llama a append_rows reintentando con backoff los errores de cuota (429) y 5xx. Un 429
+        indica que la petición se rechazó; tras un 5xx se comprueba qué filas llegaron antes
+        de reintentar las que faltan.
+
+        :return: Lista con True o False por fila según haya llegado a la hoja
+        """
+        from gspread.exceptions import APIError
+
+        appended = [False] * len(rows)
+        pending = list(range(len(rows)))
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.worksheet.append_rows([rows[position] for position in pending])
+            except APIError as e:
+                status = getattr(e.response, 'status_code', None)
+                if status != 429 and not self._confirm_written(rows, pending, appended):
+                    logging.error(f"Error al guardar en Google Sheets: {e}")
+                    return appended
+                pending = [position for position in pending if not appended[position]]
+                if not pending:
+                    return appended
+                if status not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                    logging.error(f"Error al guardar en Google Sheets: {e}")
+                    return appended
+                delay = retry_after_seconds(getattr(e.response, 'headers', None), backoff_delay(attempt))
+                logging.warning(f"Google Sheets respondió {status}. Reintentando {len(pending)} filas en {delay:.1f}s "
+                                f"(intento {attempt + 1}/{self.max_retries}).")
+                if self.metrics:
+                    self.metrics.retry('sheets')
+                time.sleep(delay)
+                continue
+            except Exception as e:
+                # Timeout o error de red: la petición pudo aplicarse igualmente
+                logging.error(f"Error al guardar en Google Sheets: {e}")
+                self._confirm_written(rows, pending, appended)
+                return appended
+
+            updated = (response or {}).get('updates', {}).get('updatedRows')
+            if updated is None or updated == len(pending):
+                for position in pending:
+                    appended[position] = True
+            else:
+                logging.warning(f"Google Sheets indica {updated} filas añadidas de {len(pending)} enviadas.")
+                self._confirm_written(rows, pending, appended)
+            return appended
+        return appended
+
+    def _confirm_written(self, rows, pending, appended):
+        """
+        Busca las filas pendientes al final de la hoja por su columna key_column y marca en
+        appended las que ya están.
+
+        :return: True si se pudo comprobar (False sin key_column o si la lectura falla)
+        """
+        if self.key_column is None:
+            return False
+        try:
+            values = self.worksheet.col_values(self.key_column + 1)
+        except Exception as e:
+            logging.error(f"No se pudo comprobar qué filas llegaron a Google Sheets: {e}")
+            return False
+        tail = set(str(value) for value in values[-(len(rows) + VERIFY_TAIL_MARGIN):])
+        found = [position for position in pending if str(rows[position][self.key_column]) in tail]
+        for position in found:
+            appended[position] = True
+        logging.info(f"Comprobación en Google Sheets: {len(found)} de {len(pending)} filas ya estaban en la hoja.")
+        return True
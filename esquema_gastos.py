@@ -0,0 +1,263 @@
+import time
+import logging
+import argparse
+import threading
+
+import numpy as np
+import pandas as pd
+
+from formatos_gastos import DATE_FORMATS, merchant_key, parse_date
+
+# ================================
+# Esquema común de los DataFrames de gastos
+# ================================
+# Tipos compactos para los gastos cargados desde Google Sheets, el CSV o el almacén:
+#   fecha        datetime64[ns]  (formato detectado una vez por origen y reutilizado; las fechas
+#                                en otro formato se convierten una a una)
+#   importe      float64         (limpieza de símbolos y coma decimal en una sola pasada)
+#   empresa      category        (nombres normalizados: mayúsculas, tildes y espacios)
+#   categoria    category
+#   forma_pago   category
+#   descripcion  category si se repite lo suficiente, texto si no
+#
+# Las columnas categóricas guardan cada valor distinto una vez y un código entero por fila,
+# lo que reduce la memoria y acelera los groupby.
+
+COLUMNS = ['fecha', 'descripcion', 'importe', 'empresa', 'categoria', 'forma_pago']
+CATEGORICAL_COLUMNS = ['empresa', 'categoria', 'forma_pago']
+
+# Valores que se usan para detectar el formato
+DATE_SAMPLE_SIZE = 50
+# descripcion se convierte en categórica si tiene menos valores distintos que esta fracción de filas
+DESCRIPTION_CATEGORY_RATIO = 0.5
+
+# Limpieza de importes en una sola pasada: fuera símbolos de moneda y espacios, coma -> punto
+_AMOUNT_TABLE = str.maketrans({'€': None, '$': None, ' ': None, '\xa0': None, ',': '.'})
+
+_date_formats = {}
+_date_formats_lock = threading.Lock()
+
+def detect_date_format(values, source=None):
+    """
+    Detecta el formato de fecha de una columna probando DATE_FORMATS sobre una muestra.
+    El resultado se guarda por origen, así que las cargas siguientes no repiten la detección.
+
+    :param values: Serie de fechas en texto
+    :param source: Clave del origen (por ejemplo 'sheets' o la ruta del CSV); None para no cachear
+    :return: Formato strftime o None si ninguno encaja
+    """
+    if source is not None:
+        with _date_formats_lock:
+            if source in _date_formats:
+                return _date_formats[source]
+
+    sample = values.dropna().astype(str).str.strip()
+    sample = sample[sample != ''].head(DATE_SAMPLE_SIZE)
+    # Se queda con el formato que entiende más valores de la muestra (el primero si empatan)
+    detected, best_count = None, 0
+    for fmt in DATE_FORMATS:
+        count = int(pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum()) if len(sample) else 0
+        if count > best_count:
+            detected, best_count = fmt, count
+        if count == len(sample):
+            break
+
+    if source is not None and len(sample):
+        with _date_formats_lock:
+            _date_formats[source] = detected
+    if detected:
+        logging.info(f"Formato de fecha detectado: {detected}")
+    return detected
+
+def _map_unique(values, convert):
+    """
+    Aplica una conversión solo a los valores distintos de la columna y la expande a todas las
+    filas (en una hoja de gastos se repiten mucho las fechas y los importes).
+    """
+    codes, uniques = pd.factorize(values)
+    converted = convert(pd.Series(uniques, dtype=object)).to_numpy()
+    result = converted.take(np.where(codes >= 0, codes, 0))
+    result = pd.Series(result, index=values.index, name=values.name)
+    return result.where(codes >= 0)
+
+def _parse_leftover_dates(values, parsed):
+    """
+    Convierte una a una, con todos los formatos aceptados, las fechas que el formato del
+    origen no entendió (filas en otro formato mezcladas con las demás).
+    """
+    leftover = parsed.isna() & values.notna()
+    if not leftover.any():
+        return parsed
+    def convert(uniques):
+        return pd.to_datetime(uniques.map(parse_date), errors='coerce')
+    return parsed.where(~leftover, _map_unique(values[leftover], convert))
+
+def parse_dates(values, source=None):
+    """
+    Convierte una columna de fechas a datetime con el formato detectado (o inferido si no hay uno
+    único). Las fechas que no encajan se prueban después con los demás formatos aceptados.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    fmt = detect_date_format(values, source)
+    if fmt is None:
+        parsed = _map_unique(values, lambda uniques: pd.to_datetime(uniques, errors='coerce'))
+        return _parse_leftover_dates(values, parsed)
+    parsed = _map_unique(values, lambda uniques: pd.to_datetime(uniques, format=fmt, errors='coerce'))
+    if source is not None and parsed.isna().sum() > values.isna().sum():
+        # Ha cambiado el formato del origen: se vuelve a detectar en la próxima carga
+        with _date_formats_lock:
+            _date_formats.pop(source, None)
+    return _parse_leftover_dates(values, parsed)
+
+def parse_amounts(values):
+    """
+    Convierte una columna de importes a float64 (quita € y $, acepta coma decimal).
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype('float64')
+    def convert(uniques):
+        return pd.to_numeric(uniques.astype(str).str.translate(_AMOUNT_TABLE), errors='coerce')
+    return _map_unique(values, convert).astype('float64')
+
+def normalize_merchants(values):
+    """
+    Convierte los nombres de negocio en categóricos, uniendo las variantes de un mismo nombre
+    bajo una sola categoría. Se muestra la grafía más frecuente y, si empatan, la que no está
+    toda en mayúsculas y después la más corta. Solo se procesan los valores distintos, no cada fila.
+
+    :param values: Serie de nombres (texto o categórica)
+    :return: Serie categórica
+    """
+    categorical = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+    names = categorical.cat.categories
+    if len(names) == 0:
+        return categorical
+
+    codes = categorical.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(names))
+    best = {}
+    for position, name in enumerate(names):
+        key = merchant_key(name)
+        rank = (counts[position], not str(name).isupper(), -len(str(name)))
+        if key not in best or rank > best[key][0]:
+            best[key] = (rank, name)
+
+    display = [best[merchant_key(name)][1] for name in names]
+    new_categories = pd.Index(sorted(set(display)))
+    mapping = new_categories.get_indexer(display)
+    new_codes = np.where(codes >= 0, mapping[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories),
+                     index=values.index, name=values.name)
+
+def apply_schema(df, source=None):
+    """
+    Aplica los tipos del esquema a un DataFrame con las columnas de COLUMNS en texto.
+    Las filas sin fecha o sin importe válidos se eliminan.
+
+    :param df: DataFrame con las columnas fecha, descripcion, importe, empresa, categoria y forma_pago
+    :param source: Clave del origen para cachear el formato de fecha detectado
+    :return: DataFrame tipado
+    """
+    typed = {
+        'fecha': parse_dates(df['fecha'], source),
+        'importe': parse_amounts(df['importe']),
+        'empresa': normalize_merchants(df['empresa']),
+    }
+    for column in ['categoria', 'forma_pago']:
+        typed[column] = df[column].astype('category')
+    descripcion = df['descripcion']
+    if descripcion.nunique(dropna=True) < DESCRIPTION_CATEGORY_RATIO * len(descripcion):
+        descripcion = descripcion.astype('category')
+    typed['descripcion'] = descripcion
+
+    other_columns = [column for column in df.columns if column not in typed]
+    result = pd.DataFrame({**{column: df[column] for column in other_columns}, **typed}, index=df.index)
+    result = result[list(df.columns)]
+    return result.dropna(subset=['fecha', 'importe'])
+
+def concat_typed(frames):
+    """
+    Concatena DataFrames tipados conservando las columnas categóricas (pd.concat las
+    convierte en texto si las categorías no coinciden) y vuelve a normalizar los negocios.
+    """
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return None
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+
+    categorical_columns = [column for column in frames[0].columns
+                           if isinstance(frames[0][column].dtype, pd.CategoricalDtype)]
+    union = {}
+    for column in categorical_columns:
+        categories = pd.Index(sorted(set().union(*(frame[column].astype('category').cat.categories for frame in frames))))
+        union[column] = pd.CategoricalDtype(categories)
+    result = pd.concat([frame.astype(union) for frame in frames], ignore_index=True)
+    if 'empresa' in union:
+        result['empresa'] = normalize_merchants(result['empresa'])
+    return result
+
+# ================================
+# Comparación de memoria y tiempos (texto frente a esquema tipado)
+# ================================
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1024 / 1024
+
+def time_groupbys(df, repeat=3):
+    """
+    Mejor tiempo (s) de los groupby del dashboard (categoría, negocio y forma de pago).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for column in CATEGORICAL_COLUMNS:
+            df.groupby(column, observed=True)['importe'].agg(['sum', 'count'])
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def compare_representations(raw):
+    """
+    Compara un DataFrame de gastos en texto (como lo devuelve la hoja) con su versión tipada.
+
+    :param raw: DataFrame con las columnas de COLUMNS en texto
+    :return: Diccionario con memoria (MB) y tiempo de groupby (s) antes y después
+    """
+    baseline = raw.assign(importe=pd.to_numeric(raw['importe'].str.replace(',', '.'), errors='coerce'))
+    start = time.perf_counter()
+    typed = apply_schema(raw)
+    schema_seconds = time.perf_counter() - start
+    return {
+        'rows': len(raw),
+        'memory_mb_before': round(memory_mb(baseline), 1),
+        'memory_mb_after': round(memory_mb(typed), 1),
+        'groupby_seconds_before': round(time_groupbys(baseline), 4),
+        'groupby_seconds_after': round(time_groupbys(typed), 4),
+        'schema_seconds': round(schema_seconds, 4),
+    }
+
+if __name__ == "__main__":
+    from benchmark_analisis import generate_expenses
+
+    parser = argparse.ArgumentParser(description="Memoria y tiempo de groupby con y sin el esquema tipado.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000],
+                        help="Número de filas de cada prueba")
+    args = parser.parse_args()
+
+    for rows in args.sizes:
+        synthetic = generate_expenses(rows)
+        # Mismo aspecto que los datos de la hoja: todo texto, importes con coma decimal y
+        # negocios con distintas grafías
+        raw = pd.DataFrame({
+            'fecha': synthetic['Fecha'].dt.strftime('%d/%m/%Y'),
+            'descripcion': synthetic['descripcion'],
+            'importe': synthetic['importe'].map('{:.2f}'.format).str.replace('.', ',', regex=False),
+            'empresa': np.where(np.arange(rows) % 3 == 0, synthetic['empresa'].str.upper(), synthetic['empresa']),
+            'categoria': synthetic['categoria'],
+            'forma_pago': synthetic['forma_pago'],
+        })
+        result = compare_representations(raw)
+        print(f"{rows:>10,} filas: memoria {result['memory_mb_before']} MB -> {result['memory_mb_after']} MB, "
+              f"groupby {result['groupby_seconds_before']:.4f}s -> {result['groupby_seconds_after']:.4f}s "
+              f"(conversión {result['schema_seconds']:.4f}s)")
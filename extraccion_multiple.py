@@ -0,0 +1,201 @@
+import json
+import base64
+import logging
+import threading
+
+# ================================
+# Extracción de varios tickets en una sola petición a OpenAI
+# ================================
+# Los hilos de extracción entregan cada imagen a ReceiptBatcher, que las agrupa y envía
+# hasta max_receipts imágenes en una sola petición: el prompt y las instrucciones se pagan
+# una vez por grupo y no una por ticket. Cada imagen va precedida de la línea "Ticket <n>"
+# y la respuesta se pide con salida estructurada (response_format json_schema, strict): un
+# objeto con la lista "tickets", cuyos elementos llevan el índice de su imagen y los campos
+# de la extracción. Los resultados se emparejan con las imágenes por ese índice; un índice
+# que falta, se repite o no existe deja ese ticket sin datos, y quien lo envió puede
+# reintentarlo por el camino de una imagen por petición.
+
+def receipts_schema(fields, categories=None):
+    """
+    Esquema JSON estricto de la respuesta: {"tickets": [{"indice": int, <campos>}]}.
+
+    :param fields: Campos de cada ticket (los de la extracción completa o corta)
+    :param categories: Categorías permitidas para 'categoria' (enum), si está entre los campos
+    :return: Diccionario para response_format
+    """
+    field_types = {
+        'fecha': {'type': 'string', 'description': 'Fecha de la transacción (YYYY-MM-DD)'},
+        'descripcion': {'type': 'string', 'description': 'Breve descripción de la compra o servicio'},
+        'importe': {'type': 'number', 'description': 'Cantidad total pagada'},
+        'negocio': {'type': 'string', 'description': 'Nombre del negocio que emitió el recibo'},
+        'categoria': {'type': 'string', 'enum': list(categories or [])},
+    }
+    item = {
+        'type': 'object',
+        'properties': {'indice': {'type': 'integer', 'description': 'Número de la línea "Ticket <n>" de la imagen'},
+                       **{field: field_types[field] for field in fields}},
+        'required': ['indice'] + list(fields),
+        'additionalProperties': False,
+    }
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'name': 'tickets',
+            'strict': True,
+            'schema': {
+                'type': 'object',
+                'properties': {'tickets': {'type': 'array', 'items': item}},
+                'required': ['tickets'],
+                'additionalProperties': False,
+            },
+        },
+    }
+
+def build_multi_payload(images, prompt, fields, model, categories=None, max_tokens_per_receipt=300):
+    """
+    Construye la petición de chat con varias imágenes, cada una precedida de "Ticket <n>".
+
+    :param images: Lista de (bytes de la imagen, tipo MIME)
+    :param prompt: Instrucciones de la extracción (puede usar {n} para el número de imágenes)
+    :param fields: Campos de cada ticket
+    :param model: Modelo de OpenAI
+    :param categories: Categorías permitidas (si 'categoria' está entre los campos)
+    :param max_tokens_per_receipt: Tokens de salida reservados por ticket
+    :return: Diccionario con el payload para /chat/completions
+    """
+    content = [{"type": "text", "text": prompt.format(n=len(images))}]
+    for position, (image_data, mime_type) in enumerate(images, start=1):
+        encoded_image = base64.b64encode(image_data).decode('utf-8')
+        content.append({"type": "text", "text": f"Ticket {position}"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}})
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": content}],
+        "response_format": receipts_schema(fields, categories),
+        "max_tokens": max_tokens_per_receipt * len(images),
+    }
+
+def parse_multi_response(resultado, count, fields):
+    """
+    Empareja los tickets de la respuesta con las imágenes enviadas por su índice.
+
+    :param resultado: Cuerpo JSON de la respuesta (ya decodificado)
+    :param count: Número de imágenes enviadas
+    :param fields: Campos que debe tener cada ticket
+    :return: Lista de count elementos: los datos de cada imagen o None si no se pudo emparejar
+    """
+    results = [None] * count
+    message = resultado['choices'][0]['message']
+    if message.get('refusal'):
+        logging.error(f"OpenAI rechazó la extracción múltiple: {message['refusal']}")
+        return results
+    try:
+        tickets = json.loads(message.get('content') or '')['tickets']
+    except (ValueError, KeyError, TypeError) as e:
+        # Con strict solo pasa si la respuesta se cortó (finish_reason 'length')
+        logging.error(f"Error al interpretar la respuesta múltiple ({resultado['choices'][0].get('finish_reason')}): {e}")
+        return results
+
+    seen = {}
+    for item in tickets if isinstance(tickets, list) else []:
+        index = item.get('indice') if isinstance(item, dict) else None
+        if not isinstance(index, int) or not 1 <= index <= count:
+            logging.warning(f"Ticket con índice inválido en la respuesta múltiple: {item}")
+            continue
+        seen[index] = seen.get(index, 0) + 1
+        if all(field in item for field in fields):
+            results[index - 1] = {field: item[field] for field in fields}
+    for index, times in seen.items():
+        if times > 1:
+            # El mismo índice dos veces: no se sabe cuál es el bueno
+            logging.warning(f"El índice {index} aparece {times} veces en la respuesta múltiple.")
+            results[index - 1] = None
+    return results
+
+def split_evenly(total, parts):
+    """
+    Reparte un entero en parts enteros que suman total ('10 en 3' -> [4, 3, 3]).
+    """
+    base, remainder = divmod(int(total or 0), parts)
+    return [base + (1 if position < remainder else 0) for position in range(parts)]
+
+class ReceiptBatcher:
+    """
+    Agrupa las imágenes que envían varios hilos y las extrae en una sola petición.
+    """
+
+    def __init__(self, send, max_receipts=4, max_wait=2.0):
+        """
+        :param send: Función lista de (imagen, mime) -> (resultados, segundos, usage) que hace la
+                     petición; resultados tiene un elemento por imagen (datos o None)
+        :param max_receipts: Imágenes por petición (el grupo se envía al llenarse)
+        :param max_wait: Segundos que una imagen espera a que se llene el grupo antes de enviarlo incompleto
+        """
+        self.send = send
+        self.max_receipts = max(1, max_receipts)
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pending = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'peticiones': 0, 'tickets': 0, 'sin_emparejar': 0, 'segundos': 0.0}
+
+    def stats(self):
+        """
+        :return: Copia de los contadores (peticiones, tickets, sin_emparejar, segundos)
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _take(self):
+        group, self._pending = self._pending, []
+        return group
+
+    def _run(self, group):
+        images = [slot['image'] for slot in group]
+        results, seconds, usage = [None] * len(group), 0.0, None
+        try:
+            results, seconds, usage = self.send(images)
+        except Exception as e:
+            logging.error(f"Error en la extracción múltiple de {len(group)} tickets: {e}")
+        finally:
+            usage = usage or {}
+            prompt_shares = split_evenly(usage.get('prompt_tokens'), len(group))
+            completion_shares = split_evenly(usage.get('completion_tokens'), len(group))
+            with self._lock:
+                self._stats['peticiones'] += 1
+                self._stats['tickets'] += len(group)
+                self._stats['sin_emparejar'] += sum(1 for datos in results if datos is None)
+                self._stats['segundos'] += seconds
+            for position, slot in enumerate(group):
+                slot['result'] = (results[position], {
+                    'segundos': seconds / len(group),
+                    'usage': {'prompt_tokens': prompt_shares[position],
+                              'completion_tokens': completion_shares[position]},
+                    'peticiones': 1 / len(group),
+                })
+                slot['done'].set()
+
+    def submit(self, image_data, mime_type='image/jpeg'):
+        """
+        Añade una imagen al grupo en curso y espera su resultado. El hilo que llena el grupo
+        (o el de la imagen más antigua, pasado max_wait) es el que hace la petición.
+
+        :return: Tupla (datos o None, parte de la petición que corresponde a esta imagen:
+                 segundos, usage y peticiones)
+        """
+        slot = {'image': (image_data, mime_type), 'done': threading.Event(), 'result': None}
+        with self._lock:
+            self._pending.append(slot)
+            group = self._take() if len(self._pending) >= self.max_receipts else None
+        if group:
+            self._run(group)
+        if not slot['done'].wait(self.max_wait):
+            with self._lock:
+                group = self._take() if any(pending is slot for pending in self._pending) else None
+            if group:
+                self._run(group)
+            slot['done'].wait()
+        return slot['result']
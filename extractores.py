@@ -0,0 +1,237 @@
+import io
+import re
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow es opcional: sin él no hay extracción local
+    Image = None
+
+try:
+    import pytesseract
+except ImportError:  # pytesseract (y el binario tesseract) son opcionales
+    pytesseract = None
+
+# ================================
+# Cadena de extractores de datos de tickets
+# ================================
+# Cada extractor recibe los bytes de la imagen y devuelve (datos, confianza), con datos en el
+# formato de la extracción con OpenAI (fecha, descripcion, importe, negocio, categoria) y la
+# confianza entre 0 y 1. La cadena prueba los extractores en orden y se queda con el primero
+# cuya confianza alcanza su umbral; el último (el modelo remoto) se acepta siempre.
+#
+# El extractor local pasa la imagen por OCR (tesseract) y busca con expresiones regulares el
+# total, la fecha, el NIF/CIF y el nombre del negocio. Basta para los tickets impresos y
+# limpios de supermercado; el resto se sigue enviando a OpenAI.
+
+# Líneas que contienen el total del ticket (y las que parecen un total pero no lo son). No se
+# usan las de la forma de pago: 'EFECTIVO 50,00' es lo entregado, no el total
+_TOTAL_LINE = re.compile(r'\b(total|importe|a pagar)\b', re.IGNORECASE)
+_NOT_TOTAL_LINE = re.compile(r'\b(subtotal|sub total|base|iva|igic|cambio|entregado|dto|descuento)\b', re.IGNORECASE)
+# Importes con dos decimales ('1.234,56', '12,50', '12.50')
+_AMOUNT = re.compile(r'(?<![\d.,])(\d{1,3}(?:[.\s]\d{3})*|\d+)[.,](\d{2})(?![\d.,])')
+_DATE_PATTERNS = [
+    (re.compile(r'\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b'), ('y', 'm', 'd')),
+    (re.compile(r'\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4}|\d{2})\b'), ('d', 'm', 'y')),
+]
+# NIF/CIF español (empresa o autónomo)
+_TAX_ID = re.compile(r'\b([ABCDEFGHJNPQRSUVW][-\s]?\d{7}[-\s]?[0-9A-J]|\d{8}[-\s]?[A-Z])\b')
+
+# Peso de cada dato encontrado en la confianza (suman 1)
+CONFIDENCE_WEIGHTS = {
+    'importe': 0.35,         # importe en una línea de total
+    'importe_maximo': 0.1,   # ... y es el mayor del ticket
+    'fecha': 0.25,           # fecha válida y reciente
+    'negocio': 0.1,          # nombre de negocio en la cabecera
+    'nif': 0.1,              # NIF/CIF del emisor
+    'negocio_conocido': 0.1, # negocio con categoría conocida
+}
+# Antigüedad máxima de una fecha para darla por buena
+MAX_TICKET_AGE_DAYS = 730
+
+def _parse_amount(integer, decimals):
+    return float(re.sub(r'[.\s]', '', integer) + '.' + decimals)
+
+def _find_total(lines):
+    """
+    :return: Tupla (total, es el mayor importe del ticket) o (None, False)
+    """
+    amounts = []
+    totals = []
+    for line in lines:
+        found = [_parse_amount(*match) for match in _AMOUNT.findall(line)]
+        amounts.extend(found)
+        if found and _TOTAL_LINE.search(line) and not _NOT_TOTAL_LINE.search(line):
+            totals.append(found[-1])
+    if not totals:
+        return None, False
+    total = max(totals)
+    return total, total >= max(amounts)
+
+def _find_date(text, today=None):
+    """
+    :return: Fecha 'YYYY-MM-DD' de la primera fecha válida y no futura del texto, o None
+    """
+    today = today or datetime.now()
+    oldest = today - timedelta(days=MAX_TICKET_AGE_DAYS)
+    for pattern, order in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            parts = dict(zip(order, (int(value) for value in match.groups())))
+            if parts['y'] < 100:
+                parts['y'] += 2000
+            try:
+                date = datetime(parts['y'], parts['m'], parts['d'])
+            except ValueError:
+                continue
+            if oldest <= date <= today + timedelta(days=1):
+                return date.strftime('%Y-%m-%d')
+    return None
+
+def _find_merchant(lines):
+    """
+    Nombre del negocio: la primera línea de la cabecera con al menos tres letras seguidas.
+    """
+    for line in lines[:6]:
+        cleaned = line.strip(' *-=:')
+        if re.search(r'[^\W\d_]{3,}', cleaned) and sum(char.isdigit() for char in cleaned) <= len(cleaned) // 3:
+            return ' '.join(cleaned.split())
+    return None
+
+def parse_receipt_text(text, lookup=None, today=None):
+    """
+    Extrae los datos de un ticket a partir de su texto (OCR) y calcula la confianza.
+
+    :param text: Texto del ticket
+    :param lookup: Función opcional negocio -> (categoría, nombre, similitud) o None
+                   (por ejemplo MerchantCategoryMemo.lookup)
+    :param today: Fecha de referencia para validar la del ticket (por defecto, hoy)
+    :return: Tupla (datos, confianza). datos no incluye 'categoria' si el negocio no es conocido
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    datos = {}
+    confidence = 0.0
+
+    total, is_largest = _find_total(lines)
+    if total is not None:
+        datos['importe'] = total
+        confidence += CONFIDENCE_WEIGHTS['importe']
+        if is_largest:
+            confidence += CONFIDENCE_WEIGHTS['importe_maximo']
+
+    fecha = _find_date(text, today)
+    if fecha:
+        datos['fecha'] = fecha
+        confidence += CONFIDENCE_WEIGHTS['fecha']
+
+    negocio = _find_merchant(lines)
+    if negocio:
+        datos['negocio'] = negocio
+        datos['descripcion'] = f"Compra en {negocio}"
+        confidence += CONFIDENCE_WEIGHTS['negocio']
+        found = lookup(negocio) if lookup else None
+        if found:
+            datos['categoria'] = found[0]
+            confidence += CONFIDENCE_WEIGHTS['negocio_conocido']
+
+    tax_id = _TAX_ID.search(text)
+    if tax_id:
+        datos['nif'] = re.sub(r'[-\s]', '', tax_id.group(1))
+        confidence += CONFIDENCE_WEIGHTS['nif']
+
+    return datos, round(confidence, 2)
+
+class LocalOCRExtractor:
+    """
+    Extractor local: OCR con tesseract y expresiones regulares. Solo usa CPU.
+    """
+
+    def __init__(self, lang='spa', lookup=None):
+        """
+        :param lang: Idioma de tesseract
+        :param lookup: Función negocio -> categoría conocida (ver parse_receipt_text)
+        """
+        self.lang = lang
+        self.lookup = lookup
+        self._warned = False
+
+    @property
+    def available(self):
+        return Image is not None and pytesseract is not None
+
+    def ocr(self, image_data):
+        with Image.open(io.BytesIO(image_data)) as img:
+            img = ImageOps.autocontrast(ImageOps.exif_transpose(img).convert('L'))
+            return pytesseract.image_to_string(img, lang=self.lang)
+
+    def extract(self, image_data):
+        """
+        :param image_data: Bytes de la imagen
+        :return: Tupla (datos, confianza); (None, 0.0) si el OCR no está disponible o falla
+        """
+        if not self.available:
+            return None, 0.0
+        try:
+            text = self.ocr(image_data)
+        except Exception as e:
+            # Normalmente falta el binario de tesseract o el idioma: se avisa una sola vez
+            if not self._warned:
+                logging.warning(f"No se pudo usar el OCR local: {e}")
+                self._warned = True
+            return None, 0.0
+        return parse_receipt_text(text, self.lookup)
+
+class ExtractorChain:
+    """
+    Prueba los extractores en orden y cuenta cuántos tickets resuelve cada uno y cuánto tarda.
+    """
+
+    def __init__(self, steps):
+        """
+        :param steps: Lista de (nombre, función(image_data) -> (datos, confianza), umbral).
+                      Un umbral None acepta siempre el resultado si hay datos.
+        """
+        self.steps = steps
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _record(self, name, seconds, accepted):
+        with self._lock:
+            entry = self._stats.setdefault(name, {'intentos': 0, 'tickets': 0, 'segundos': 0.0})
+            entry['intentos'] += 1
+            entry['segundos'] += seconds
+            if accepted:
+                entry['tickets'] += 1
+
+    def extract(self, image_data):
+        """
+        :param image_data: Bytes de la imagen
+        :return: Tupla (datos, nombre del extractor que los dio); (None, None) si ninguno los obtuvo
+        """
+        for name, extractor, threshold in self.steps:
+            start = time.perf_counter()
+            try:
+                datos, confidence = extractor(image_data)
+            except Exception as e:
+                logging.warning(f"Error en el extractor '{name}': {e}")
+                datos, confidence = None, 0.0
+            accepted = bool(datos) and (threshold is None or confidence >= threshold)
+            self._record(name, time.perf_counter() - start, accepted)
+            if accepted:
+                return datos, name
+            if datos:
+                logging.info(f"Extractor '{name}': confianza {confidence} por debajo de {threshold}, se prueba el siguiente.")
+        return None, None
+
+    def stats(self):
+        """
+        :return: Copia de los contadores por extractor (intentos, tickets aceptados y segundos)
+        """
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
@@ -0,0 +1,53 @@
+import re
+import bisect
+import unicodedata
+from datetime import datetime
+
+# ================================
+# Formatos de los campos de un gasto (sin dependencias)
+# ================================
+# Lo comparten el almacén en Parquet, el esquema de los DataFrames y la tabla de negocios, y
+# se puede importar sin cargar pandas ni pyarrow.
+
+# Formatos de fecha aceptados, en orden (el día antes que el mes en las fechas con barras)
+DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S']
+
+# Límites y etiquetas de los rangos de importe (intervalos cerrados por la izquierda)
+RANGE_BINS = [float('-inf'), 10, 50, 100, 500, float('inf')]
+RANGE_LABELS = ["Menos de 10€", "10€ - 50€", "50€ - 100€", "100€ - 500€", "Más de 500€"]
+
+def parse_date(value, formats=DATE_FORMATS):
+    """
+    Convierte una fecha en texto probando los formatos aceptados.
+
+    :param value: Texto de la fecha (o fecha con hora en formato ISO)
+    :param formats: Formatos que probar, en orden
+    :return: datetime.date o None si ningún formato encaja
+    """
+    if value is None:
+        return None
+    text = str(value).strip()
+    for candidate in (text, text[:10]):
+        for fmt in formats:
+            try:
+                return datetime.strptime(candidate, fmt).date()
+            except ValueError:
+                continue
+    return None
+
+def merchant_key(name):
+    """
+    Clave de comparación de un nombre de negocio: sin tildes, en minúsculas y sin signos ni
+    espacios repetidos ('ALCAMPO  Plaza del Toro.' -> 'alcampo plaza del toro').
+    """
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).casefold()
+    return re.sub(r'[^0-9a-z]+', ' ', text).strip()
+
+def amount_range(value):
+    """
+    Retorna el rango de gasto para un importe dado (los mismos intervalos que pd.cut con
+    RANGE_BINS y right=False)
+    """
+    position = bisect.bisect_right(RANGE_BINS[1:-1], value)
+    return RANGE_LABELS[position]
@@ -0,0 +1,149 @@
+import os
+import csv
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+# ================================
+# Índice persistente de archivos procesados
+# ================================
+class ProcessedIndex:
+    """
+    Índice local (SQLite) de los tickets ya procesados, indexado por ID de Drive y por nombre.
+
+    Se carga una vez por ejecución en memoria, de modo que cada comprobación de duplicados
+    es O(1) y no necesita red. Cada alta se confirma en su propia transacción, así que el
+    índice en disco nunca queda a medio escribir aunque el proceso se interrumpa.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Ruta al archivo SQLite del índice
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._ids = set()
+        self._names = set()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                " file_name TEXT PRIMARY KEY,"
+                " file_id TEXT,"
+                " source TEXT,"
+                " processed_at TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_file_id ON processed(file_id)")
+            self._conn.commit()
+        return self._conn
+
+    def load(self):
+        """
+        Carga el índice desde disco a memoria.
+
+        :return: Número de archivos en el índice
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT file_name, file_id FROM processed").fetchall()
+            self._names = {name for name, _ in rows}
+            self._ids = {file_id for _, file_id in rows if file_id}
+        logging.info(f"Índice de archivos procesados cargado: {len(self._names)} archivos ({self.db_path})")
+        return len(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def contains(self, file_name=None, file_id=None):
+        """
+        Indica si un archivo ya figura como procesado, por ID o por nombre.
+        """
+        return (file_id is not None and file_id in self._ids) or \
+               (file_name is not None and file_name in self._names)
+
+    def add(self, file_name, file_id=None, source='pipeline'):
+        """
+        Registra un archivo como procesado y lo confirma en disco inmediatamente.
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO processed (file_name, file_id, source, processed_at) VALUES (?, ?, ?, ?)",
+                    (file_name, file_id, source, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                )
+            self._names.add(file_name)
+            if file_id:
+                self._ids.add(file_id)
+
+    def remove(self, file_name):
+        """
+        Quita un archivo del índice para que se vuelva a procesar.
+
+        :return: True si estaba en el índice
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                row = conn.execute("SELECT file_id FROM processed WHERE file_name = ?", (file_name,)).fetchone()
+                conn.execute("DELETE FROM processed WHERE file_name = ?", (file_name,))
+            self._names.discard(file_name)
+            if row and row[0]:
+                self._ids.discard(row[0])
+        return row is not None
+
+    def rebuild(self, csv_path=None, sheet_names=None, drive_files=None, store_names=None):
+        """
+        Reconstruye el índice desde cero a partir de las fuentes existentes.
+
+        :param csv_path: Ruta al CSV local de gastos (columna 'Archivo')
+        :param sheet_names: Lista de nombres de archivo de la columna Archivo de Google Sheets
+        :param drive_files: Lista de diccionarios (id, name) de la carpeta de destino en Drive
+        :param store_names: Lista de nombres de archivo del almacén de gastos en Parquet
+        :return: Número de archivos en el índice reconstruido
+        """
+        entries = {}
+
+        if csv_path and os.path.exists(csv_path):
+            with open(csv_path, 'r', newline='', encoding='utf-8') as csv_file:
+                for row in csv.DictReader(csv_file):
+                    if row.get('Archivo'):
+                        entries[row['Archivo']] = (None, 'csv')
+
+        for name in store_names or []:
+            if name and name not in entries:
+                entries[name] = (None, 'almacen')
+
+        for name in sheet_names or []:
+            if name and name not in entries:
+                entries[name] = (None, 'sheets')
+
+        for file in drive_files or []:
+            # Los archivos copiados conservan el nombre pero no el ID original
+            if file.get('name') and file['name'] not in entries:
+                entries[file['name']] = (None, 'drive')
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM processed")
+                conn.executemany(
+                    "INSERT INTO processed (file_name, file_id, source, processed_at) VALUES (?, ?, ?, ?)",
+                    [(name, file_id, source, now) for name, (file_id, source) in entries.items()]
+                )
+            self._names = set(entries)
+            self._ids = set()
+
+        logging.info(f"Índice de archivos procesados reconstruido: {len(entries)} archivos.")
+        return len(entries)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
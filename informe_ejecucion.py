@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import math
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# ================================
+# Informe de rendimiento y coste de cada ejecución
+# ================================
+# Durante la ejecución se anota, para cada archivo, el tiempo de cada etapa, los tokens de
+# entrada y salida de las llamadas a OpenAI, los bytes de imagen enviados, el extractor que
+# resolvió el ticket (la caché cuenta como acierto) y el resultado o el motivo por el que se
+# omitió. Los datos se atribuyen al archivo que está procesando el hilo actual (activate).
+# Al terminar se escribe un JSON con los archivos, los totales y los percentiles p50/p95/p99
+# de las latencias, y el comando comparar detecta regresiones de coste o de tiempo entre dos
+# informes:
+#
+#   python informe_ejecucion.py comparar informe_anterior.json informe_nuevo.json
+#   python informe_ejecucion.py comparar --ultimos
+
+REPORT_VERSION = 1
+PERCENTILES = (50, 95, 99)
+
+# Variación relativa a partir de la que el comando comparar marca una regresión
+DEFAULT_THRESHOLD = 0.1
+# Diferencia mínima (s) para marcar una regresión de latencia: evita el ruido de las etapas de milisegundos
+MIN_SECONDS_CHANGE = 0.05
+
+def percentile(values, q):
+    """
+    Percentil q (0-100) por el método del rango más cercano, o None si no hay valores.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def summarize(values):
+    """
+    :return: Diccionario con p50, p95, p99, máximo y número de valores (redondeados a ms)
+    """
+    summary = {f'p{q}': percentile(values, q) for q in PERCENTILES}
+    summary['max'] = max(values) if values else None
+    summary = {key: round(value, 3) if value is not None else None for key, value in summary.items()}
+    summary['n'] = len(values)
+    return summary
+
+class RunReport:
+    """
+    Acumula los datos por archivo de una ejecución. Seguro entre hilos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self, **meta):
+        """
+        Empieza un informe nuevo.
+
+        :param meta: Datos de la ejecución que se guardan tal cual (modelo, prompt, hilos...)
+        """
+        with self._lock:
+            self.meta = meta
+            self.started_at = datetime.now()
+            self.files = {}
+            self.unattributed = {}
+            self.stages = {}
+
+    def _entry(self, file):
+        entry = self.files.get(file['id'])
+        if entry is None:
+            entry = self.files[file['id']] = {
+                'id': file['id'],
+                'nombre': file.get('name'),
+                'subido': file.get('createdTime'),
+                'resultado': None,
+                'motivo': None,
+                'tiempos': {},
+            }
+        return entry
+
+    @contextmanager
+    def activate(self, file):
+        """
+        Atribuye al archivo lo que se anote desde este hilo dentro del bloque.
+        """
+        with self._lock:
+            self._entry(file)
+        previous = getattr(self._local, 'file_id', None)
+        self._local.file_id = file['id']
+        try:
+            yield
+        finally:
+            self._local.file_id = previous
+
+    def _current(self):
+        file_id = getattr(self._local, 'file_id', None)
+        return self.files.get(file_id, self.unattributed)
+
+    def add(self, **amounts):
+        """
+        Suma cantidades (tokens, bytes, llamadas...) al archivo activo en este hilo.
+        """
+        with self._lock:
+            entry = self._current()
+            for key, amount in amounts.items():
+                entry[key] = entry.get(key, 0) + (amount or 0)
+
+    def set(self, file=None, **values):
+        """
+        Guarda valores en el archivo indicado (o en el activo en este hilo).
+        """
+        with self._lock:
+            entry = self._entry(file) if file is not None else self._current()
+            entry.update(values)
+
+    def observe(self, stage, seconds, ok=True):
+        """
+        Anota la duración de una llamada a una etapa (se registra como oyente de PipelineMetrics).
+        Las etapas que no son de un archivo concreto (los lotes de Sheets) solo cuentan en los totales.
+        """
+        with self._lock:
+            timings = self.stages.setdefault(stage, {'segundos': [], 'errores': 0})
+            timings['segundos'].append(seconds)
+            if not ok:
+                timings['errores'] += 1
+            entry = self._current()
+            if entry is not self.unattributed:
+                entry['tiempos'][stage] = round(entry['tiempos'].get(stage, 0.0) + seconds, 4)
+
+    def to_dict(self, run_stats=None):
+        """
+        :param run_stats: Contadores de la ejecución (ver assistant_goupbi.new_run_stats)
+        :return: Informe completo, listo para json.dump
+        """
+        with self._lock:
+            files = [dict(entry, tiempos=dict(entry['tiempos'])) for entry in self.files.values()]
+            unattributed = dict(self.unattributed)
+            stages = {stage: (list(timings['segundos']), timings['errores'])
+                      for stage, timings in self.stages.items()}
+        finished_at = datetime.now()
+
+        for entry in files:
+            entry['segundos'] = round(sum(entry['tiempos'].values()), 4)
+
+        def total(key):
+            return sum(entry.get(key, 0) for entry in files) + unattributed.get(key, 0)
+
+        processed = [entry for entry in files if entry['resultado'] == 'procesado']
+        extracted = [entry for entry in files if entry.get('extractor')]
+        reasons = {}
+        for entry in files:
+            if entry['resultado'] != 'procesado' and entry['motivo']:
+                reasons[entry['motivo']] = reasons.get(entry['motivo'], 0) + 1
+        prompt_tokens, completion_tokens = total('prompt_tokens'), total('completion_tokens')
+        totals = {
+            'archivos': len(files),
+            'procesados': len(processed),
+            'omitidos': sum(1 for entry in files if entry['resultado'] == 'omitido'),
+            'fallidos': sum(1 for entry in files if entry['resultado'] == 'fallido'),
+            'motivos': reasons,
+            # Con la extracción múltiple cada ticket cuenta la fracción de petición que le toca
+            'llamadas_api': round(total('llamadas_api'), 2),
+            'fallos_interpretacion': total('fallos_interpretacion'),
+            'tasa_fallos_interpretacion': round(total('fallos_interpretacion') / len(extracted), 3) if extracted else None,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'tokens_por_ticket': round((prompt_tokens + completion_tokens) / len(extracted), 1) if extracted else None,
+            'bytes_originales': total('bytes_originales'),
+            'bytes_enviados': total('bytes_enviados'),
+            'bytes_enviados_por_ticket': round(total('bytes_enviados') / len(extracted)) if extracted else None,
+            'aciertos_cache': sum(1 for entry in extracted if entry['extractor'] == 'cache'),
+            'tasa_aciertos_cache': round(sum(1 for entry in extracted if entry['extractor'] == 'cache')
+                                         / len(extracted), 3) if extracted else None,
+            'extractores': {name: sum(1 for entry in extracted if entry['extractor'] == name)
+                            for name in sorted({entry['extractor'] for entry in extracted})},
+        }
+        if run_stats:
+            totals['pasan_a_descartados'] = run_stats['dead_letters']
+
+        return {
+            'version': REPORT_VERSION,
+            'inicio': self.started_at.isoformat(timespec='seconds'),
+            'fin': finished_at.isoformat(timespec='seconds'),
+            'duracion_segundos': round((finished_at - self.started_at).total_seconds(), 3),
+            **self.meta,
+            'totales': totals,
+            'latencias': {
+                'archivo': summarize([entry['segundos'] for entry in files if entry['tiempos']]),
+                'subida_hoja': summarize(run_stats.get('latencies', []) if run_stats else []),
+                'etapas': {stage: dict(summarize(seconds), errores=errors, segundos=round(sum(seconds), 3))
+                           for stage, (seconds, errors) in sorted(stages.items())},
+            },
+            'archivos': files,
+        }
+
+def write_report(report, directory):
+    """
+    Escribe un informe en directory/ejecucion-AAAAMMDD-HHMMSS.json (fecha de inicio).
+
+    :return: Ruta del informe
+    """
+    os.makedirs(directory, exist_ok=True)
+    started_at = datetime.fromisoformat(report['inicio'])
+    path = os.path.join(directory, f"ejecucion-{started_at.strftime('%Y%m%d-%H%M%S')}.json")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+# ================================
+# Comparación de dos informes
+# ================================
+# (nombre, función informe -> valor, True si más alto es mejor, diferencia mínima para ser regresión)
+COMPARED_METRICS = [
+    ('tokens_por_ticket', lambda r: r['totales']['tokens_por_ticket'], False, 0),
+    ('bytes_enviados_por_ticket', lambda r: r['totales']['bytes_enviados_por_ticket'], False, 0),
+    ('tasa_aciertos_cache', lambda r: r['totales']['tasa_aciertos_cache'], True, 0),
+    ('tasa_fallos_interpretacion', lambda r: r['totales'].get('tasa_fallos_interpretacion'), False, 0),
+    ('archivo_p50', lambda r: r['latencias']['archivo']['p50'], False, MIN_SECONDS_CHANGE),
+    ('archivo_p95', lambda r: r['latencias']['archivo']['p95'], False, MIN_SECONDS_CHANGE),
+    ('archivo_p99', lambda r: r['latencias']['archivo']['p99'], False, MIN_SECONDS_CHANGE),
+    ('subida_hoja_p95', lambda r: r['latencias']['subida_hoja']['p95'], False, MIN_SECONDS_CHANGE),
+]
+
+def _stage_metrics(report):
+    return [(f'etapa_{stage}_p95', lambda r, stage=stage: r['latencias']['etapas'].get(stage, {}).get('p95'),
+             False, MIN_SECONDS_CHANGE)
+            for stage in report['latencias']['etapas']]
+
+def compare_reports(old, new, threshold=DEFAULT_THRESHOLD):
+    """
+    Compara dos informes métrica a métrica.
+
+    :param old: Informe de referencia
+    :param new: Informe nuevo
+    :param threshold: Variación relativa a partir de la que se considera regresión
+    :return: Lista de (métrica, valor anterior, valor nuevo, variación relativa o None, es regresión)
+    """
+    rows = []
+    seen = set()
+    for name, getter, higher_is_better, min_change in COMPARED_METRICS + _stage_metrics(old) + _stage_metrics(new):
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            before, after = getter(old), getter(new)
+        except (KeyError, TypeError):
+            continue
+        if before is None or after is None:
+            rows.append((name, before, after, None, False))
+            continue
+        change = (after - before) / before if before else (0.0 if after == before else None)
+        worse = (change is not None and (-change if higher_is_better else change) > threshold
+                 and abs(after - before) >= min_change)
+        rows.append((name, before, after, change, worse))
+    return rows
+
+def latest_reports(directory, count=2):
+    """
+    :return: Rutas de los count informes más recientes del directorio, del más antiguo al más nuevo
+    """
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith('ejecucion-') and name.endswith('.json'))
+    return [os.path.join(directory, name) for name in names[-count:]]
+
+def load_report(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    state_dir = os.getenv('STATE_DIR', os.path.join(script_dir, ".asistente"))
+    reports_dir = os.getenv('RUN_REPORTS_DIR', os.path.join(state_dir, "informes"))
+
+    parser = argparse.ArgumentParser(description="Informes de rendimiento y coste de las ejecuciones.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compare = subparsers.add_parser('comparar', help="Compara dos informes y marca las regresiones")
+    compare.add_argument('informes', nargs='*', help="Informe de referencia e informe nuevo")
+    compare.add_argument('--ultimos', action='store_true', help=f"Comparar los dos últimos informes de {reports_dir}")
+    compare.add_argument('--umbral', type=float, default=DEFAULT_THRESHOLD,
+                         help=f"Variación relativa que cuenta como regresión (por defecto {DEFAULT_THRESHOLD})")
+    args = parser.parse_args()
+
+    paths = latest_reports(reports_dir) if args.ultimos else args.informes
+    if len(paths) != 2:
+        parser.error("Hacen falta exactamente dos informes (o --ultimos con al menos dos en el directorio).")
+
+    old, new = load_report(paths[0]), load_report(paths[1])
+    print(f"Referencia: {paths[0]} ({old['inicio']}, {old['totales']['archivos']} archivos)")
+    print(f"Nuevo:      {paths[1]} ({new['inicio']}, {new['totales']['archivos']} archivos)")
+    regressions = 0
+    for name, before, after, change, worse in compare_reports(old, new, args.umbral):
+        variation = f"{change:+.1%}" if change is not None else "-"
+        print(f"{'REGRESIÓN ' if worse else '          '}{name:<32} {before!s:>12} -> {after!s:<12} {variation}")
+        regressions += worse
+    print(f"{regressions} regresiones (umbral {args.umbral:.0%}).")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import logging
+import argparse
+from datetime import datetime
+
+# ================================
+# Instantánea JSON de los datos del dashboard
+# ================================
+# dashboard.html carga este archivo en lugar de descargar y agregar todo el CSV en el
+# navegador. Contiene la salida de analisis_datos.analyze_data (o de los agregados
+# incrementales), así que su tamaño no depende del número de transacciones.
+#
+# Formato:
+#   {"version": 1, "etag": "<sha256 de los datos>", "generated_at": "...", "data": {...}}
+#
+# El etag solo depende de los datos: si no cambian, el archivo no se reescribe y los
+# navegadores pueden revalidar su copia en caché sin volver a descargarla.
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = "dashboard_data.json"
+
+def _to_native(value):
+    """
+    Convierte los tipos de numpy/pandas a tipos de JSON y redondea los importes a céntimos.
+    """
+    if isinstance(value, dict):
+        return {str(key): _to_native(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_native(item) for item in value]
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        value = value.item()
+    if isinstance(value, float):
+        return None if value != value else round(value, 2)
+    return value
+
+def snapshot_etag(data):
+    """
+    Hash del contenido de los datos del dashboard (independiente del orden de las claves).
+
+    :param data: Datos del dashboard ya convertidos con _to_native
+    :return: Cadena hexadecimal
+    """
+    canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+def build_snapshot(dashboard_data):
+    """
+    Prepara la instantánea versionada a partir de la salida de analyze_data.
+
+    :param dashboard_data: Diccionario de analyze_data (o None si no hay datos)
+    :return: Diccionario listo para serializar
+    """
+    data = _to_native(dashboard_data)
+    return {
+        'version': SNAPSHOT_VERSION,
+        'etag': snapshot_etag(data),
+        'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'data': data
+    }
+
+def read_snapshot(path):
+    """
+    Lee una instantánea existente.
+
+    :return: Diccionario de la instantánea o None si no existe o no se puede leer
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"No se pudo leer la instantánea del dashboard: {e}")
+        return None
+
+def write_snapshot(dashboard_data, path):
+    """
+    Escribe la instantánea del dashboard si su contenido ha cambiado.
+
+    :param dashboard_data: Diccionario de analyze_data
+    :param path: Ruta del archivo JSON
+    :return: Etag de la instantánea
+    """
+    snapshot = build_snapshot(dashboard_data)
+    previous = read_snapshot(path)
+    if previous and previous.get('version') == SNAPSHOT_VERSION and previous.get('etag') == snapshot['etag']:
+        logging.info(f"Instantánea del dashboard sin cambios ({snapshot['etag']}).")
+        return snapshot['etag']
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    logging.info(f"Instantánea del dashboard guardada en {path} ({snapshot['etag']}).")
+    return snapshot['etag']
+
+if __name__ == "__main__":
+    from agregados import ExpenseAggregates, rows_from_csv
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    state_dir = os.getenv('STATE_DIR', os.path.join(script_dir, ".asistente"))
+
+    parser = argparse.ArgumentParser(description="Genera la instantánea JSON que carga dashboard.html.")
+    parser.add_argument('--csv', default=os.path.join(script_dir, "registro_gastos.csv"),
+                        help="CSV de gastos desde el que calcular los agregados si no existen")
+    parser.add_argument('--output', default=os.path.join(script_dir, SNAPSHOT_FILE),
+                        help="Ruta de la instantánea")
+    args = parser.parse_args()
+
+    aggregates = ExpenseAggregates(os.path.join(state_dir, "agregados.json"))
+    if aggregates.exists():
+        aggregates.load()
+    else:
+        aggregates.rebuild(rows_from_csv(args.csv))
+    write_snapshot(aggregates.to_dashboard_data(), args.output)
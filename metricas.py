@@ -0,0 +1,240 @@
+import os
+import time
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ================================
+# Métricas del procesamiento en formato de texto de Prometheus
+# ================================
+# Cada etapa instrumentada (descarga, extracción, CSV, Sheets, copia en Drive, consulta del
+# índice) registra:
+#   asistente_stage_duration_seconds  histograma de la duración de cada llamada
+#   asistente_stage_calls_total       llamadas por resultado (ok / error)
+#   asistente_stage_in_flight         llamadas en curso (útil con varios hilos)
+#   asistente_bytes_total             bytes descargados de Drive y enviados a OpenAI
+#   asistente_retries_total           reintentos ante errores transitorios por servicio
+#
+# Las métricas se escriben en un archivo .prom al final de cada ejecución (para el textfile
+# collector de node_exporter) y el servicio de vigilancia puede además servirlas en /metrics.
+# Los contadores empiezan en cero con cada proceso, como en cualquier exportador de Prometheus.
+
+# Límites de los buckets del histograma (segundos): de una consulta al índice a una llamada lenta a OpenAI
+DEFAULT_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+PREFIX = 'asistente'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class PipelineMetrics:
+    """
+    Registro de métricas por etapa, seguro entre hilos.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Límites superiores de los buckets del histograma de duración
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._durations = {}  # etapa -> [recuentos por bucket..., suma, total]
+        self._calls = {}      # (etapa, resultado) -> llamadas
+        self._in_flight = {}  # etapa -> llamadas en curso
+        self._bytes = {}      # (etapa, sentido) -> bytes
+        self._retries = {}    # servicio -> reintentos
+        self._listeners = []
+
+    # ---------- Registro ----------
+    def add_listener(self, listener):
+        """
+        Registra una función listener(etapa, segundos, ok) a la que se avisa de cada llamada
+        (por ejemplo RunReport.observe, que las atribuye a cada archivo).
+        """
+        self._listeners.append(listener)
+
+    def observe(self, stage, seconds, ok=True):
+        """
+        Anota una llamada terminada de una etapa.
+        """
+        for listener in self._listeners:
+            listener(stage, seconds, ok)
+        with self._lock:
+            entry = self._durations.setdefault(stage, [0] * len(self.buckets) + [0.0, 0])
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[position] += 1
+            entry[-2] += seconds
+            entry[-1] += 1
+            key = (stage, 'ok' if ok else 'error')
+            self._calls[key] = self._calls.get(key, 0) + 1
+
+    def _add_in_flight(self, stage, delta):
+        with self._lock:
+            self._in_flight[stage] = self._in_flight.get(stage, 0) + delta
+
+    @contextmanager
+    def track(self, stage):
+        """
+        Mide una llamada a una etapa. El bloque puede marcar el fallo con call['ok'] = False;
+        una excepción también cuenta como error (y se propaga).
+
+            with metrics.track('descarga') as call:
+                ...
+        """
+        call = {'ok': True}
+        self._add_in_flight(stage, 1)
+        start = time.perf_counter()
+        try:
+            yield call
+        except BaseException:
+            call['ok'] = False
+            raise
+        finally:
+            self._add_in_flight(stage, -1)
+            self.observe(stage, time.perf_counter() - start, call['ok'])
+
+    def instrument(self, stage, failed=None):
+        """
+        Decorador que mide cada llamada a una función como una etapa.
+
+        :param stage: Nombre de la etapa
+        :param failed: Función resultado -> bool que indica si la llamada falló (las funciones
+                       del pipeline devuelven None o False en lugar de lanzar excepciones)
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.track(stage) as call:
+                    result = function(*args, **kwargs)
+                    if failed is not None and failed(result):
+                        call['ok'] = False
+                    return result
+            return wrapper
+        return decorator
+
+    def add_bytes(self, stage, direction, count):
+        """
+        :param stage: Etapa que transfiere los datos
+        :param direction: 'recibidos' o 'enviados'
+        :param count: Número de bytes
+        """
+        with self._lock:
+            key = (stage, direction)
+            self._bytes[key] = self._bytes.get(key, 0) + count
+
+    def retry(self, service):
+        """
+        Anota un reintento ante un error transitorio de un servicio ('openai', 'sheets', ...).
+        """
+        with self._lock:
+            self._retries[service] = self._retries.get(service, 0) + 1
+
+    # ---------- Consulta ----------
+    def stage_summary(self):
+        """
+        :return: {etapa: {'llamadas', 'errores', 'segundos'}} con los valores acumulados
+        """
+        with self._lock:
+            return {stage: {'llamadas': entry[-1],
+                            'errores': self._calls.get((stage, 'error'), 0),
+                            'segundos': entry[-2]}
+                    for stage, entry in self._durations.items()}
+
+    def report(self):
+        """
+        Muestra en el log el tiempo acumulado por etapa, de la más lenta a la más rápida.
+        """
+        summary = self.stage_summary()
+        for stage, entry in sorted(summary.items(), key=lambda item: -item[1]['segundos']):
+            logging.info(f"Etapa '{stage}': {entry['llamadas']} llamadas, {entry['errores']} errores, "
+                         f"{entry['segundos']:.1f}s ({entry['segundos'] / entry['llamadas']:.3f}s de media).")
+
+    def render(self):
+        """
+        :return: Métricas en el formato de texto de Prometheus (versión 0.0.4)
+        """
+        with self._lock:
+            durations = {stage: list(entry) for stage, entry in self._durations.items()}
+            calls, in_flight = dict(self._calls), dict(self._in_flight)
+            transferred, retries = dict(self._bytes), dict(self._retries)
+
+        lines = []
+        def header(name, kind, description):
+            lines.append(f"# HELP {PREFIX}_{name} {description}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        header('stage_duration_seconds', 'histogram', 'Duración de cada llamada a una etapa del procesamiento.')
+        for stage, entry in sorted(durations.items()):
+            for bound, count in zip(self.buckets + (float('inf'),), entry[:len(self.buckets)] + [entry[-1]]):
+                lines.append(f"{PREFIX}_stage_duration_seconds_bucket{_labels(stage=stage, le=_number(bound))} {count}")
+            lines.append(f"{PREFIX}_stage_duration_seconds_sum{_labels(stage=stage)} {_number(entry[-2])}")
+            lines.append(f"{PREFIX}_stage_duration_seconds_count{_labels(stage=stage)} {entry[-1]}")
+
+        header('stage_calls_total', 'counter', 'Llamadas a cada etapa por resultado.')
+        for (stage, result), count in sorted(calls.items()):
+            lines.append(f"{PREFIX}_stage_calls_total{_labels(stage=stage, result=result)} {count}")
+
+        header('stage_in_flight', 'gauge', 'Llamadas en curso a cada etapa.')
+        for stage, count in sorted(in_flight.items()):
+            lines.append(f"{PREFIX}_stage_in_flight{_labels(stage=stage)} {count}")
+
+        header('bytes_total', 'counter', 'Bytes transferidos por etapa y sentido.')
+        for (stage, direction), count in sorted(transferred.items()):
+            lines.append(f"{PREFIX}_bytes_total{_labels(stage=stage, direction=direction)} {count}")
+
+        header('retries_total', 'counter', 'Reintentos ante errores transitorios por servicio.')
+        for service, count in sorted(retries.items()):
+            lines.append(f"{PREFIX}_retries_total{_labels(service=service)} {count}")
+
+        return '\n'.join(lines) + '\n'
+
+    # ---------- Exportación ----------
+    def write(self, path):
+        """
+        Escribe las métricas en un archivo de forma atómica (el textfile collector de
+        node_exporter no debe leer nunca un archivo a medias).
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, host='127.0.0.1', port=9108):
+        """
+        Sirve las métricas en http://host:port/metrics desde un hilo en segundo plano.
+
+        :return: Servidor HTTP (llamar a shutdown() para detenerlo)
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Métricas: {self.address_string()} - {format % args}")
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metricas', daemon=True).start()
+        logging.info(f"Métricas disponibles en http://{host}:{port}/metrics")
+        return server
@@ -0,0 +1,71 @@
+import io
+import logging
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow es opcional: sin él se envía la imagen original
+    Image = None
+
+# ================================
+# Preprocesado de imágenes antes de enviarlas a OpenAI
+# ================================
+# Tipos MIME según la firma de los primeros bytes del archivo
+_MAGIC_MIME_TYPES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+def sniff_mime_type(data, default='image/jpeg'):
+    """
+    Detecta el tipo MIME de una imagen a partir de sus primeros bytes.
+
+    :param data: Bytes de la imagen
+    :param default: Tipo a devolver si no se reconoce el formato
+    :return: Tipo MIME (por ejemplo 'image/png')
+    """
+    for magic, mime_type in _MAGIC_MIME_TYPES:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return default
+
+def preprocess_image(data, max_side=1600, quality=80, grayscale=True):
+    """
+    Reduce el tamaño de una imagen de ticket: corrige la orientación EXIF, la pasa a escala
+    de grises, la reescala para que su lado mayor no supere max_side y la recodifica en JPEG.
+    Si el resultado no es más pequeño que el original (o Pillow no está disponible), se
+    devuelve la imagen original con su tipo MIME real.
+
+    Es una función de nivel de módulo y solo usa bytes, para poder ejecutarla en un
+    ProcessPoolExecutor.
+
+    :param data: Bytes de la imagen original
+    :param max_side: Lado mayor máximo en píxeles (0 para no reescalar)
+    :param quality: Calidad JPEG de salida (1-95)
+    :param grayscale: Convertir a escala de grises
+    :return: Tupla (bytes, tipo MIME)
+    """
+    original_mime = sniff_mime_type(data)
+    if Image is None:
+        return data, original_mime
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            img = img.convert('L') if grayscale else img.convert('RGB')
+            if max_side and max(img.size) > max_side:
+                img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+            output = io.BytesIO()
+            img.save(output, format='JPEG', quality=quality, optimize=True)
+            processed = output.getvalue()
+    except Exception as e:
+        logging.warning(f"No se pudo preprocesar la imagen, se envía la original: {e}")
+        return data, original_mime
+
+    if len(processed) >= len(data):
+        return data, original_mime
+    return processed, 'image/jpeg'
@@ -0,0 +1,32 @@
+import random
+
+# ================================
+# Utilidades para reintentos con espera exponencial
+# ================================
+# Códigos HTTP que indican un fallo transitorio (cuota o error del servidor)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """
+    Calcula la espera antes de un reintento con backoff exponencial y "full jitter".
+
+    :param attempt: Número de intento fallido (empezando en 0)
+    :param base: Espera base en segundos
+    :param cap: Espera máxima en segundos
+    :return: Segundos a esperar
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def retry_after_seconds(headers, default=None):
+    """
+    Lee la cabecera Retry-After (en segundos) de una respuesta HTTP.
+
+    :param headers: Cabeceras de la respuesta (dict o similar)
+    :param default: Valor a devolver si la cabecera no existe o no es numérica
+    :return: Segundos a esperar o default
+    """
+    value = headers.get('Retry-After') if headers else None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,156 @@
+import os
+import signal
+import logging
+import argparse
+import threading
+
+import assistant_goupbi as app
+
+# ================================
+# Servicio de vigilancia de la carpeta de tickets
+# ================================
+# Alternativa a lanzar assistant_goupbi.py desde cron: un proceso residente que verifica la hoja
+# y carga el índice de procesados, los agregados y la tabla de negocios una sola vez, mantiene
+# abiertos los clientes de Google y el pool de preprocesado, y consulta la carpeta de Drive
+# (en modo incremental) cada pocos segundos. Los archivos nuevos pasan por el mismo camino que
+# process_tickets, así que el diario, los reintentos y las marcas de sincronización son comunes
+# a los dos modos.
+#
+# El intervalo entre consultas vuelve al mínimo cada vez que llega un ticket y se multiplica por
+# WATCH_BACKOFF en cada consulta sin novedades, hasta WATCH_MAX_INTERVAL. Con SIGTERM o Ctrl+C
+# el servicio termina el lote en curso, guarda el estado y sale.
+
+WATCH_MIN_INTERVAL = float(os.getenv('WATCH_MIN_INTERVAL', '5'))
+WATCH_MAX_INTERVAL = float(os.getenv('WATCH_MAX_INTERVAL', '300'))
+WATCH_BACKOFF = float(os.getenv('WATCH_BACKOFF', '2'))
+# Puerto en el que servir las métricas de Prometheus en /metrics (0 para no servirlas)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+class AdaptivePoller:
+    """
+    Intervalo de consulta adaptativo: mínimo tras actividad, creciente mientras no haya novedades.
+    """
+
+    def __init__(self, min_interval=WATCH_MIN_INTERVAL, max_interval=WATCH_MAX_INTERVAL, backoff=WATCH_BACKOFF):
+        """
+        :param min_interval: Segundos entre consultas cuando llegan tickets
+        :param max_interval: Segundos máximos entre consultas sin novedades
+        :param backoff: Factor por el que crece el intervalo en cada consulta sin novedades
+        """
+        self.min_interval = max(0.1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.interval = self.min_interval
+
+    def record(self, active):
+        """
+        Ajusta el intervalo según el resultado de la última consulta.
+
+        :param active: True si la consulta encontró trabajo
+        :return: Segundos que esperar hasta la siguiente consulta
+        """
+        if active:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
+
+def poll_once(days_threshold=7, max_workers=None):
+    """
+    Busca archivos nuevos en la carpeta de tickets y los procesa.
+
+    :param days_threshold: Días hacia atrás si todavía no hay marca de sincronización
+    :param max_workers: Hilos para descarga y extracción
+    :return: True si se procesó o reanudó algún archivo
+    """
+    files = app.get_new_files(app.TICKETS_FOLDER_ID, days_threshold, incremental=True)
+    # Drive devuelve de nuevo los archivos con la misma marca de tiempo que la última
+    # sincronización: los ya procesados se descartan aquí, sin tocar el diario ni la hoja
+    files = [file for file in files
+             if not app.processed_index.contains(file_name=file['name'], file_id=file['id'])]
+    # Un sondeo sin novedades es lo normal: no se anota por encima de DEBUG
+    run_stats = app.process_files(files, max_workers, idle_level=logging.DEBUG)
+    return bool(run_stats and (run_stats['processed'] or run_stats['resumed']))
+
+def install_signal_handlers(stop):
+    """
+    Hace que SIGTERM y SIGINT pidan la parada del servicio en lugar de interrumpirlo.
+
+    :param stop: threading.Event que se activa al recibir la señal
+    """
+    def request_stop(signum, frame):
+        if not stop.is_set():
+            logging.info(f"Señal {signal.Signals(signum).name} recibida: el servicio se detendrá "
+                         f"al terminar el lote en curso.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+def shutdown():
+    """
+    Libera los recursos del servicio: pool de preprocesado y bases de datos locales.
+    """
+    app.shutdown_image_pool()
+    app.save_local_state()
+    for store in (app.job_journal, app.processed_index, app.perceptual_index):
+        try:
+            store.close()
+        except Exception as e:
+            logging.warning(f"Error al cerrar {type(store).__name__}: {e}")
+
+def run_service(poller=None, days_threshold=7, max_workers=None, stop=None, metrics_port=METRICS_PORT):
+    """
+    Bucle principal del servicio: consulta, procesa y espera el intervalo adaptativo.
+
+    :param poller: AdaptivePoller (por defecto, con los valores de WATCH_*)
+    :param days_threshold: Días hacia atrás si todavía no hay marca de sincronización
+    :param max_workers: Hilos para descarga y extracción
+    :param stop: threading.Event que detiene el servicio (por defecto se crea uno ligado a SIGTERM)
+    :param metrics_port: Puerto en el que servir /metrics (0 para no servirlas)
+    """
+    poller = poller or AdaptivePoller()
+    if stop is None:
+        stop = threading.Event()
+        install_signal_handlers(stop)
+
+    logging.info(f"=== Servicio de vigilancia de tickets iniciado (carpeta {app.TICKETS_FOLDER_ID}, "
+                 f"consultas cada {poller.min_interval:g}-{poller.max_interval:g}s) ===")
+    metrics_server = app.metrics.serve(METRICS_HOST, metrics_port) if metrics_port else None
+    app.prepare_run()
+    try:
+        while not stop.is_set():
+            try:
+                active = poll_once(days_threshold, max_workers)
+            except Exception as e:
+                # Un fallo puntual (red, cuota) no detiene el servicio: se trata como consulta vacía
+                logging.error(f"Error en la consulta de la carpeta de tickets: {e}")
+                active = False
+            interval = poller.record(active)
+            logging.debug(f"Próxima consulta en {interval:g}s.")
+            stop.wait(interval)
+    finally:
+        shutdown()
+        if metrics_server:
+            metrics_server.shutdown()
+        logging.info("=== Servicio de vigilancia detenido ===")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vigila la carpeta de tickets y procesa los nuevos en cuanto llegan.")
+    parser.add_argument('--min-interval', type=float, default=WATCH_MIN_INTERVAL,
+                        help=f"Segundos entre consultas tras llegar tickets (por defecto {WATCH_MIN_INTERVAL:g})")
+    parser.add_argument('--max-interval', type=float, default=WATCH_MAX_INTERVAL,
+                        help=f"Segundos máximos entre consultas sin novedades (por defecto {WATCH_MAX_INTERVAL:g})")
+    parser.add_argument('--backoff', type=float, default=WATCH_BACKOFF,
+                        help=f"Factor de crecimiento del intervalo sin novedades (por defecto {WATCH_BACKOFF:g})")
+    parser.add_argument('--days', type=int, default=7,
+                        help="Días hacia atrás en la primera consulta si no hay marca de sincronización (por defecto 7)")
+    parser.add_argument('--workers', type=int, default=app.MAX_WORKERS,
+                        help=f"Hilos para descarga y extracción en paralelo (por defecto {app.MAX_WORKERS})")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="Servir las métricas de Prometheus en este puerto, en /metrics (por defecto no se sirven)")
+    args = parser.parse_args()
+
+    run_service(AdaptivePoller(args.min_interval, args.max_interval, args.backoff),
+                days_threshold=args.days, max_workers=args.workers, metrics_port=args.metrics_port)
@@ -0,0 +1,298 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pandas as pd
+
+from analisis_datos import analyze_data
+from instantanea_dashboard import build_snapshot
+import dashboard_pro
+
+# ================================
+# Servidor local del dashboard
+# ================================
+# Sirve dashboard.html y los datos del dashboard calculados en el servidor a partir de la
+# hoja de gastos (dashboard_pro.get_gastos_data + analisis_datos.analyze_data), con filtros
+# por fechas, categoría y negocio:
+#
+#   GET /                                  -> dashboard.html
+#   GET /dashboard_data.json?desde=2025-01-01&hasta=2025-03-31&categoria=Salud&empresa=Mercadona
+#   GET /api/dashboard?...                 -> lo mismo que /dashboard_data.json
+#
+# categoria y empresa admiten varios valores (repitiendo el parámetro o separados por comas).
+# Las respuestas llevan ETag (hash del contenido) y se comprimen con gzip si el cliente lo
+# acepta. Los resultados se guardan en una caché LRU en memoria por versión de los datos y
+# consulta, y cada consulta distinta se calcula una sola vez aunque la pidan varios clientes
+# a la vez.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DASHBOARD_HTML_PATH = os.path.join(SCRIPT_DIR, "dashboard.html")
+
+# Segundos durante los que se reutilizan los datos de la hoja sin volver a consultar Drive
+DASHBOARD_DATA_TTL = float(os.getenv('DASHBOARD_DATA_TTL', '60'))
+# Número máximo de consultas distintas en la caché de respuestas
+DASHBOARD_CACHE_SIZE = int(os.getenv('DASHBOARD_CACHE_SIZE', '128'))
+# Tamaño mínimo (bytes) a partir del cual se comprime la respuesta
+GZIP_MIN_BYTES = 1024
+
+DATA_PATHS = {'/dashboard_data.json', '/api/dashboard'}
+
+class LRUCache:
+    """
+    Caché LRU thread-safe de tamaño fijo.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = max(1, maxsize)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+class Response:
+    """
+    Cuerpo de una respuesta ya preparado: original, comprimido y su ETag.
+    """
+
+    def __init__(self, body, content_type, etag=None):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag or hashlib.sha256(body).hexdigest()[:32]
+        self.gzipped = gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None
+
+def parse_filters(query):
+    """
+    Normaliza los filtros de la consulta. El resultado sirve como clave de la caché.
+
+    :param query: Cadena de consulta de la URL
+    :return: Tupla (desde, hasta, categorias, empresas)
+    :raises ValueError: Si alguna fecha no tiene formato YYYY-MM-DD
+    """
+    params = parse_qs(query)
+
+    def values(name):
+        items = [item.strip() for value in params.get(name, []) for item in value.split(',')]
+        return tuple(sorted({item for item in items if item}))
+
+    def date(name):
+        value = (params.get(name) or [''])[0].strip()
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            raise ValueError(f"Fecha no válida en '{name}': {value} (formato YYYY-MM-DD)")
+
+    return date('desde'), date('hasta'), values('categoria'), values('empresa')
+
+def apply_filters(df, filters):
+    """
+    Filtra el DataFrame de gastos con una única máscara booleana.
+
+    :param df: DataFrame de dashboard_pro.get_gastos_data
+    :param filters: Tupla de parse_filters
+    :return: DataFrame filtrado
+    """
+    desde, hasta, categorias, empresas = filters
+    mask = pd.Series(True, index=df.index)
+    if desde:
+        mask &= df['fecha'] >= pd.Timestamp(desde)
+    if hasta:
+        # Incluye todo el día indicado
+        mask &= df['fecha'] < pd.Timestamp(hasta) + pd.Timedelta(days=1)
+    if categorias:
+        mask &= df['categoria'].isin(categorias)
+    if empresas:
+        mask &= df['empresa'].isin(empresas)
+    return df if mask.all() else df[mask]
+
+class DashboardData:
+    """
+    Datos de la hoja de gastos con una versión (hash del contenido) y respuestas cacheadas
+    por versión y consulta.
+    """
+
+    def __init__(self, ttl=DASHBOARD_DATA_TTL, cache_size=DASHBOARD_CACHE_SIZE):
+        self.ttl = ttl
+        self.cache = LRUCache(cache_size)
+        self._df = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._data_lock = threading.Lock()
+        self._compute_locks = {}
+        self._compute_locks_lock = threading.Lock()
+
+    def current(self):
+        """
+        Devuelve (df, versión), consultando la hoja como mucho una vez cada ttl segundos.
+        """
+        with self._data_lock:
+            now = datetime.now().timestamp()
+            if self._df is None or now - self._loaded_at >= self.ttl:
+                df = dashboard_pro.get_gastos_data()
+                if df is None:
+                    df = pd.DataFrame(columns=['fecha', 'descripcion', 'importe', 'empresa', 'categoria', 'forma_pago'])
+                version = str(int(pd.util.hash_pandas_object(df, index=False).sum())) if len(df) else 'vacio'
+                if version != self._version:
+                    logging.info(f"Datos del dashboard cargados: {len(df)} gastos (versión {version}).")
+                self._df, self._version, self._loaded_at = df, version, now
+            return self._df, self._version
+
+    def _compute_lock(self, key):
+        with self._compute_locks_lock:
+            return self._compute_locks.setdefault(key, threading.Lock())
+
+    def response(self, filters):
+        """
+        Respuesta JSON del dashboard para unos filtros, desde la caché si ya se calculó.
+        """
+        df, version = self.current()
+        key = (version, filters)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Una sola petición calcula cada consulta; el resto espera y reutiliza el resultado
+        with self._compute_lock(key):
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            filtered = apply_filters(df, filters).rename(columns={'fecha': 'Fecha'})
+            snapshot = build_snapshot(analyze_data(filtered))
+            desde, hasta, categorias, empresas = filters
+            snapshot['filtros'] = {'desde': desde, 'hasta': hasta,
+                                   'categoria': list(categorias), 'empresa': list(empresas)}
+            body = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            response = Response(body, 'application/json; charset=utf-8', etag=snapshot['etag'])
+            self.cache.put(key, response)
+        with self._compute_locks_lock:
+            self._compute_locks.pop(key, None)
+        return response
+
+class DashboardHandler(BaseHTTPRequestHandler):
+    """
+    Manejador HTTP del dashboard. La instancia de DashboardData se comparte en self.server.data.
+    """
+
+    server_version = "AsistenteDashboard/1.0"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            if url.path in ('/', '/index.html', '/dashboard.html'):
+                self._send(self.server.static_file(DASHBOARD_HTML_PATH, 'text/html; charset=utf-8'))
+            elif url.path in DATA_PATHS:
+                self._send(self.server.data.response(parse_filters(url.query)))
+            else:
+                self._send_error(HTTPStatus.NOT_FOUND, "Recurso no encontrado")
+        except ValueError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+        except Exception as e:
+            logging.exception(f"Error al atender {self.path}: {e}")
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "Error interno del servidor")
+
+    def _send(self, response):
+        etag = f'"{response.etag}"'
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        body = response.body
+        use_gzip = response.gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if use_gzip:
+            body = response.gzipped
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', response.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        # El navegador guarda la respuesta pero la revalida siempre con If-None-Match
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        body = json.dumps({'error': message}, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} - {format % args}")
+
+class DashboardServer(ThreadingHTTPServer):
+    """
+    Servidor HTTP con un hilo por petición, los datos del dashboard y los archivos estáticos en memoria.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, data=None):
+        super().__init__(address, DashboardHandler)
+        self.data = data or DashboardData()
+        self._static = {}
+        self._static_lock = threading.Lock()
+
+    def static_file(self, path, content_type):
+        """
+        Contenido de un archivo estático, releído solo si cambia su fecha de modificación.
+        """
+        mtime = os.path.getmtime(path)
+        with self._static_lock:
+            cached = self._static.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path, 'rb') as f:
+                    cached = (mtime, Response(f.read(), content_type))
+                self._static[path] = cached
+            return cached[1]
+
+def run_server(host='127.0.0.1', port=8000):
+    """
+    Arranca el servidor del dashboard hasta que se interrumpe con Ctrl+C.
+    """
+    server = DashboardServer((host, port))
+    logging.info(f"Dashboard disponible en http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Deteniendo el servidor del dashboard.")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor local del dashboard de gastos.")
+    parser.add_argument('--host', default=os.getenv('DASHBOARD_HOST', '127.0.0.1'),
+                        help="Dirección en la que escuchar (por defecto 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=int(os.getenv('DASHBOARD_PORT', '8000')),
+                        help="Puerto (por defecto 8000)")
+    args = parser.parse_args()
+
+    run_server(args.host, args.port)